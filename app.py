@@ -1,7 +1,14 @@
 import os
 import sqlite3
 import hashlib
+import hmac
+import re
+import math
+import mmap
+import struct
+import base64
 import secrets
+from markupsafe import Markup, escape
 from flask import (
     Flask, 
     render_template, 
@@ -11,25 +18,107 @@ from flask import (
     flash,
     abort,
     jsonify,
-    session
+    session,
+    g,
+    Response,
+    stream_with_context
 )
+from itsdangerous import Signer, BadSignature
 from werkzeug.utils import secure_filename
+from werkzeug.datastructures import FileStorage
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.exceptions import HTTPException
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from collections import deque, OrderedDict
 from pathlib import Path
 from functools import wraps
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import difflib  # Add this to your imports at the top
+import csv
+import io
+import json
+import zlib
+import heapq
+import itertools
+import click
+import time
+import queue
+import atexit
+import threading
+
+try:
+    from PIL import Image, ImageOps  # Optional: without Pillow, uploads are served as-is
+except ImportError:
+    Image = None
+
+try:
+    import rcssmin, rjsmin  # Optional: better minification for flask build-assets
+except ImportError:
+    rcssmin = rjsmin = None
 
 
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-here-change-this-in-production'
 app.config['SESSION_TYPE'] = 'filesystem'
+app.config['ORDER_ARCHIVE_AFTER_DAYS'] = 365
+app.config['ACTIVITY_LOG_HOT_MONTHS'] = 3
+app.config['ACTIVITY_LOG_RETENTION_MONTHS'] = 84  # 7 years of audit history
+app.config['PASSWORD_HASH_ITERATIONS'] = 1000000  # Calibrate with: flask --app app benchmark-password-hash
+app.config['PASSWORD_HASH_TARGET_MS'] = 250  # Login latency budget the benchmark aims for
+app.config['RATE_LIMIT_ENABLED'] = True
+app.config['RATE_LIMIT_BACKEND'] = 'memory'  # 'memory' (per worker) or 'sqlite' (shared by all workers)
 
 STATIC_IMG_DIR = Path(__file__).parent / "static" / "img"
 STATIC_DIR = Path(__file__).parent / 'static'
 STATIC_JS_DIR = STATIC_DIR / 'js'
+IMAGE_DERIVED_DIR = STATIC_IMG_DIR / 'derived'
+PRODUCT_IMG_DIR = STATIC_IMG_DIR / 'products'  # Content-addressed uploads, named by SHA-256
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+IMAGE_METADATA_TTL = 60  # seconds a worker keeps its copy of the image_metadata table
+IMAGE_LQIP_WIDTH = 16  # Width of the blurred inline placeholder
+ASSET_SOURCE_DIRS = ('css', 'js')  # Under static/; built into static/dist/
+ASSET_DIST_DIR = STATIC_DIR / 'dist'
+ASSET_MANIFEST = ASSET_DIST_DIR / 'manifest.json'
+IMAGE_DERIVATIVE_WIDTHS = (160, 320, 640, 960, 1280)
+IMAGE_DERIVATIVE_QUALITY = 80
+IMAGE_JOB_MAX_ATTEMPTS = 5
+IMAGE_JOB_RETRY_DELAY = 30  # seconds, doubled after each failed attempt
+IMAGE_JOB_POLL_INTERVAL = 5  # seconds between checks for jobs queued by other workers or due for retry
+IMAGE_JOB_STALE_AFTER = 600  # seconds before a 'running' job from a dead worker is picked up again
 ALLOWED_EXT = {"png", "jpeg", "webp", "gif", "avif", "jpg"} 
+FREE_SHIPPING_THRESHOLD = 80.00
+CART_BATCH_MAX_OPERATIONS = 50
+CART_STATE_COOKIE = 'cart_state'
+CART_STATE_MAX_AGE = 60  # seconds; carts are shared across devices, so the cookie is re-read from the DB this often
+ADMIN_ORDERS_PAGE_SIZE = 50
+BULK_STATUS_MAX_ORDERS = 500
+EXPORT_BATCH_SIZE = 200
+ARCHIVE_DB_PATH = 'archive.db'
+ACTIVITY_LOG_QUEUE_SIZE = 10000
+ACTIVITY_LOG_BATCH_SIZE = 100
+ACTIVITY_LOG_FLUSH_INTERVAL = 0.25  # seconds
+ACTIVITY_LOG_PAGE_SIZE = 200
+ACTIVITY_LOG_PARTITION_DIR = Path('activity_log_partitions')
+PASSWORD_HASH_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))
+PASSWORD_HASH_MAX_PENDING = PASSWORD_HASH_WORKERS * 4  # Running + queued jobs before we shed load
+PASSWORD_HASH_TIMEOUT = 10  # seconds
+PASSWORD_HASH_MIN_ITERATIONS = 600000  # OWASP floor for PBKDF2-HMAC-SHA256
+BREACHED_PASSWORD_FILTER = Path('breached_passwords.bloom')
+CUSTOMER_CACHE_SIZE = 1024
+CUSTOMER_CACHE_TTL = 30  # seconds; other workers see profile edits within this window
+RATE_LIMIT_DB_PATH = 'ratelimit.db'
+RATE_LIMIT_MAX_KEYS = 100000  # In-memory buckets kept before the least recently used are dropped
+
+# Token buckets per endpoint: (burst size, seconds to earn one token back).
+# 'ip' is keyed on the client address, 'account' on the email/user the request is for.
+RATE_LIMITS = {
+    'login': {'ip': (20, 6), 'account': (5, 60)},
+    'register': {'ip': (5, 120)},
+    'report_bug': {'ip': (10, 60), 'account': (5, 120)},
+    'request_product': {'ip': (10, 60), 'account': (5, 120)}
+}
 
 # Verify static folder exists
 STATIC_JS_DIR.mkdir(parents=True, exist_ok=True)
@@ -42,15 +131,45 @@ print(f"cart.js exists: {(STATIC_JS_DIR / 'cart.js').exists()}")
 def get_db_connection():
     conn = sqlite3.connect('store.db')
     conn.row_factory = sqlite3.Row
+    if query_trace is not None:
+        conn.set_trace_callback(query_trace.append)
     return conn
 
 def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXT
 
 # Authentication helper functions
+def current_hash_method():
+    """Werkzeug method string for the current hashing policy"""
+    return f"pbkdf2:sha256:{app.config['PASSWORD_HASH_ITERATIONS']}"
+
 def hash_password(password):
-    """Hash a password using pbkdf2 with salt (same as registration)"""
-    return generate_password_hash(password, method='pbkdf2:sha256', salt_length=16)
+    """Hash a password using pbkdf2 with salt at the current policy cost, in the hashing pool"""
+    return run_password_job(generate_password_hash, password, method=current_hash_method(), salt_length=16)
+
+def check_password(stored_hash, password):
+    """
+    Compare a password against a stored hash. Besides werkzeug hashes this
+    accepts the unsalted hex digests (SHA-1/SHA-256) left from before
+    migrate_password.py, so those users can still log in; login then
+    upgrades them through rehash_password.
+    """
+    if stored_hash and '$' not in stored_hash:
+        algorithm = {40: 'sha1', 64: 'sha256'}.get(len(stored_hash))
+        if not algorithm:
+            return False
+        digest = hashlib.new(algorithm, password.encode('utf-8')).hexdigest()
+        return hmac.compare_digest(digest, stored_hash.lower())
+    return check_password_hash(stored_hash, password)
+
+def verify_password(stored_hash, password):
+    """check_password, in the hashing pool"""
+    return run_password_job(check_password, stored_hash, password)
+
+def password_needs_rehash(stored_hash):
+    """True if the hash isn't pbkdf2:sha256 at exactly the current policy's iteration count"""
+    method = stored_hash.split('$', 1)[0] if '$' in stored_hash else ''
+    return method != current_hash_method()
 
 def get_user_role():
     """Get the current user's role from session"""
@@ -96,17 +215,16 @@ def manager_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-def log_activity(action, product_id=None, product_sku=None, product_name=None, details=None):
-    """Log admin/manager activity"""
+def log_activity(action, product_id=None, product_sku=None, product_name=None, details=None, conn=None):
+    """
+    Log admin/manager activity.
+    Entries are queued for the background writer so the request doesn't pay
+    for the insert. Pass conn to write inside the caller's transaction instead.
+    """
     if session.get('user_role') not in ['admin', 'manager']:
         return  # Only log admin/manager actions
     
-    conn = get_db_connection()
-    conn.execute("""
-        INSERT INTO activity_log 
-        (user_id, user_name, user_role, action, product_id, product_sku, product_name, details)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
+    row = (
         session.get('user_id'),
         session.get('user_name'),
         session.get('user_role'),
@@ -114,10 +232,1339 @@ def log_activity(action, product_id=None, product_sku=None, product_name=None, d
         product_id,
         product_sku,
         product_name,
-        details
-    ))
+        details,
+        time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())  # Same format/timezone as CURRENT_TIMESTAMP
+    )
+    
+    if conn is not None:
+        conn.execute(ACTIVITY_LOG_INSERT, row)
+        return
+    
+    start_activity_writer()
+    try:
+        activity_queue.put_nowait(row)
+    except queue.Full:
+        with activity_stats_lock:
+            activity_stats['dropped'] += 1
+        print(f"⚠️ Activity log queue full, dropped {action} entry")
+
+
+# ===========================
+# ACTIVITY LOG WRITER
+# ===========================
+
+ACTIVITY_LOG_INSERT = """
+    INSERT INTO activity_log 
+    (user_id, user_name, user_role, action, product_id, product_sku, product_name, details, timestamp)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+activity_queue = queue.Queue(maxsize=ACTIVITY_LOG_QUEUE_SIZE)
+activity_stats = {'written': 0, 'dropped': 0, 'failed': 0, 'batches': 0}
+activity_stats_lock = threading.Lock()
+activity_writer_lock = threading.Lock()
+activity_writer_stop = threading.Event()
+activity_writer_thread = None
+
+
+def start_activity_writer():
+    """Start the background writer thread once per process"""
+    global activity_writer_thread
+    if activity_writer_thread is not None and activity_writer_thread.is_alive():
+        return
+    with activity_writer_lock:
+        if activity_writer_thread is None or not activity_writer_thread.is_alive():
+            activity_writer_stop.clear()
+            activity_writer_thread = threading.Thread(target=activity_writer_loop,
+                                                      name='activity-log-writer',
+                                                      daemon=True)
+            activity_writer_thread.start()
+
+
+def next_activity_batch(first_timeout):
+    """Collect up to ACTIVITY_LOG_BATCH_SIZE rows, waiting at most one flush interval after the first"""
+    batch = [activity_queue.get(timeout=first_timeout)]
+    deadline = time.monotonic() + ACTIVITY_LOG_FLUSH_INTERVAL
+    while len(batch) < ACTIVITY_LOG_BATCH_SIZE:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(activity_queue.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
+
+
+def write_activity_batch(batch):
+    """Insert a batch of queued rows in one transaction, retrying briefly if the database is busy"""
+    for attempt in range(3):
+        try:
+            conn = get_db_connection()
+            try:
+                with conn:
+                    conn.executemany(ACTIVITY_LOG_INSERT, batch)
+            finally:
+                conn.close()
+            with activity_stats_lock:
+                activity_stats['written'] += len(batch)
+                activity_stats['batches'] += 1
+            break
+        except sqlite3.Error as e:
+            print(f"❌ Activity log write failed (attempt {attempt + 1}): {e}")
+            time.sleep(0.1 * (attempt + 1))
+    else:
+        with activity_stats_lock:
+            activity_stats['failed'] += len(batch)
+    
+    for _ in batch:
+        activity_queue.task_done()
+
+
+def activity_writer_loop():
+    """Drain the queue until asked to stop and the queue is empty"""
+    while True:
+        try:
+            batch = next_activity_batch(ACTIVITY_LOG_FLUSH_INTERVAL)
+        except queue.Empty:
+            if activity_writer_stop.is_set():
+                return
+            continue
+        write_activity_batch(batch)
+
+
+def flush_activity_log(timeout=5.0):
+    """Block until every queued entry has been written (or timeout seconds pass)"""
+    deadline = time.monotonic() + timeout
+    while activity_queue.unfinished_tasks and time.monotonic() < deadline:
+        if activity_writer_thread is None or not activity_writer_thread.is_alive():
+            # No writer running (e.g. during shutdown) - write what's left ourselves
+            try:
+                write_activity_batch(next_activity_batch(0))
+            except queue.Empty:
+                pass
+        else:
+            time.sleep(0.01)
+
+
+def get_activity_writer_stats():
+    """Queue depth and writer counters"""
+    with activity_stats_lock:
+        stats = dict(activity_stats)
+    stats['queue_depth'] = activity_queue.qsize()
+    stats['queue_capacity'] = ACTIVITY_LOG_QUEUE_SIZE
+    stats['writer_alive'] = activity_writer_thread is not None and activity_writer_thread.is_alive()
+    return stats
+
+
+@atexit.register
+def stop_activity_writer():
+    """Let the writer finish the queue on shutdown"""
+    activity_writer_stop.set()
+    if activity_writer_thread is not None:
+        activity_writer_thread.join(timeout=5.0)
+    flush_activity_log(timeout=5.0)
+
+# ===========================
+# PASSWORD HASHING POOL
+# ===========================
+# PBKDF2 is deliberately slow, so hashing runs in a small process pool
+# instead of the request thread. At most PASSWORD_HASH_MAX_PENDING jobs
+# may be running or queued; past that, auth requests get an immediate 503
+# so a login burst can't tie up every worker and starve the rest of the site.
+
+password_hash_pool = None
+password_hash_pool_lock = threading.Lock()
+password_hash_slots = threading.BoundedSemaphore(PASSWORD_HASH_MAX_PENDING)
+password_hash_stats = {'completed': 0, 'rejected': 0, 'timeouts': 0, 'errors': 0, 'pending': 0}
+password_hash_latencies = deque(maxlen=500)  # Recent end-to-end latencies in ms
+password_hash_stats_lock = threading.Lock()
+
+
+def get_password_hash_pool():
+    global password_hash_pool
+    with password_hash_pool_lock:
+        if password_hash_pool is None:
+            password_hash_pool = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS)
+        return password_hash_pool
+
+
+def reset_password_hash_pool():
+    """Throw away a broken pool; the next job starts a fresh one"""
+    global password_hash_pool
+    with password_hash_pool_lock:
+        if password_hash_pool is not None:
+            password_hash_pool.shutdown(wait=False, cancel_futures=True)
+        password_hash_pool = None
+
+
+def release_password_hash_slot(future):
+    password_hash_slots.release()
+    with password_hash_stats_lock:
+        password_hash_stats['pending'] -= 1
+
+
+def password_hashing_busy(stat):
+    with password_hash_stats_lock:
+        password_hash_stats[stat] += 1
+    abort(503, description='Password hashing is at capacity')
+
+
+def submit_password_job(func, *args, **kwargs):
+    """Queue func(*args, **kwargs) in the hashing pool and return its future, or abort with 503 if the pool is full"""
+    if not password_hash_slots.acquire(blocking=False):
+        password_hashing_busy('rejected')
+    
+    with password_hash_stats_lock:
+        password_hash_stats['pending'] += 1
+    
+    try:
+        future = get_password_hash_pool().submit(func, *args, **kwargs)
+    except (BrokenProcessPool, RuntimeError):
+        release_password_hash_slot(None)
+        reset_password_hash_pool()
+        password_hashing_busy('errors')
+    
+    # The slot is freed when the job finishes, even if nobody waits for it
+    future.add_done_callback(release_password_hash_slot)
+    return future
+
+
+def run_password_job(func, *args, **kwargs):
+    """Run func(*args, **kwargs) in the hashing pool and wait for it, or abort with 503 if the pool is full"""
+    started = time.perf_counter()
+    future = submit_password_job(func, *args, **kwargs)
+    
+    try:
+        result = future.result(timeout=PASSWORD_HASH_TIMEOUT)
+    except FutureTimeoutError:
+        password_hashing_busy('timeouts')
+    except BrokenProcessPool:
+        reset_password_hash_pool()
+        password_hashing_busy('errors')
+    
+    with password_hash_stats_lock:
+        password_hash_stats['completed'] += 1
+        password_hash_latencies.append((time.perf_counter() - started) * 1000)
+    return result
+
+
+def get_password_hash_stats():
+    """Pool counters, queue depth and latency percentiles"""
+    with password_hash_stats_lock:
+        stats = dict(password_hash_stats)
+        latencies = sorted(password_hash_latencies)
+    
+    stats['workers'] = PASSWORD_HASH_WORKERS
+    stats['max_pending'] = PASSWORD_HASH_MAX_PENDING
+    stats['queue_depth'] = max(0, stats['pending'] - PASSWORD_HASH_WORKERS)
+    if latencies:
+        stats['latency_ms'] = {
+            'p50': round(latencies[len(latencies) // 2], 1),
+            'p95': round(latencies[int(len(latencies) * 0.95)], 1),
+            'max': round(latencies[-1], 1),
+            'samples': len(latencies)
+        }
+    return stats
+
+
+def rehash_password(user_id, old_hash, password):
+    """
+    Queue a fresh hash under the current policy without waiting for it - the
+    login response doesn't pay for a second PBKDF2 run. Best effort: skipped
+    if the pool is busy, and the next login tries again.
+    """
+    method = current_hash_method()
+    try:
+        future = submit_password_job(generate_password_hash, password, method=method, salt_length=16)
+    except HTTPException:
+        return
+    
+    def store_new_hash(future):
+        if future.cancelled() or future.exception():
+            return
+        conn = get_db_connection()
+        # Only replace the hash we verified against, in case the password changed meanwhile
+        conn.execute('UPDATE customers SET password = ? WHERE id = ? AND password = ?',
+                     (future.result(), user_id, old_hash))
+        conn.commit()
+        conn.close()
+        invalidate_customer(user_id)
+        print(f"🔐 Rehashed password for user {user_id} to {method}")
+    
+    future.add_done_callback(store_new_hash)
+
+
+def time_pbkdf2(iterations):
+    """Milliseconds for one PBKDF2-HMAC-SHA256 hash at the given cost"""
+    started = time.perf_counter()
+    hashlib.pbkdf2_hmac('sha256', b'benchmark-password', b'benchmark-salt16', iterations)
+    return (time.perf_counter() - started) * 1000
+
+
+@app.cli.command('benchmark-password-hash')
+@click.option('--target-ms', type=float, default=None,
+              help='Login latency budget for one hash (default PASSWORD_HASH_TARGET_MS).')
+def benchmark_password_hash_command(target_ms):
+    """Measure PBKDF2 speed on this machine and recommend PASSWORD_HASH_ITERATIONS."""
+    target_ms = target_ms or app.config['PASSWORD_HASH_TARGET_MS']
+    probe = 100000
+    time_pbkdf2(probe)  # Warm up
+    per_iteration = min(time_pbkdf2(probe) for _ in range(3)) / probe
+    
+    current = app.config['PASSWORD_HASH_ITERATIONS']
+    recommended = max(PASSWORD_HASH_MIN_ITERATIONS, int(target_ms / per_iteration) // 10000 * 10000)
+    
+    print(f"PBKDF2-HMAC-SHA256: {per_iteration * 1000000:.1f} ms per million iterations")
+    print(f"Current policy:     {current} iterations ≈ {current * per_iteration:.0f} ms")
+    print(f"Target {target_ms:.0f} ms:      {recommended} iterations ≈ {recommended * per_iteration:.0f} ms")
+    if recommended * per_iteration > target_ms:
+        print(f"⚠️ The {PASSWORD_HASH_MIN_ITERATIONS} iteration floor is slower than the target on this machine")
+    if recommended != current:
+        print(f"\nSet app.config['PASSWORD_HASH_ITERATIONS'] = {recommended}; "
+              "existing hashes are upgraded as users log in.")
+
+
+@atexit.register
+def stop_password_hash_pool():
+    if password_hash_pool is not None:
+        password_hash_pool.shutdown(wait=False, cancel_futures=True)
+
+
+# ===========================
+# BREACHED PASSWORD FILTER
+# ===========================
+# A Bloom filter over a breached-password corpus, stored as a flat file
+# and memory-mapped read-only, so every worker shares the same pages and a
+# lookup touches k bits instead of loading millions of entries.
+# File layout: 32-byte header (magic, bit count m, hash count k, entries n)
+# followed by the m-bit array.
+
+BLOOM_MAGIC = b'CZBLOOM1'
+BLOOM_HEADER = struct.Struct('<8sQIQ4x')
+
+breached_filter = None  # (path, mtime, mmap, m, k, n)
+breached_filter_lock = threading.Lock()
+
+
+def bloom_positions(password, m, k):
+    """k bit positions for a password, using double hashing over one BLAKE2b digest"""
+    digest = hashlib.blake2b(password.encode('utf-8'), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], 'little')
+    h2 = int.from_bytes(digest[8:], 'little') | 1
+    return [(h1 + i * h2) % m for i in range(k)]
+
+
+def load_breached_filter():
+    """mmap the filter file, reopening it if it was rebuilt. Returns None if there is no filter."""
+    global breached_filter
+    try:
+        mtime = BREACHED_PASSWORD_FILTER.stat().st_mtime
+    except OSError:
+        return None
+    
+    with breached_filter_lock:
+        if breached_filter and breached_filter[:2] == (BREACHED_PASSWORD_FILTER, mtime):
+            return breached_filter
+        
+        with open(BREACHED_PASSWORD_FILTER, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, m, k, n = BLOOM_HEADER.unpack_from(data)
+        if magic != BLOOM_MAGIC:
+            print(f"⚠️ {BREACHED_PASSWORD_FILTER} is not a breached-password filter, ignoring it")
+            data.close()
+            return None
+        
+        breached_filter = (BREACHED_PASSWORD_FILTER, mtime, data, m, k, n)
+        return breached_filter
+
+
+def bloom_contains(data, m, k, password):
+    for position in bloom_positions(password, m, k):
+        if not data[BLOOM_HEADER.size + position // 8] & (1 << (position % 8)):
+            return False
+    return True
+
+
+def is_breached_password(password):
+    """True if the password is (probably) in the breached corpus; False if there's no filter"""
+    loaded = load_breached_filter()
+    if not loaded:
+        return False
+    _, _, data, m, k, _ = loaded
+    return bloom_contains(data, m, k, password)
+
+
+def bloom_false_positive_rate(m, k, n):
+    """Expected false positive rate for an m-bit filter with k hashes and n entries"""
+    return (1 - math.exp(-k * n / m)) ** k if n else 0.0
+
+
+def report_bloom_filter(data, m, k, n, samples=100000):
+    """Print size, expected FPR, and FPR measured with random passwords that can't be in the corpus"""
+    false_positives = sum(bloom_contains(data, m, k, f"fpr-probe-{secrets.token_hex(12)}") for _ in range(samples))
+    print(f"Entries:       {n:,}")
+    print(f"Size:          {m // 8 / 1024 / 1024:.1f} MiB ({m / max(n, 1):.1f} bits/entry), k = {k}")
+    print(f"Expected FPR:  {bloom_false_positive_rate(m, k, n):.4%}")
+    print(f"Measured FPR:  {false_positives / samples:.4%} ({false_positives} of {samples:,} random probes)")
+
+
+def iter_corpus(path):
+    """Passwords from a corpus file, one per line (a trailing ':count' as in HIBP dumps is dropped)"""
+    with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+        for line in f:
+            password = line.rstrip('\r\n')
+            if ':' in password and password.rsplit(':', 1)[1].isdigit():
+                password = password.rsplit(':', 1)[0]
+            if password:
+                yield password
+
+
+@app.cli.command('build-breached-password-filter')
+@click.argument('corpus', type=click.Path(exists=True, dir_okay=False))
+@click.option('--fpr', type=float, default=0.001, help='Target false positive rate.')
+def build_breached_password_filter_command(corpus, fpr):
+    """Build the breached-password Bloom filter from a corpus file (one password per line)."""
+    n = sum(1 for _ in iter_corpus(corpus))
+    m = max(64, math.ceil(-n * math.log(fpr) / math.log(2) ** 2))
+    m = (m + 7) // 8 * 8
+    k = max(1, round(m / max(n, 1) * math.log(2)))
+    print(f"Building filter for {n:,} passwords at {fpr:.3%} target FPR...")
+    
+    bits = bytearray(m // 8)
+    for password in iter_corpus(corpus):
+        for position in bloom_positions(password, m, k):
+            bits[position // 8] |= 1 << (position % 8)
+    
+    # Write to a temp file and swap it in, so running workers never see a half-written filter
+    temp_path = BREACHED_PASSWORD_FILTER.with_suffix('.tmp')
+    with open(temp_path, 'wb') as f:
+        f.write(BLOOM_HEADER.pack(BLOOM_MAGIC, m, k, n))
+        f.write(bits)
+    os.replace(temp_path, BREACHED_PASSWORD_FILTER)
+    print(f"✅ Wrote {BREACHED_PASSWORD_FILTER}")
+    
+    report_bloom_filter(bytes(BLOOM_HEADER.size) + bits, m, k, n)
+
+
+@app.cli.command('breached-password-filter-report')
+def breached_password_filter_report_command():
+    """Show the size and false positive rate of the breached-password filter."""
+    loaded = load_breached_filter()
+    if not loaded:
+        print(f"❌ No breached-password filter at {BREACHED_PASSWORD_FILTER}")
+        raise SystemExit(1)
+    _, _, data, m, k, n = loaded
+    report_bloom_filter(data, m, k, n)
+
+
+# ===========================
+# CUSTOMER PROFILE CACHE
+# ===========================
+# Per-worker LRU of customer rows for the session-backed pages, so account
+# and checkout don't hit the database on every request. Entries expire after
+# CUSTOMER_CACHE_TTL and are dropped as soon as this worker changes a profile.
+
+customer_cache = OrderedDict()  # user_id -> (expires at, customer dict)
+customer_cache_lock = threading.Lock()
+
+
+def get_customer(user_id, conn=None):
+    """Customer profile by id (as a dict), from the cache or the database. None if it doesn't exist."""
+    now = time.monotonic()
+    with customer_cache_lock:
+        cached = customer_cache.get(user_id)
+        if cached and cached[0] > now:
+            customer_cache.move_to_end(user_id)
+            return cached[1]
+    
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db_connection()
+    try:
+        row = conn.execute("SELECT * FROM customers WHERE id = ?", (user_id,)).fetchone()
+    finally:
+        if own_conn:
+            conn.close()
+    
+    if not row:
+        invalidate_customer(user_id)
+        return None
+    
+    customer = dict(row)
+    with customer_cache_lock:
+        customer_cache[user_id] = (now + CUSTOMER_CACHE_TTL, customer)
+        customer_cache.move_to_end(user_id)
+        if len(customer_cache) > CUSTOMER_CACHE_SIZE:
+            customer_cache.popitem(last=False)
+    return customer
+
+
+def invalidate_customer(user_id):
+    """Drop a customer from this worker's cache after their row changes"""
+    with customer_cache_lock:
+        customer_cache.pop(user_id, None)
+
+
+# ===========================
+# RATE LIMITING
+# ===========================
+# Token buckets, checked before a rate-limited route does any database or
+# password hashing work. Buckets live in a bounded in-process LRU dict, or
+# in a small SQLite file when RATE_LIMIT_BACKEND is 'sqlite' so every
+# worker process shares the same limits.
+
+rate_limit_buckets = OrderedDict()  # key -> (tokens, last refill time)
+rate_limit_lock = threading.Lock()
+rate_limit_db_ready = False  # rate_limit_buckets table created in RATE_LIMIT_DB_PATH by this worker
+
+
+def take_token_memory(key, capacity, refill_seconds, now):
+    """Take one token from an in-memory bucket. Returns seconds to wait, or 0 if allowed."""
+    with rate_limit_lock:
+        tokens, updated = rate_limit_buckets.pop(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) / refill_seconds)
+        
+        wait = 0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) * refill_seconds
+        
+        rate_limit_buckets[key] = (tokens, now)
+        if len(rate_limit_buckets) > RATE_LIMIT_MAX_KEYS:
+            rate_limit_buckets.popitem(last=False)
+        return wait
+
+
+def init_rate_limit_db():
+    """Create the shared bucket table - once per worker, not on every request"""
+    global rate_limit_db_ready
+    with rate_limit_lock:
+        if rate_limit_db_ready:
+            return
+        conn = sqlite3.connect(RATE_LIMIT_DB_PATH, timeout=1)
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated REAL NOT NULL
+                ) WITHOUT ROWID
+            ''')
+            conn.commit()
+        finally:
+            conn.close()
+        rate_limit_db_ready = True
+
+
+def take_token_sqlite(key, capacity, refill_seconds, now):
+    """Same as take_token_memory, but the bucket is shared through RATE_LIMIT_DB_PATH"""
+    conn = None
+    try:
+        if not rate_limit_db_ready:
+            init_rate_limit_db()
+        conn = sqlite3.connect(RATE_LIMIT_DB_PATH, timeout=1, isolation_level=None)
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute('SELECT tokens, updated FROM rate_limit_buckets WHERE key = ?', (key,)).fetchone()
+        tokens, updated = row if row else (capacity, now)
+        tokens = min(capacity, tokens + (now - updated) / refill_seconds)
+        
+        wait = 0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) * refill_seconds
+        
+        conn.execute('''
+            INSERT INTO rate_limit_buckets (key, tokens, updated) VALUES (?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated
+        ''', (key, tokens, now))
+        conn.execute('COMMIT')
+        return wait
+    except sqlite3.Error as e:
+        # Never lock people out because the limiter itself is unavailable
+        print(f"⚠️ Rate limiter unavailable: {e}")
+        return 0
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+def check_rate_limit(endpoint, account=None):
+    """Take a token from each bucket that applies. Returns seconds to wait, or 0 if allowed."""
+    limits = RATE_LIMITS.get(endpoint, {})
+    take_token = take_token_sqlite if app.config['RATE_LIMIT_BACKEND'] == 'sqlite' else take_token_memory
+    now = time.time()
+    
+    keys = []
+    if 'ip' in limits:
+        keys.append((f"{endpoint}:ip:{request.remote_addr}", limits['ip']))
+    if 'account' in limits and account:
+        keys.append((f"{endpoint}:account:{str(account).strip().lower()}", limits['account']))
+    
+    return max([take_token(key, capacity, refill, now) for key, (capacity, refill) in keys] or [0])
+
+
+def rate_limited(endpoint, account=None):
+    """
+    Decorator: reject POSTs over the endpoint's RATE_LIMITS with a 429
+    before the view runs. account is a callable returning the account key
+    (e.g. the submitted email) or None.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if request.method == 'POST' and app.config['RATE_LIMIT_ENABLED']:
+                wait = check_rate_limit(endpoint, account() if account else None)
+                if wait:
+                    g.retry_after = int(wait) + 1
+                    abort(429)
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+
+# ===========================
+# ACTIVITY LOG PARTITIONS
+# ===========================
+# activity_log holds the last ACTIVITY_LOG_HOT_MONTHS months. Older months
+# are rolled into one read-only SQLite file per month under
+# ACTIVITY_LOG_PARTITION_DIR, each with the same table, indexes and FTS
+# index, so the live table stays small and queries only open the months
+# they need.
+
+def shift_month(month, delta):
+    """'YYYY-MM' moved by delta months"""
+    year, mon = map(int, month.split('-'))
+    index = year * 12 + (mon - 1) + delta
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+
+def activity_partition_path(month):
+    return ACTIVITY_LOG_PARTITION_DIR / f"activity_log_{month.replace('-', '_')}.db"
+
+
+def list_activity_log_partitions():
+    """[(month, path)] for every partition file, newest first"""
+    if not ACTIVITY_LOG_PARTITION_DIR.exists():
+        return []
+    partitions = []
+    for path in ACTIVITY_LOG_PARTITION_DIR.glob('activity_log_*.db'):
+        month = path.stem[len('activity_log_'):].replace('_', '-')
+        partitions.append((month, path))
+    return sorted(partitions, reverse=True)
+
+
+def init_activity_partition_schema(conn, schema='main'):
+    """Same activity_log layout as the live table, minus the triggers (partitions are read-only)"""
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS {schema}.activity_log (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            user_name TEXT NOT NULL,
+            user_role TEXT NOT NULL,
+            action TEXT NOT NULL,
+            product_id INTEGER,
+            product_sku TEXT,
+            product_name TEXT,
+            details TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {schema}.idx_activity_log_timestamp ON activity_log(timestamp DESC, id DESC)')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {schema}.idx_activity_log_action ON activity_log(action, timestamp DESC, id DESC)')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {schema}.idx_activity_log_user ON activity_log(user_name, timestamp DESC, id DESC)')
+    conn.execute(f'''
+        CREATE VIRTUAL TABLE IF NOT EXISTS {schema}.activity_log_fts USING fts5(
+            product_name, product_sku, details,
+            content='activity_log', content_rowid='id'
+        )
+    ''')
+
+
+def rollover_activity_log(hot_months, retention_months):
+    """
+    Move whole months older than hot_months out of activity_log into monthly
+    partition files, compact them, and delete partitions older than
+    retention_months. Returns (rows moved, partitions dropped).
+    """
+    current_month = time.strftime('%Y-%m', time.gmtime())
+    cutoff = shift_month(current_month, -(hot_months - 1)) + '-01'
+    ACTIVITY_LOG_PARTITION_DIR.mkdir(parents=True, exist_ok=True)
+    
+    conn = get_db_connection()
+    moved = 0
+    try:
+        months = [row[0] for row in conn.execute('''
+            SELECT DISTINCT strftime('%Y-%m', timestamp) FROM activity_log WHERE timestamp < ?
+        ''', (cutoff,))]
+        
+        for month in months:
+            start, end = month + '-01', shift_month(month, 1) + '-01'
+            conn.execute('ATTACH DATABASE ? AS part', (str(activity_partition_path(month)),))
+            try:
+                init_activity_partition_schema(conn, 'part')
+                conn.commit()
+                
+                # Copy and delete in one transaction across both files
+                users = conn.execute('''
+                    SELECT user_name, COUNT(*) AS entries FROM activity_log
+                    WHERE timestamp >= ? AND timestamp < ? GROUP BY user_name
+                ''', (start, end)).fetchall()
+                count = conn.execute('''
+                    INSERT OR IGNORE INTO part.activity_log
+                    SELECT id, user_id, user_name, user_role, action, product_id,
+                           product_sku, product_name, details, timestamp
+                    FROM main.activity_log WHERE timestamp >= ? AND timestamp < ?
+                ''', (start, end)).rowcount
+                conn.execute('DELETE FROM main.activity_log WHERE timestamp >= ? AND timestamp < ?', (start, end))
+                
+                # The delete trigger decremented the user list; those entries still exist in the partition
+                conn.executemany('''
+                    INSERT INTO activity_log_users (user_name, entries) VALUES (?, ?)
+                    ON CONFLICT (user_name) DO UPDATE SET entries = entries + excluded.entries
+                ''', [(user['user_name'], user['entries']) for user in users])
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+            finally:
+                conn.execute('DETACH DATABASE part')
+            
+            compact_activity_partition(month)
+            moved += count
+            print(f"✅ Rolled {count} activity log entries into partition {month}")
+        
+        dropped = drop_expired_activity_partitions(conn, current_month, retention_months)
+    finally:
+        conn.close()
+    
+    return moved, dropped
+
+
+def compact_activity_partition(month):
+    """Rebuild the partition's FTS index, merge its segments and VACUUM the file"""
+    part = sqlite3.connect(activity_partition_path(month))
+    part.execute("INSERT INTO activity_log_fts (activity_log_fts) VALUES ('rebuild')")
+    part.execute("INSERT INTO activity_log_fts (activity_log_fts) VALUES ('optimize')")
+    part.commit()
+    part.execute('VACUUM')
+    part.close()
+
+
+def drop_expired_activity_partitions(conn, current_month, retention_months):
+    """Delete partition files older than the retention period"""
+    oldest_kept = shift_month(current_month, -retention_months)
+    dropped = 0
+    for month, path in list_activity_log_partitions():
+        if month >= oldest_kept:
+            continue
+        
+        part = sqlite3.connect(path)
+        users = part.execute('SELECT user_name, COUNT(*) FROM activity_log GROUP BY user_name').fetchall()
+        part.close()
+        
+        conn.executemany('UPDATE activity_log_users SET entries = entries - ? WHERE user_name = ?',
+                         [(entries, user_name) for user_name, entries in users])
+        conn.execute('DELETE FROM activity_log_users WHERE entries <= 0')
+        conn.commit()
+        path.unlink()
+        dropped += 1
+        print(f"🗑️ Dropped activity log partition {month} (past {retention_months}-month retention)")
+    return dropped
+
+
+@app.cli.command('rollover-activity-log')
+@click.option('--hot-months', type=int, default=None,
+              help='Months to keep in the live activity_log table.')
+@click.option('--retention-months', type=int, default=None,
+              help='Delete partitions older than this many months.')
+def rollover_activity_log_command(hot_months, retention_months):
+    """Roll old activity log months into partition files and apply retention."""
+    run_migrations()
+    flush_activity_log()
+    hot_months = hot_months or app.config['ACTIVITY_LOG_HOT_MONTHS']
+    retention_months = retention_months or app.config['ACTIVITY_LOG_RETENTION_MONTHS']
+    moved, dropped = rollover_activity_log(max(hot_months, 1), retention_months)
+    print(f"✅ Moved {moved} entries, dropped {dropped} expired partition(s)")
+
+
+# ===========================
+# IMAGE DERIVATIVES
+# ===========================
+# Uploaded images are resized to a few widths as WebP under
+# static/img/derived/ ("<file name>.<width>w.webp"), and templates list them in
+# srcset so listings download a thumbnail instead of the full-size upload.
+# Images without derivatives (or without Pillow installed) fall back to the
+# original file.
+
+derived_index = (None, {})  # (derived dir mtime, {source filename: [(width, derived filename)]})
+derived_index_lock = threading.Lock()
+
+
+def derived_filename(filename, width):
+    return f"{Path(filename).name}.{width}w.webp"
+
+
+def generate_image_derivatives(filename):
+    """Write the WebP derivatives for an image in static/img. Returns how many were written."""
+    if Image is None:
+        return 0
+    
+    with Image.open(STATIC_IMG_DIR / filename) as source:
+        image = ImageOps.exif_transpose(source)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.mode or 'transparency' in image.info else 'RGB')
+        save_image_metadata(filename, image, source.format)
+        if getattr(source, 'is_animated', False):
+            return 0  # Resizing would drop the animation
+        
+        # Every width smaller than the original, or just the original width for small images
+        widths = [w for w in IMAGE_DERIVATIVE_WIDTHS if w < image.width] or [image.width]
+        
+        IMAGE_DERIVED_DIR.mkdir(parents=True, exist_ok=True)
+        delete_image_derivatives(filename)  # A replaced upload may have different widths
+        for width in widths:
+            height = max(1, round(image.height * width / image.width))
+            resized = image.resize((width, height), Image.LANCZOS) if width != image.width else image
+            resized.save(IMAGE_DERIVED_DIR / derived_filename(filename, width), 'WEBP',
+                         quality=IMAGE_DERIVATIVE_QUALITY)
+        return len(widths)
+
+
+def delete_image_derivatives(filename):
+    """Remove an image's derivatives (e.g. when its product is deleted)"""
+    for _, name in get_image_derivatives(filename):
+        (IMAGE_DERIVED_DIR / name).unlink(missing_ok=True)
+
+
+def get_image_derivatives(filename):
+    """[(width, derived filename)] for an image, smallest first. Re-lists the directory only when it changes."""
+    global derived_index
+    try:
+        mtime = IMAGE_DERIVED_DIR.stat().st_mtime
+    except OSError:
+        return []
+    
+    with derived_index_lock:
+        if derived_index[0] != mtime:
+            index = {}
+            for path in IMAGE_DERIVED_DIR.iterdir():
+                parts = path.name.rsplit('.', 2)
+                if len(parts) == 3 and parts[2] == 'webp' and parts[1][:-1].isdigit():
+                    index.setdefault(parts[0], []).append((int(parts[1][:-1]), path.name))
+            for entries in index.values():
+                entries.sort()
+            derived_index = (mtime, index)
+        return derived_index[1].get(Path(filename).name, [])
+
+
+def image_attrs(filename, sizes='100vw', placeholder=False):
+    """Extra <img> attributes for static/img/<filename>: srcset/sizes for its derivatives, its intrinsic
+    width/height, and (with placeholder=True) data attributes for the blurred preview that
+    static/js/images.js shows until the image loads. Never opens the image file."""
+    if not filename:
+        return Markup('')
+    
+    attrs = []
+    derivatives = get_image_derivatives(filename)
+    if derivatives:
+        srcset = ', '.join(
+            f"{url_for('static', filename='img/derived/' + name)} {width}w" for width, name in derivatives
+        )
+        attrs.append(f'srcset="{escape(srcset)}" sizes="{escape(sizes)}"')
+    
+    metadata = get_image_metadata(filename)
+    if metadata:
+        attrs.append(f'width="{metadata["width"]}" height="{metadata["height"]}"')
+        if placeholder:
+            attrs.append(f'data-lqip="{escape(metadata["lqip"])}" data-lqip-color="{escape(metadata["dominant_color"])}"')
+    return Markup(' '.join(attrs))
+
+
+@app.cli.command('generate-image-derivatives')
+@click.option('--force', is_flag=True, help='Regenerate images that already have derivatives.')
+def generate_image_derivatives_command(force):
+    """Create responsive WebP derivatives for every image in static/img."""
+    if Image is None:
+        print("❌ Pillow is not installed (pip install Pillow)")
+        raise SystemExit(1)
+    
+    generated = skipped = failed = 0
+    for path in sorted(list_static_images()):
+        filename = path.relative_to(STATIC_IMG_DIR).as_posix()
+        if not force and get_image_derivatives(filename) and get_image_metadata(filename):
+            skipped += 1
+            continue
+        try:
+            generate_image_derivatives(filename)
+            generated += 1
+        except Exception as e:
+            print(f"⚠️ {path.name}: {e}")
+            failed += 1
+    
+    original = sum(p.stat().st_size for p in list_static_images())
+    derived = sum(p.stat().st_size for p in IMAGE_DERIVED_DIR.iterdir()) if IMAGE_DERIVED_DIR.exists() else 0
+    print(f"✅ Generated {generated}, skipped {skipped}, failed {failed}")
+    print(f"Originals: {original / 1024 / 1024:.1f} MB, derivatives: {derived / 1024 / 1024:.1f} MB")
+
+
+def list_static_images():
+    """Original images: static/img itself plus the content-addressed product store"""
+    for directory in (STATIC_IMG_DIR, PRODUCT_IMG_DIR):
+        if directory.exists():
+            yield from (p for p in directory.iterdir() if p.is_file() and allowed_file(p.name))
+
+
+# ===========================
+# IMAGE METADATA
+# ===========================
+# Dimensions, size, format, dominant colour and a tiny blurred WebP preview
+# (LQIP) for each image, recorded when its derivatives are generated. Pages
+# use them for width/height attributes and placeholders. Rows are looked up
+# by filename and cached per worker, so requests don't open image files.
+
+image_metadata_cache = {}  # filename -> (loaded at, row dict or None)
+image_metadata_lock = threading.Lock()
+
+
+def save_image_metadata(filename, image, image_format):
+    """Record metadata for an opened (and EXIF-rotated) image"""
+    rgb = image.convert('RGB')
+    dominant = rgb.resize((1, 1), Image.BOX).getpixel((0, 0))
+    
+    preview = rgb.resize((IMAGE_LQIP_WIDTH, max(1, round(image.height * IMAGE_LQIP_WIDTH / image.width))), Image.BOX)
+    buf = io.BytesIO()
+    preview.save(buf, 'WEBP', quality=30)
+    lqip = 'data:image/webp;base64,' + base64.b64encode(buf.getvalue()).decode()
+    
+    conn = get_db_connection()
+    try:
+        with conn:
+            conn.execute("""
+                INSERT INTO image_metadata (filename, width, height, bytes, format, dominant_color, lqip, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(filename) DO UPDATE SET
+                    width = excluded.width, height = excluded.height, bytes = excluded.bytes,
+                    format = excluded.format, dominant_color = excluded.dominant_color,
+                    lqip = excluded.lqip, updated_at = excluded.updated_at
+            """, (filename, image.width, image.height, (STATIC_IMG_DIR / filename).stat().st_size,
+                  (image_format or '').lower(), '#%02x%02x%02x' % dominant, lqip))
+    finally:
+        conn.close()
+    invalidate_image_metadata(filename)
+
+
+def delete_image_metadata(conn, filename):
+    conn.execute("DELETE FROM image_metadata WHERE filename = ?", (filename,))
+    invalidate_image_metadata(filename)
+
+
+def invalidate_image_metadata(filename):
+    """Make this worker re-read one image's row on next use"""
+    with image_metadata_lock:
+        image_metadata_cache.pop(filename, None)
+
+
+def get_image_metadata(filename):
+    """Metadata row (as a dict) for an image, or None if it hasn't been indexed"""
+    with image_metadata_lock:
+        cached = image_metadata_cache.get(filename)
+    if cached and time.monotonic() - cached[0] <= IMAGE_METADATA_TTL:
+        return cached[1]
+    
+    conn = get_db_connection()
+    try:
+        row = conn.execute("SELECT * FROM image_metadata WHERE filename = ?", (filename,)).fetchone()
+    except sqlite3.OperationalError:
+        row = None  # Table not migrated yet
+    finally:
+        conn.close()
+    
+    metadata = dict(row) if row else None
+    with image_metadata_lock:
+        image_metadata_cache[filename] = (time.monotonic(), metadata)
+    return metadata
+
+
+# ===========================
+# PRODUCT IMAGE STORE
+# ===========================
+# Product uploads are stored once per distinct content as
+# static/img/products/<sha256>.<ext>, and products.image holds that path.
+# Identical uploads share a file, a new upload never overwrites an old one,
+# and the URL changes whenever the content does, so these images (and their
+# derivatives) are served with an immutable far-future Cache-Control.
+
+CONTENT_ADDRESSED_NAME = re.compile(r'^[0-9a-f]{64}\.')
+
+
+def store_product_image(upload):
+    """Save an uploaded image under its content hash. Returns the products.image value."""
+    data = upload.read()
+    ext = upload.filename.rsplit('.', 1)[1].lower()
+    filename = f"products/{hashlib.sha256(data).hexdigest()}.{ext}"
+    path = STATIC_IMG_DIR / filename
+    
+    if not path.exists():
+        PRODUCT_IMG_DIR.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(f".{path.name}.{secrets.token_hex(4)}.tmp")
+        temp_path.write_bytes(data)
+        os.replace(temp_path, path)
+    return filename
+
+
+def enqueue_product_image(filename):
+    """Queue derivatives for a stored image - known content that already has them needs no work"""
+    if not get_image_derivatives(filename):
+        enqueue_image_job(filename)
+
+
+def release_product_image(conn, filename):
+    """Delete an image file and its derivatives once no product references it any more"""
+    if not filename:
+        return
+    if conn.execute("SELECT 1 FROM products WHERE image = ? LIMIT 1", (filename,)).fetchone():
+        return
+    try:
+        (STATIC_IMG_DIR / filename).unlink(missing_ok=True)
+        delete_image_derivatives(filename)
+        delete_image_metadata(conn, filename)
+        conn.commit()
+    except OSError as e:
+        print(f"Could not delete image file: {e}")
+
+
+def get_referenced_images():
+    """Image paths (relative to static/img) used by products, templates, CSS, JS or the PWA manifest"""
+    conn = get_db_connection()
+    referenced = {row['image'] for row in conn.execute("SELECT DISTINCT image FROM products WHERE image IS NOT NULL")}
+    conn.close()
+    
+    pattern = re.compile(r'img/([\w./-]+\.\w+)')
+    for directory, suffixes in [(Path(app.root_path) / app.template_folder, ('.html',)),
+                                (STATIC_DIR, ('.css', '.js', '.json'))]:
+        for path in directory.rglob('*'):
+            if path.suffix in suffixes and path.is_file():
+                referenced.update(pattern.findall(path.read_text(encoding='utf-8', errors='ignore')))
+    return referenced
+
+
+@app.cli.command('migrate-product-images')
+def migrate_product_images_command():
+    """Move products still using {sku}.{ext} images into the content-addressed store."""
+    run_migrations()
+    conn = get_db_connection()
+    products = conn.execute("""
+        SELECT id, sku, image FROM products
+        WHERE image IS NOT NULL AND image != '' AND image NOT LIKE 'products/%'
+    """).fetchall()
+    
+    moved = missing = 0
+    for product in products:
+        path = STATIC_IMG_DIR / product['image']
+        if not path.is_file():
+            print(f"⚠️ {product['sku']}: {product['image']} not found, left as is")
+            missing += 1
+            continue
+        with open(path, 'rb') as f:
+            filename = store_product_image(FileStorage(f, filename=path.name))
+        conn.execute("UPDATE products SET image = ? WHERE id = ?", (filename, product['id']))
+        conn.commit()
+        enqueue_product_image(filename)
+        moved += 1
+    conn.close()
+    
+    print(f"✅ Moved {moved} product image(s), {missing} missing")
+    print("Run `flask --app app process-image-jobs` to build their derivatives, then `flask --app app gc-images`.")
+
+
+@app.cli.command('gc-images')
+@click.option('--delete', is_flag=True, help='Delete the files instead of just listing them.')
+@click.option('--min-age', type=int, default=3600, help='Skip files modified in the last N seconds (uploads in progress).')
+def gc_images_command(delete, min_age):
+    """List (or delete) images and derivatives nothing references."""
+    referenced = get_referenced_images()
+    cutoff = time.time() - min_age
+    
+    orphans = [p for p in list_static_images()
+               if p.relative_to(STATIC_IMG_DIR).as_posix() not in referenced and p.stat().st_mtime < cutoff]
+    
+    # Derivatives whose original is gone
+    sources = {p.name for p in list_static_images() if p not in orphans}
+    if IMAGE_DERIVED_DIR.exists():
+        orphans += [p for p in IMAGE_DERIVED_DIR.iterdir()
+                    if p.name.rsplit('.', 2)[0] not in sources and p.stat().st_mtime < cutoff]
+    
+    freed = 0
+    conn = get_db_connection()
+    for path in orphans:
+        freed += path.stat().st_size
+        print(f"{'🗑️  Deleted' if delete else 'Unreferenced:'} {path.relative_to(STATIC_DIR)}")
+        if delete:
+            path.unlink()
+            delete_image_metadata(conn, path.relative_to(STATIC_IMG_DIR).as_posix())
     conn.commit()
     conn.close()
+    
+    action = 'Freed' if delete else 'Would free (run with --delete)'
+    print(f"✅ {len(orphans)} file(s). {action} {freed / 1024 / 1024:.1f} MB")
+
+
+# ===========================
+# IMAGE JOB QUEUE
+# ===========================
+# Derivatives take seconds to encode, so uploads only queue a job in the
+# image_jobs table. A background thread in each worker claims jobs with an
+# atomic UPDATE (so workers never process the same job twice), retries
+# failures with backoff, and marks a job 'failed' after
+# IMAGE_JOB_MAX_ATTEMPTS. `flask process-image-jobs` drains the queue from
+# the command line.
+
+image_worker_lock = threading.Lock()
+image_worker_wakeup = threading.Event()
+image_worker_stop = threading.Event()
+image_worker_thread = None
+
+
+def start_image_worker():
+    """Start the background image worker thread once per process"""
+    global image_worker_thread
+    if image_worker_thread is not None and image_worker_thread.is_alive():
+        return
+    with image_worker_lock:
+        if image_worker_thread is None or not image_worker_thread.is_alive():
+            image_worker_stop.clear()
+            image_worker_thread = threading.Thread(target=image_worker_loop,
+                                                   name='image-worker',
+                                                   daemon=True)
+            image_worker_thread.start()
+
+
+def enqueue_image_job(filename):
+    """Queue derivative generation for an image (once - a pending or running job for the same file is reused)"""
+    if Image is None:
+        return
+    
+    conn = get_db_connection()
+    try:
+        with conn:
+            conn.execute("""
+                INSERT INTO image_jobs (filename)
+                SELECT ? WHERE NOT EXISTS (
+                    SELECT 1 FROM image_jobs WHERE filename = ? AND status IN ('pending', 'running')
+                )
+            """, (filename, filename))
+    finally:
+        conn.close()
+    
+    start_image_worker()
+    image_worker_wakeup.set()
+
+
+def claim_image_job():
+    """Mark the oldest runnable job as running and return it, or None if there's nothing to do"""
+    now = time.time()
+    conn = get_db_connection()
+    try:
+        with conn:
+            rows = conn.execute("""
+                UPDATE image_jobs
+                SET status = 'running', attempts = attempts + 1, claimed_at = ?
+                WHERE id = (
+                    SELECT id FROM image_jobs
+                    WHERE (status = 'pending' AND run_after <= ?)
+                       OR (status = 'running' AND claimed_at < ?)
+                    ORDER BY id
+                    LIMIT 1
+                )
+                RETURNING id, filename, attempts
+            """, (now, now, now - IMAGE_JOB_STALE_AFTER)).fetchall()
+    finally:
+        conn.close()
+    return rows[0] if rows else None
+
+
+def run_image_job(job):
+    """Generate one job's derivatives and record the outcome"""
+    error = None
+    try:
+        if (STATIC_IMG_DIR / job['filename']).exists():
+            generate_image_derivatives(job['filename'])
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    
+    conn = get_db_connection()
+    try:
+        with conn:
+            if error is None:
+                conn.execute("UPDATE image_jobs SET status = 'done', last_error = NULL WHERE id = ?", (job['id'],))
+            elif job['attempts'] >= IMAGE_JOB_MAX_ATTEMPTS:
+                conn.execute("UPDATE image_jobs SET status = 'failed', last_error = ? WHERE id = ?", (error, job['id']))
+            else:
+                retry_at = time.time() + IMAGE_JOB_RETRY_DELAY * 2 ** (job['attempts'] - 1)
+                conn.execute("UPDATE image_jobs SET status = 'pending', last_error = ?, run_after = ? WHERE id = ?",
+                             (error, retry_at, job['id']))
+    finally:
+        conn.close()
+    
+    if error:
+        print(f"⚠️ Image job {job['id']} ({job['filename']}) failed, attempt {job['attempts']}: {error}")
+    return error is None
+
+
+def image_worker_loop():
+    """Process jobs until asked to stop, sleeping while the queue is empty"""
+    while not image_worker_stop.is_set():
+        try:
+            job = claim_image_job()
+        except sqlite3.Error as e:
+            print(f"❌ Could not claim image job: {e}")
+            job = None
+        
+        if job is None:
+            image_worker_wakeup.wait(IMAGE_JOB_POLL_INTERVAL)
+            image_worker_wakeup.clear()
+            continue
+        run_image_job(job)
+
+
+@atexit.register
+def stop_image_worker():
+    """Stop the worker after its current job; unfinished jobs stay queued for next time"""
+    image_worker_stop.set()
+    image_worker_wakeup.set()
+    if image_worker_thread is not None:
+        image_worker_thread.join(timeout=5.0)
+
+
+def get_image_job(filename):
+    """Latest job for an image, or None"""
+    if not filename:
+        return None
+    conn = get_db_connection()
+    job = conn.execute("""
+        SELECT * FROM image_jobs WHERE filename = ? ORDER BY id DESC LIMIT 1
+    """, (filename,)).fetchone()
+    conn.close()
+    
+    if job and job['status'] in ('pending', 'running'):
+        start_image_worker()  # Resume work queued before this process started
+    return job
+
+
+@app.cli.command('process-image-jobs')
+def process_image_jobs_command():
+    """Process queued image jobs until none are ready to run."""
+    run_migrations()
+    done = failed = 0
+    while True:
+        job = claim_image_job()
+        if job is None:
+            break
+        if run_image_job(job):
+            done += 1
+        else:
+            failed += 1
+    print(f"✅ Processed {done} image job(s), {failed} failed")
+
+
+# ===========================
+# STATIC ASSET BUILD
+# ===========================
+# `flask build-assets` minifies static/css and static/js into
+# static/dist/<name>.<hash>.<ext> and writes a manifest mapping each source
+# path to its built file. url_for('static', ...) resolves through the
+# manifest, so pages link the fingerprinted copy, which (like content-
+# addressed images) is served as immutable. Without a build, the original
+# files are linked as before.
+
+asset_manifest = (None, {})  # (manifest mtime, {'css/styles.css': 'dist/styles.<hash>.css'})
+asset_manifest_lock = threading.Lock()
+
+
+def minify_css(text):
+    """Minify CSS with rcssmin. Without it the file is only fingerprinted - regexes can't tell strings and url() apart."""
+    return rcssmin.cssmin(text) if rcssmin is not None else text
+
+
+def minify_js(text):
+    """Minify JS with rjsmin. Without it the file is only fingerprinted - regex-stripping JS isn't safe."""
+    return rjsmin.jsmin(text) if rjsmin is not None else text
+
+
+def get_asset_manifest():
+    """Source path -> built path, reloaded when the manifest file changes"""
+    global asset_manifest
+    try:
+        mtime = ASSET_MANIFEST.stat().st_mtime
+    except OSError:
+        return {}
+    
+    with asset_manifest_lock:
+        if asset_manifest[0] != mtime:
+            asset_manifest = (mtime, json.loads(ASSET_MANIFEST.read_text()))
+        return asset_manifest[1]
+
+
+@app.url_defaults
+def fingerprint_static_url(endpoint, values):
+    """Point url_for('static', filename=...) at the built, fingerprinted copy when there is one"""
+    if endpoint == 'static' and 'filename' in values:
+        values['filename'] = get_asset_manifest().get(values['filename'], values['filename'])
+
+
+@app.after_request
+def cache_immutable_static(response):
+    """Fingerprinted assets and content-addressed images never change, so browsers
+    can cache them for a year without revalidating"""
+    path = request.path
+    if response.status_code in (200, 304) and path.startswith('/static/') and (
+            path.startswith('/static/dist/') and not path.endswith('/manifest.json')
+            or CONTENT_ADDRESSED_NAME.match(path.rsplit('/', 1)[1])):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    return response
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Minify and fingerprint static CSS/JS into static/dist and write the manifest."""
+    ASSET_DIST_DIR.mkdir(parents=True, exist_ok=True)
+    manifest = {}
+    
+    for directory in ASSET_SOURCE_DIRS:
+        for path in sorted((STATIC_DIR / directory).glob('*')):
+            if path.suffix not in ('.css', '.js'):
+                continue
+            source = path.read_text(encoding='utf-8')
+            built = minify_css(source) if path.suffix == '.css' else minify_js(source)
+            digest = hashlib.sha256(built.encode('utf-8')).hexdigest()[:12]
+            output = ASSET_DIST_DIR / f"{path.stem}.{digest}{path.suffix}"
+            output.write_text(built, encoding='utf-8')
+            
+            manifest[f"{directory}/{path.name}"] = f"dist/{output.name}"
+            print(f"{directory}/{path.name}: {len(source) / 1024:.1f} KB -> {output.name} {len(built) / 1024:.1f} KB")
+    
+    # Swap the manifest in atomically. Keep the previous build too, so pages
+    # rendered just before the swap can still load their assets.
+    previous = json.loads(ASSET_MANIFEST.read_text()) if ASSET_MANIFEST.exists() else {}
+    temp_path = ASSET_MANIFEST.with_suffix('.tmp')
+    temp_path.write_text(json.dumps(manifest, indent=2))
+    os.replace(temp_path, ASSET_MANIFEST)
+    
+    keep = {Path(built).name for built in [*manifest.values(), *previous.values()]} | {ASSET_MANIFEST.name}
+    for path in ASSET_DIST_DIR.iterdir():
+        if path.name not in keep:
+            path.unlink()
+    
+    if rcssmin is None or rjsmin is None:
+        print("⚠️ rcssmin/rjsmin not installed - files without a minifier were only fingerprinted, not minified")
+    print(f"✅ Wrote {ASSET_MANIFEST.relative_to(STATIC_DIR.parent)}")
+
 
 # ===========================
 # CONTEXT PROCESSOR
@@ -157,7 +1604,9 @@ def utility_processor():
     return dict(
         get_summer_blend_id=get_summer_blend_id,
         get_breville_id=get_breville_id,
-        get_cruzy_beans_id=get_cruzy_beans_id  # ADD THIS
+        get_cruzy_beans_id=get_cruzy_beans_id,  # ADD THIS
+        get_cart_state=get_cart_state,
+        image_attrs=image_attrs
     )
 
 
@@ -330,6 +1779,7 @@ def about():
     return render_template("about.html", year=datetime.now().year)
 
 @app.route("/report-bug", methods=['GET', 'POST'])
+@rate_limited('report_bug', account=lambda: session.get('user_id'))
 def report_bug():
     """Bug report page - requires login"""
     # Check if user is logged in
@@ -349,23 +1799,6 @@ def report_bug():
         
         conn = get_db_connection()
         
-        # Create bug_reports table if it doesn't exist
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS bug_reports (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                username TEXT NOT NULL,
-                title TEXT NOT NULL,
-                category TEXT NOT NULL,
-                description TEXT NOT NULL,
-                device TEXT,
-                severity TEXT NOT NULL,
-                status TEXT DEFAULT 'open',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        
         # Insert bug report
         conn.execute('''
             INSERT INTO bug_reports (user_id, username, title, category, description, device, severity)
@@ -374,11 +1807,416 @@ def report_bug():
         
         conn.commit()
         conn.close()
-        
-        flash(f"✅ Thank you, {username}! Your bug report has been submitted successfully.", "success")
-        return redirect(url_for('about'))
+        
+        flash(f"✅ Thank you, {username}! Your bug report has been submitted successfully.", "success")
+        return redirect(url_for('about'))
+    
+    return render_template('report_bug.html', year=datetime.now().year)
+
+# ===========================
+# SALES ROLLUPS
+# ===========================
+
+def record_order_sales(conn, order_id, sign=1):
+    """
+    Add (sign=1) or remove (sign=-1) one order's contribution to the daily
+    sales rollups. Called inside the caller's transaction.
+    """
+    order = conn.execute('''
+        SELECT date(created_at) AS day, subtotal, total FROM orders_new WHERE id = ?
+    ''', (order_id,)).fetchone()
+    if not order:
+        return
+    
+    # Use the category the SKU was rolled up under, so removing an order
+    # undoes exactly what adding it did even if the product changed since
+    items = conn.execute('''
+        SELECT oi.product_sku, oi.product_name, oi.quantity, oi.subtotal,
+               COALESCE(s.category, p.category, 'other') AS category
+        FROM order_items_new oi
+        LEFT JOIN sales_daily_sku s ON s.day = ? AND s.sku = oi.product_sku
+        LEFT JOIN products p ON p.sku = oi.product_sku
+        WHERE oi.order_id = ?
+    ''', (order['day'], order_id)).fetchall()
+    
+    add_order_to_sales(conn, order['day'], order['subtotal'], order['total'], items, sign)
+
+
+def add_order_to_sales(conn, day, subtotal, total, items, sign=1):
+    """Upsert one order into the rollups; items need product_sku, product_name, quantity, subtotal and category"""
+    units = sum(item['quantity'] for item in items)
+    conn.execute('''
+        INSERT INTO sales_daily (day, orders, units, revenue, gross)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (day) DO UPDATE SET
+            orders = orders + excluded.orders,
+            units = units + excluded.units,
+            revenue = revenue + excluded.revenue,
+            gross = gross + excluded.gross
+    ''', (day, sign, sign * units, sign * subtotal, sign * total))
+    
+    categories = {}
+    for item in items:
+        totals = categories.setdefault(item['category'], [0, 0.0])
+        totals[0] += item['quantity']
+        totals[1] += item['subtotal']
+    
+    conn.executemany('''
+        INSERT INTO sales_daily_category (day, category, orders, units, revenue)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (day, category) DO UPDATE SET
+            orders = orders + excluded.orders,
+            units = units + excluded.units,
+            revenue = revenue + excluded.revenue
+    ''', [(day, category, sign, sign * totals[0], sign * totals[1])
+          for category, totals in categories.items()])
+    
+    conn.executemany('''
+        INSERT INTO sales_daily_sku (day, sku, name, category, orders, units, revenue)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (day, sku) DO UPDATE SET
+            orders = orders + excluded.orders,
+            units = units + excluded.units,
+            revenue = revenue + excluded.revenue
+    ''', [(day, item['product_sku'], item['product_name'], item['category'],
+           sign, sign * item['quantity'], sign * item['subtotal'])
+          for item in items])
+
+
+def apply_status_change_to_sales(conn, order_id, old_status, new_status):
+    """Cancelled orders don't count as sales - adjust the rollups when an order enters or leaves 'cancelled'"""
+    if old_status != 'cancelled' and new_status == 'cancelled':
+        record_order_sales(conn, order_id, sign=-1)
+    elif old_status == 'cancelled' and new_status != 'cancelled':
+        record_order_sales(conn, order_id, sign=1)
+
+
+def rebuild_sales_rollups(conn):
+    """Recompute every rollup row from orders_new/order_items_new (caller commits)"""
+    conn.execute('DELETE FROM sales_daily')
+    conn.execute('DELETE FROM sales_daily_category')
+    conn.execute('DELETE FROM sales_daily_sku')
+    
+    conn.execute('''
+        INSERT INTO sales_daily (day, orders, units, revenue, gross)
+        SELECT date(o.created_at), COUNT(*), COALESCE(SUM(u.units), 0), SUM(o.subtotal), SUM(o.total)
+        FROM orders_new o
+        LEFT JOIN (
+            SELECT order_id, SUM(quantity) AS units FROM order_items_new GROUP BY order_id
+        ) u ON u.order_id = o.id
+        WHERE o.status != 'cancelled'
+        GROUP BY date(o.created_at)
+    ''')
+    
+    conn.execute('''
+        INSERT INTO sales_daily_sku (day, sku, name, category, orders, units, revenue)
+        SELECT date(o.created_at), oi.product_sku, MAX(oi.product_name), COALESCE(MAX(p.category), 'other'),
+               COUNT(*), SUM(oi.quantity), SUM(oi.subtotal)
+        FROM order_items_new oi
+        JOIN orders_new o ON o.id = oi.order_id
+        LEFT JOIN products p ON p.sku = oi.product_sku
+        WHERE o.status != 'cancelled'
+        GROUP BY date(o.created_at), oi.product_sku
+    ''')
+    
+    conn.execute('''
+        INSERT INTO sales_daily_category (day, category, orders, units, revenue)
+        SELECT date(o.created_at), COALESCE(s.category, 'other'),
+               COUNT(DISTINCT o.id), SUM(oi.quantity), SUM(oi.subtotal)
+        FROM order_items_new oi
+        JOIN orders_new o ON o.id = oi.order_id
+        LEFT JOIN sales_daily_sku s ON s.day = date(o.created_at) AND s.sku = oi.product_sku
+        WHERE o.status != 'cancelled'
+        GROUP BY date(o.created_at), COALESCE(s.category, 'other')
+    ''')
+    
+    # Archived orders left orders_new but still count as sales
+    categories = {row['sku']: row['category'] for row in conn.execute('SELECT sku, category FROM products')}
+    for order, items in iter_archived_orders("status != 'cancelled'"):
+        for item in items:
+            item['category'] = categories.get(item['product_sku'], 'other')
+        add_order_to_sales(conn, order['created_at'][:10], order['subtotal'], order['total'], items)
+
+
+@app.cli.command('rebuild-sales-rollups')
+def rebuild_sales_rollups_command():
+    """Recompute the daily sales rollup tables from scratch."""
+    run_migrations()
+    conn = get_db_connection()
+    rebuild_sales_rollups(conn)
+    conn.commit()
+    days = conn.execute('SELECT COUNT(*) FROM sales_daily').fetchone()[0]
+    conn.close()
+    print(f"✅ Rebuilt sales rollups ({days} days)")
+
+
+@app.route("/manager/reports/sales")
+@manager_required
+def sales_report():
+    """Revenue, units and AOV for a date range, read from the daily rollups"""
+    # Rollup days are date(created_at), which is UTC - default the range in UTC too
+    today = datetime.now(timezone.utc).date()
+    date_to = parse_date(request.args.get('date_to', '')) or today.strftime('%Y-%m-%d')
+    date_from = parse_date(request.args.get('date_from', '')) or (today - timedelta(days=29)).strftime('%Y-%m-%d')
+    if date_from > date_to:
+        date_from, date_to = date_to, date_from
+    
+    conn = get_db_connection()
+    
+    days = conn.execute('''
+        SELECT day, orders, units, revenue, gross FROM sales_daily
+        WHERE day BETWEEN ? AND ? AND orders > 0
+        ORDER BY day
+    ''', (date_from, date_to)).fetchall()
+    
+    categories = conn.execute('''
+        SELECT category, SUM(orders) AS orders, SUM(units) AS units, SUM(revenue) AS revenue
+        FROM sales_daily_category
+        WHERE day BETWEEN ? AND ?
+        GROUP BY category
+        HAVING SUM(units) > 0
+        ORDER BY revenue DESC
+    ''', (date_from, date_to)).fetchall()
+    
+    top_skus = conn.execute('''
+        SELECT sku, MAX(name) AS name, MAX(category) AS category,
+               SUM(orders) AS orders, SUM(units) AS units, SUM(revenue) AS revenue
+        FROM sales_daily_sku
+        WHERE day BETWEEN ? AND ?
+        GROUP BY sku
+        HAVING SUM(units) > 0
+        ORDER BY revenue DESC
+        LIMIT 20
+    ''', (date_from, date_to)).fetchall()
+    
+    conn.close()
+    
+    total_orders = sum(day['orders'] for day in days)
+    summary = {
+        'orders': total_orders,
+        'units': sum(day['units'] for day in days),
+        'revenue': sum(day['revenue'] for day in days),
+        'gross': sum(day['gross'] for day in days),
+        'aov': sum(day['gross'] for day in days) / total_orders if total_orders else 0
+    }
+    
+    return render_template('sales_report.html',
+                         days=days,
+                         categories=categories,
+                         top_skus=top_skus,
+                         summary=summary,
+                         date_from=date_from,
+                         date_to=date_to,
+                         year=datetime.now().year)
+
+
+# ===========================
+# ORDER ARCHIVE
+# ===========================
+
+def get_archive_connection():
+    """
+    Connection to the order archive, or None if nothing has been archived yet.
+    archive_orders creates the schema - request paths only ever read it.
+    """
+    if not os.path.exists(ARCHIVE_DB_PATH):
+        return None
+    conn = sqlite3.connect(ARCHIVE_DB_PATH)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def init_archive_schema(conn, schema='main'):
+    """
+    Archived orders are append-only. The lookup columns are stored plainly
+    and indexed; the full order and its items live in a zlib-compressed
+    JSON payload that is only decoded when someone opens the order.
+    """
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS {schema}.archived_orders (
+            id INTEGER PRIMARY KEY,
+            order_number TEXT UNIQUE NOT NULL,
+            user_id INTEGER,
+            customer_email TEXT NOT NULL,
+            status TEXT NOT NULL,
+            total REAL NOT NULL,
+            created_at TIMESTAMP NOT NULL,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            payload BLOB NOT NULL
+        )
+    ''')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {schema}.idx_archived_orders_user ON archived_orders(user_id, created_at DESC)')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {schema}.idx_archived_orders_created ON archived_orders(created_at)')
+    conn.execute(f'''
+        CREATE INDEX IF NOT EXISTS {schema}.idx_archived_orders_email
+        ON archived_orders(customer_email COLLATE NOCASE, created_at DESC)
+    ''')
+
+
+def pack_archived_order(order, items):
+    """Compress an order row and its item rows into an archive payload"""
+    record = {'order': dict(order), 'items': [dict(item) for item in items]}
+    return zlib.compress(json.dumps(record).encode('utf-8'), 9)
+
+
+def unpack_archived_order(row):
+    """Return (order, items) dicts from an archived_orders row"""
+    record = json.loads(zlib.decompress(row['payload']).decode('utf-8'))
+    order = record['order']
+    order['archived'] = True
+    return order, record['items']
+
+
+def iter_archived_orders(where='1=1', params=()):
+    """Yield (order, items) for archived orders matching a WHERE clause"""
+    archive = get_archive_connection()
+    if archive is None:
+        return
+    try:
+        for row in archive.execute(f'SELECT payload FROM archived_orders WHERE {where} ORDER BY created_at DESC', params):
+            yield unpack_archived_order(row)
+    finally:
+        archive.close()
+
+
+def find_archived_order(order_number=None, order_id=None):
+    """Look up one archived order by number or id, returning (order, items) or (None, [])"""
+    archive = get_archive_connection()
+    if archive is None:
+        return None, []
+    if order_number is not None:
+        row = archive.execute('SELECT payload FROM archived_orders WHERE order_number = ?', (order_number,)).fetchone()
+    else:
+        row = archive.execute('SELECT payload FROM archived_orders WHERE id = ?', (order_id,)).fetchone()
+    archive.close()
+    return unpack_archived_order(row) if row else (None, [])
+
+
+def get_archived_order_summaries(user_id=None, email=None, limit=None):
+    """Order list rows (no payload decoding) for a customer's archived orders"""
+    archive = get_archive_connection()
+    if archive is None:
+        return []
+    query = '''
+        SELECT id, order_number, customer_email, status, total, created_at, 1 AS archived
+        FROM archived_orders
+    '''
+    if user_id is not None:
+        query += ' WHERE user_id = ? ORDER BY created_at DESC, id DESC'
+        params = [user_id]
+    else:
+        query += ' WHERE customer_email = ? COLLATE NOCASE ORDER BY created_at DESC, id DESC'
+        params = [email]
+    if limit:
+        query += ' LIMIT ?'
+        params.append(limit)
+    
+    orders = archive.execute(query, params).fetchall()
+    archive.close()
+    return orders
+
+
+def get_customer_order_history(user_id, limit=None):
+    """
+    A customer's live and archived orders, newest first by (created_at, id).
+    Archiving goes by age and status, so an archived order can be newer than a
+    live one (an old order still 'shipped' stays live) - merge, don't append.
+    """
+    query = 'SELECT * FROM orders_new WHERE user_id = ? ORDER BY created_at DESC, id DESC'
+    params = [user_id]
+    if limit:
+        query += ' LIMIT ?'
+        params.append(limit)
+    
+    conn = get_db_connection()
+    orders = conn.execute(query, params).fetchall()
+    conn.close()
+    
+    archived = get_archived_order_summaries(user_id=user_id, limit=limit)
+    merged = heapq.merge(orders, archived, key=lambda order: (order['created_at'], order['id']), reverse=True)
+    return list(itertools.islice(merged, limit))
+
+
+def get_archived_order_count():
+    """Number of orders in the archive (they aren't in order_status_counts)"""
+    archive = get_archive_connection()
+    if archive is None:
+        return 0
+    count = archive.execute('SELECT COUNT(*) FROM archived_orders').fetchone()[0]
+    archive.close()
+    return count
+
+
+def archive_orders(older_than_days, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Move delivered/cancelled orders older than older_than_days into the archive.
+    Each batch is copied and deleted in one transaction across both databases,
+    so an order is never in both places or neither. Returns the number moved.
+    """
+    conn = get_db_connection()
+    conn.execute('ATTACH DATABASE ? AS archive', (ARCHIVE_DB_PATH,))
+    init_archive_schema(conn, 'archive')
+    conn.commit()
+    
+    moved = 0
+    try:
+        while True:
+            orders = conn.execute('''
+                SELECT * FROM orders_new
+                WHERE status IN ('delivered', 'cancelled')
+                  AND created_at < datetime('now', ?)
+                LIMIT ?
+            ''', (f'-{int(older_than_days)} days', batch_size)).fetchall()
+            if not orders:
+                break
+            
+            order_ids = [order['id'] for order in orders]
+            placeholders = ','.join('?' * len(order_ids))
+            items_by_order = {}
+            for item in conn.execute(f'''
+                SELECT * FROM order_items_new WHERE order_id IN ({placeholders}) ORDER BY order_id, id
+            ''', order_ids):
+                items_by_order.setdefault(item['order_id'], []).append(item)
+            
+            # A plain INSERT: if an order is somehow already archived, the batch
+            # fails and rolls back rather than deleting a row that wasn't copied
+            conn.executemany('''
+                INSERT INTO archive.archived_orders
+                (id, order_number, user_id, customer_email, status, total, created_at, payload)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [
+                (order['id'], order['order_number'], order['user_id'], order['customer_email'],
+                 order['status'], order['total'], order['created_at'],
+                 pack_archived_order(order, items_by_order.get(order['id'], [])))
+                for order in orders
+            ])
+            conn.execute(f'DELETE FROM order_items_new WHERE order_id IN ({placeholders})', order_ids)
+            conn.execute(f'DELETE FROM orders_new WHERE id IN ({placeholders})', order_ids)
+            conn.commit()
+            moved += len(orders)
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
     
-    return render_template('report_bug.html', year=datetime.now().year)
+    return moved
+
+
+@app.cli.command('archive-orders')
+@click.option('--days', type=int, default=None,
+              help='Archive delivered/cancelled orders older than this many days.')
+def archive_orders_command(days):
+    """Move old delivered/cancelled orders into the compressed archive."""
+    run_migrations()
+    days = days if days is not None else app.config['ORDER_ARCHIVE_AFTER_DAYS']
+    try:
+        moved = archive_orders(days)
+    except sqlite3.IntegrityError as e:
+        print(f"❌ Archiving stopped, an order is already in {ARCHIVE_DB_PATH}: {e}")
+        raise SystemExit(1)
+    print(f"✅ Archived {moved} order(s) older than {days} days to {ARCHIVE_DB_PATH}")
+
 
 @app.route("/manager/reports")
 @admin_required  # Both admin and manager can access
@@ -459,6 +2297,7 @@ def update_missing_product_status(request_id):
 
 
 @app.route("/request-product", methods=['GET', 'POST'])
+@rate_limited('request_product', account=lambda: session.get('user_id'))
 def request_product():
     """Request a missing product"""
     # Check if user is logged in
@@ -478,23 +2317,6 @@ def request_product():
         
         conn = get_db_connection()
         
-        # Create missing_products table if it doesn't exist
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS missing_products (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                username TEXT NOT NULL,
-                product_name TEXT NOT NULL,
-                product_category TEXT NOT NULL,
-                description TEXT NOT NULL,
-                additional_info TEXT,
-                priority TEXT NOT NULL,
-                status TEXT DEFAULT 'pending',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES customers (id)
-            )
-        ''')
-        
         # Insert missing product request
         conn.execute('''
             INSERT INTO missing_products (user_id, username, product_name, product_category, description, additional_info, priority)
@@ -546,6 +2368,7 @@ def product_detail(product_id):
 # ===========================
 
 @app.route("/register", methods=["GET", "POST"])
+@rate_limited('register', account=lambda: request.form.get('email'))
 def register():
     """User registration with strong password requirements"""
     if request.method == "POST":
@@ -583,7 +2406,7 @@ def register():
             return redirect(url_for("login"))
         
         # Hash password with salt
-        hashed_password = generate_password_hash(password, method='pbkdf2:sha256', salt_length=16)
+        hashed_password = hash_password(password)
         
         # Insert new user
         try:
@@ -602,6 +2425,7 @@ def register():
             session['user_name'] = user['name']
             session['user_email'] = user['email']
             session['user_role'] = user['role']
+            flash_cart_changes(merge_cart_on_login(user['id']))
             
             flash(f"Welcome, {name}! Your account has been created.", "success")
             return redirect(url_for('index'))
@@ -614,6 +2438,22 @@ def register():
     return render_template("register.html", year=datetime.now().year)
 
 
+# Common weak passwords
+COMMON_PASSWORDS = frozenset([
+    'password', 'password123', '123456', '12345678', 'qwerty', 'abc123',
+    'monkey', 'letmein', 'trustno1', 'dragon', 'baseball', 'iloveyou',
+    'master', 'sunshine', 'ashley', 'bailey', 'shadow', 'superman',
+    'coffee', 'espresso', 'cappuccino', 'latte', 'cruzy', 'admin',
+    'qwertyuiop', 'asdfghjkl', 'zxcvbnm', '1234567890',
+    'passw0rd', 'p@ssword', 'p@ssw0rd', 'welcome', 'login'
+])
+
+SEQUENTIAL_PATTERNS = (
+    'abcd', 'bcde', 'cdef', 'defg', '1234', '2345', '3456', '4567',
+    'qwer', 'wert', 'erty', 'asdf', 'sdfg', 'dfgh'
+)
+
+
 def validate_password(password, name="", email=""):
     """
     Validate password against professional security requirements.
@@ -621,21 +2461,6 @@ def validate_password(password, name="", email=""):
     """
     errors = []
     
-    # Common weak passwords
-    COMMON_PASSWORDS = [
-        'password', 'password123', '123456', '12345678', 'qwerty', 'abc123',
-        'monkey', 'letmein', 'trustno1', 'dragon', 'baseball', 'iloveyou',
-        'master', 'sunshine', 'ashley', 'bailey', 'shadow', 'superman',
-        'coffee', 'espresso', 'cappuccino', 'latte', 'cruzy', 'admin',
-        'qwertyuiop', 'asdfghjkl', 'zxcvbnm', '1234567890',
-        'passw0rd', 'p@ssword', 'p@ssw0rd', 'welcome', 'login'
-    ]
-    
-    SEQUENTIAL_PATTERNS = [
-        'abcd', 'bcde', 'cdef', 'defg', '1234', '2345', '3456', '4567',
-        'qwer', 'wert', 'erty', 'asdf', 'sdfg', 'dfgh'
-    ]
-    
     # 1. Length check
     if len(password) < 8:
         errors.append("Password must be at least 8 characters long.")
@@ -665,6 +2490,10 @@ def validate_password(password, name="", email=""):
     if password.lower() in COMMON_PASSWORDS:
         errors.append("This password is too common. Please choose a stronger password.")
     
+    # 7b. Check against the breached-password corpus
+    elif is_breached_password(password):
+        errors.append("This password has appeared in a data breach. Please choose a different password.")
+    
     # 8. Check for sequential patterns
     password_lower = password.lower()
     for pattern in SEQUENTIAL_PATTERNS:
@@ -673,7 +2502,6 @@ def validate_password(password, name="", email=""):
             break
     
     # 9. Check for repeating characters (e.g., aaaa, 1111)
-    import re
     if re.search(r'(.)\1{3,}', password):
         errors.append("Password cannot contain repeating characters (e.g., aaaa, 1111).")
     
@@ -691,6 +2519,7 @@ def validate_password(password, name="", email=""):
 
 
 @app.route("/login", methods=["GET", "POST"])
+@rate_limited('login', account=lambda: request.form.get('email'))
 def login():
     """User login"""
     if request.method == "POST":
@@ -705,12 +2534,17 @@ def login():
         user = conn.execute("SELECT * FROM customers WHERE email = ?", (email,)).fetchone()
         conn.close()
         
-        # Verify password using check_password_hash (secure comparison with salt)
-        if user and check_password_hash(user['password'], password):
+        # Verify password in the hashing pool (secure comparison with salt)
+        if user and verify_password(user['password'], password):
+            # Upgrade old or off-policy hashes now that we know the password
+            if password_needs_rehash(user['password']):
+                rehash_password(user['id'], user['password'], password)
+            
             session['user_id'] = user['id']
             session['user_name'] = user['name']
             session['user_email'] = user['email']
             session['user_role'] = user['role']  # ← ADD THIS LINE!
+            flash_cart_changes(merge_cart_on_login(user['id']))
             
             flash(f"Welcome back, {user['name']}!", "success")
             
@@ -729,32 +2563,23 @@ def logout():
     """User logout"""
     session.clear()
     flash('You have been logged out.', 'info')
-    return redirect(url_for('index'))
+    response = redirect(url_for('index'))
+    response.delete_cookie(CART_STATE_COOKIE)
+    return response
 
 
 @app.route("/account")
 @login_required
 def account():
     """User account page"""
-    conn = get_db_connection()
-    user = conn.execute("""
-        SELECT * FROM customers WHERE id = ?
-    """, (session['user_id'],)).fetchone()
-    
-    # Get recent orders
-    orders = conn.execute('''
-        SELECT * FROM orders_new 
-        WHERE user_id = ? 
-        ORDER BY created_at DESC
-        LIMIT 5
-    ''', (session['user_id'],)).fetchall()
-    
-    conn.close()
-    
+    user = get_customer(session['user_id'])
     if not user:
         flash('User not found.', 'danger')
         return redirect(url_for('logout'))
     
+    # Get recent orders
+    orders = get_customer_order_history(session['user_id'], limit=5)
+    
     return render_template('account.html', 
                          user=user, 
                          orders=orders,
@@ -765,9 +2590,8 @@ def account():
 @login_required
 def edit_account():
     """Edit user account"""
-    conn = get_db_connection()
-    
     if request.method == 'POST':
+        conn = get_db_connection()
         name = request.form.get('name', '').strip()
         phone = request.form.get('phone', '').strip()
         address = request.form.get('address', '').strip()
@@ -792,7 +2616,7 @@ def edit_account():
                     conn.close()
                     return redirect(url_for('edit_account'))
                 
-                if not check_password_hash(user['password'], current_password):
+                if not verify_password(user['password'], current_password):
                     flash('Current password is incorrect.', 'danger')
                     conn.close()
                     return redirect(url_for('edit_account'))
@@ -812,7 +2636,7 @@ def edit_account():
                     return redirect(url_for('edit_account'))
                 
                 # Hash new password
-                hashed_password = generate_password_hash(new_password, method='pbkdf2:sha256', salt_length=16)
+                hashed_password = hash_password(new_password)
                 
                 # Update with new password
                 conn.execute("""
@@ -833,18 +2657,18 @@ def edit_account():
                 flash('✅ Profile updated successfully!', 'success')
             
             conn.commit()
+            invalidate_customer(session['user_id'])
             session['user_name'] = name
             return redirect(url_for('account'))
             
+        except HTTPException:
+            raise  # e.g. 503 from the password hashing pool
         except Exception as e:
             flash(f'Error updating account: {e}', 'danger')
         finally:
             conn.close()
     
-    user = conn.execute("""
-        SELECT * FROM customers WHERE id = ?
-    """, (session['user_id'],)).fetchone()
-    conn.close()
+    user = get_customer(session['user_id'])
     
     if not user:
         flash('User not found.', 'danger')
@@ -854,6 +2678,213 @@ def edit_account():
 
 
 
+def get_activity_log_filters():
+    """Read the activity log filters from the query string"""
+    return {
+        'action': request.args.get('action', ''),
+        'user': request.args.get('user', ''),
+        'search': request.args.get('search', ''),
+        'date_from': parse_date(request.args.get('date_from', '').strip()),
+        'date_to': parse_date(request.args.get('date_to', '').strip())
+    }
+
+
+def fts_query(text):
+    """Turn free text into an FTS5 query: every word must match, as a prefix"""
+    terms = [term.replace('"', '""') for term in text.split()]
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def query_activity_log(conn, filters, position=None, limit=None):
+    """
+    Activity log rows from one partition (the live table or a monthly file),
+    newest first. Every partition has the same activity_log/activity_log_fts layout.
+    """
+    query = "SELECT a.* FROM activity_log a WHERE 1=1"
+    params = []
+    
+    if filters['action']:
+        query += " AND a.action = ?"
+        params.append(filters['action'])
+    
+    if filters['user']:
+        query += " AND a.user_name = ?"
+        params.append(filters['user'])
+    
+    if filters['date_from']:
+        query += " AND a.timestamp >= ?"
+        params.append(filters['date_from'])
+    
+    if filters['date_to']:
+        query += " AND a.timestamp < date(?, '+1 day')"
+        params.append(filters['date_to'])
+    
+    match = fts_query(filters['search'])
+    if match:
+        query += " AND a.id IN (SELECT rowid FROM activity_log_fts WHERE activity_log_fts MATCH ?)"
+        params.append(match)
+    
+    if position:
+        query += " AND (a.timestamp, a.id) < (?, ?)"
+        params.extend(position)
+    
+    query += " ORDER BY a.timestamp DESC, a.id DESC"
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+    
+    return conn.execute(query, params)
+
+
+def iter_activity_log_sources(conn, filters, position=None):
+    """
+    Yield a connection for each partition that can hold matching rows, newest first:
+    the live table, then the monthly partition files. Partitions outside the
+    date range (or newer than the cursor) are skipped without being opened.
+    """
+    yield conn
+    
+    upper = filters['date_to'] or None
+    if position:
+        upper = min(upper, position[0][:10]) if upper else position[0][:10]
+    
+    for month, path in list_activity_log_partitions():
+        if filters['date_from'] and shift_month(month, 1) + '-01' <= filters['date_from']:
+            break  # This and every older partition ends before the range starts
+        if upper and month + '-01' > upper:
+            continue
+        
+        part = sqlite3.connect(path)
+        part.row_factory = sqlite3.Row
+        try:
+            yield part
+        finally:
+            part.close()
+
+
+def fetch_activity_log_page(conn, filters, cursor='', page_size=None):
+    """
+    One page of activity log entries, newest first, using keyset pagination
+    on (timestamp, id) across the live table and monthly partitions.
+    Returns (logs, next_cursor).
+    """
+    page_size = page_size or ACTIVITY_LOG_PAGE_SIZE
+    position = parse_keyset_cursor(cursor)
+    logs = []
+    for source in iter_activity_log_sources(conn, filters, position):
+        logs += query_activity_log(source, filters, position, page_size + 1 - len(logs)).fetchall()
+        if len(logs) > page_size:
+            break
+    
+    next_cursor = None
+    if len(logs) > page_size:
+        logs = logs[:page_size]
+        next_cursor = f"{logs[-1]['timestamp']}|{logs[-1]['id']}"
+    
+    return logs, next_cursor
+
+
+ACTIVITY_EXPORT_COLUMNS = [
+    'id', 'timestamp', 'user_id', 'user_name', 'user_role', 'action',
+    'product_id', 'product_sku', 'product_name', 'details'
+]
+
+
+def iter_activity_export_batches(filters, cursor=''):
+    """
+    Yield activity log rows EXPORT_BATCH_SIZE at a time, newest first.
+    Each batch is a fresh keyset query on its own connection, so nothing
+    stays open between batches while the client downloads.
+    """
+    while True:
+        conn = get_db_connection()
+        try:
+            logs, cursor = fetch_activity_log_page(conn, filters, cursor, EXPORT_BATCH_SIZE)
+        finally:
+            conn.close()
+        
+        if logs:
+            yield logs
+        if not cursor:
+            return
+
+
+def export_activity_csv(filters, cursor):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    
+    writer.writerow(ACTIVITY_EXPORT_COLUMNS + ['cursor'])
+    yield buffer.getvalue()
+    
+    for logs in iter_activity_export_batches(filters, cursor):
+        buffer.seek(0)
+        buffer.truncate()
+        for log in logs:
+            writer.writerow([log[column] for column in ACTIVITY_EXPORT_COLUMNS] + [f"{log['timestamp']}|{log['id']}"])
+        yield buffer.getvalue()
+
+
+def export_activity_jsonl(filters, cursor):
+    for logs in iter_activity_export_batches(filters, cursor):
+        lines = []
+        for log in logs:
+            record = {column: log[column] for column in ACTIVITY_EXPORT_COLUMNS}
+            record['cursor'] = f"{log['timestamp']}|{log['id']}"
+            lines.append(json.dumps(record))
+        yield '\n'.join(lines) + '\n'
+
+
+@app.route("/activity-log/export")
+@manager_required
+def export_activity_log():
+    """
+    Stream the activity log as CSV (default) or JSONL, newest first, with the
+    same filters as the activity log page. Every row carries a cursor; pass the
+    last one back as ?cursor= to resume an interrupted export.
+    """
+    export_format = request.args.get('format', 'csv').lower()
+    if export_format not in ('csv', 'jsonl'):
+        return jsonify({'success': False, 'message': 'Format must be csv or jsonl'}), 400
+    
+    filters = get_activity_log_filters()
+    cursor = request.args.get('cursor', '')
+    if cursor and not parse_keyset_cursor(cursor):
+        return jsonify({'success': False, 'message': 'Invalid cursor'}), 400
+    
+    flush_activity_log(timeout=1.0)
+    
+    described = ', '.join(f"{key}={value}" for key, value in filters.items() if value) or 'no filters'
+    log_activity(
+        action='ACTIVITY_LOG_EXPORTED',
+        details=f"Exported activity log as {export_format.upper()} ({described})"
+    )
+    
+    filename = f"activity-log-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{export_format}"
+    if export_format == 'csv':
+        body, mimetype = export_activity_csv(filters, cursor), 'text/csv'
+    else:
+        body, mimetype = export_activity_jsonl(filters, cursor), 'application/x-ndjson'
+    
+    return Response(stream_with_context(body),
+                    mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}',
+                             'X-Accel-Buffering': 'no'})
+
+
+@app.route("/manager/metrics/password-hashing")
+@manager_required
+def password_hashing_metrics():
+    """Password hashing pool queue depth, rejections and latency"""
+    return jsonify(get_password_hash_stats())
+
+
+@app.route("/activity-log/stats")
+@manager_required
+def activity_log_stats():
+    """Activity log writer queue depth and counters"""
+    return jsonify(get_activity_writer_stats())
+
+
 @app.route("/activity-log")
 @login_required
 def activity_log():
@@ -863,46 +2894,333 @@ def activity_log():
         return redirect(url_for('index'))
     
     # Get filter parameters
-    filter_action = request.args.get('action', '')
-    filter_user = request.args.get('user', '')
-    search_query = request.args.get('search', '')
+    filters = get_activity_log_filters()
+    cursor = request.args.get('cursor', '')
     
-    conn = get_db_connection()
-    
-    # Build query
-    query = "SELECT * FROM activity_log WHERE 1=1"
-    params = []
-    
-    if filter_action:
-        query += " AND action = ?"
-        params.append(filter_action)
+    # Make sure entries still sitting in the writer queue show up
+    flush_activity_log(timeout=1.0)
     
-    if filter_user:
-        query += " AND user_name = ?"
-        params.append(filter_user)
-    
-    if search_query:
-        query += " AND (product_name LIKE ? OR product_sku LIKE ? OR details LIKE ?)"
-        params.extend([f'%{search_query}%', f'%{search_query}%', f'%{search_query}%'])
-    
-    query += " ORDER BY timestamp DESC LIMIT 200"
-    
-    logs = conn.execute(query, params).fetchall()
+    conn = get_db_connection()
+    logs, next_cursor = fetch_activity_log_page(conn, filters, cursor)
     
-    # Get unique users for filter
+    # Unique users for the filter, from the trigger-maintained list
     all_users = conn.execute("""
-        SELECT DISTINCT user_name FROM activity_log ORDER BY user_name
+        SELECT user_name FROM activity_log_users ORDER BY user_name
     """).fetchall()
     
     conn.close()
     
     return render_template('activity_log.html',
                          logs=logs,
+                         next_cursor=next_cursor,
+                         cursor=cursor,
                          all_users=all_users,
-                         filter_action=filter_action,
-                         filter_user=filter_user,
-                         search_query=search_query,
+                         filter_action=filters['action'],
+                         filter_user=filters['user'],
+                         search_query=filters['search'],
+                         date_from=filters['date_from'],
+                         date_to=filters['date_to'],
                          year=datetime.now().year)
+
+
+# ===========================
+# CART STORE (SERVER-SIDE)
+# ===========================
+# The session only carries a cart id. Cart lines live in the indexed
+# carts/cart_items tables, so every read or write is a primary key lookup
+# and the session cookie stays the same size however big the cart gets.
+
+def get_cart_id(conn, create=False):
+    """Get the current cart id, optionally creating a cart for this session"""
+    cart_id = session.get('cart_id')
+    user_id = session.get('user_id')
+    
+    if not cart_id and user_id:
+        # Logged in without a cart id in the session (e.g. new device) - reuse the user's cart
+        row = conn.execute("SELECT id FROM carts WHERE user_id = ?", (user_id,)).fetchone()
+        if row:
+            cart_id = row['id']
+            session['cart_id'] = cart_id
+    
+    if not cart_id and create:
+        cart_id = secrets.token_urlsafe(16)
+        conn.execute("INSERT INTO carts (id, user_id) VALUES (?, ?)", (cart_id, user_id))
+        session['cart_id'] = cart_id
+    
+    return cart_id
+
+
+def load_cart(conn, cart_id):
+    """Load all cart lines joined with current product data in a single query"""
+    if not cart_id:
+        return {}
+    
+    rows = conn.execute("""
+        SELECT ci.product_id, ci.quantity, ci.price, ci.original_price, ci.discount_percentage,
+               p.sku, p.name, p.image, p.stock
+        FROM cart_items ci
+        JOIN products p ON p.id = ci.product_id
+        WHERE ci.cart_id = ?
+        ORDER BY ci.added_at, ci.product_id
+    """, (cart_id,)).fetchall()
+    
+    return {
+        str(row['product_id']): {
+            'product_id': row['product_id'],
+            'sku': row['sku'],
+            'name': row['name'],
+            'image': row['image'],
+            'stock': row['stock'],
+            'quantity': row['quantity'],
+            'price': row['price'],
+            'original_price': row['original_price'],
+            'discount_percentage': row['discount_percentage']
+        }
+        for row in rows
+    }
+
+
+def get_cart_count(conn, cart_id):
+    """Total quantity of items in the cart"""
+    if not cart_id:
+        return 0
+    row = conn.execute(
+        "SELECT COALESCE(SUM(quantity), 0) AS count FROM cart_items WHERE cart_id = ?",
+        (cart_id,)
+    ).fetchone()
+    return row['count']
+
+
+def discounted_price(price, discount_percentage):
+    """Apply a percentage discount to a price"""
+    if discount_percentage and discount_percentage > 0:
+        return price * (1 - discount_percentage / 100)
+    return price
+
+
+def add_cart_item(conn, cart_id, product, quantity):
+    """Add a product to the cart (or increase its quantity), pricing it with any discount"""
+    original_price = product['price']
+    discount_percentage = product['discount_percentage'] if product['discount_percentage'] else 0
+    final_price = discounted_price(original_price, discount_percentage)
+    
+    conn.execute("""
+        INSERT INTO cart_items (cart_id, product_id, quantity, price, original_price, discount_percentage)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (cart_id, product_id) DO UPDATE SET quantity = quantity + excluded.quantity
+    """, (cart_id, product['id'], quantity, final_price, original_price, discount_percentage))
+    touch_cart(conn, cart_id)
+
+
+def set_cart_item_quantity(conn, cart_id, product_id, quantity):
+    """Set the quantity of a cart line, removing it when quantity drops to zero"""
+    if quantity <= 0:
+        conn.execute("DELETE FROM cart_items WHERE cart_id = ? AND product_id = ?", (cart_id, product_id))
+    else:
+        conn.execute("""
+            UPDATE cart_items SET quantity = ?
+            WHERE cart_id = ? AND product_id = ?
+        """, (quantity, cart_id, product_id))
+    touch_cart(conn, cart_id)
+
+
+def touch_cart(conn, cart_id):
+    """Record that the cart was modified (recreating the cart row if it was rolled back)"""
+    conn.execute("""
+        INSERT INTO carts (id, user_id) VALUES (?, ?)
+        ON CONFLICT (id) DO UPDATE SET version = version + 1, updated_at = CURRENT_TIMESTAMP
+    """, (cart_id, session.get('user_id')))
+    g.cart_state_changed = True
+
+
+def clear_cart(conn, cart_id):
+    """Remove every line from the cart"""
+    if cart_id:
+        conn.execute("DELETE FROM cart_items WHERE cart_id = ?", (cart_id,))
+        touch_cart(conn, cart_id)
+
+
+def revalidate_cart(conn, cart_id):
+    """
+    Re-check every cart line against current price, discount and stock in one query.
+    Lines are repriced, trimmed to available stock or removed as needed.
+    Returns a list of changes describing what was adjusted.
+    """
+    if not cart_id:
+        return []
+    
+    rows = conn.execute("""
+        SELECT ci.product_id, ci.quantity, ci.price, ci.discount_percentage,
+               p.id AS current_id, p.name, p.price AS current_price,
+               p.discount_percentage AS current_discount, p.stock
+        FROM cart_items ci
+        LEFT JOIN products p ON p.id = ci.product_id
+        WHERE ci.cart_id = ?
+    """, (cart_id,)).fetchall()
+    
+    changes = []
+    removals = []
+    updates = []
+    
+    for row in rows:
+        product_id = row['product_id']
+        
+        if row['current_id'] is None or row['stock'] <= 0:
+            removals.append((cart_id, product_id))
+            changes.append({
+                'product_id': product_id,
+                'name': row['name'] or 'An item',
+                'change': 'removed',
+                'reason': 'out of stock' if row['current_id'] else 'no longer available'
+            })
+            continue
+        
+        discount_percentage = row['current_discount'] or 0
+        price = discounted_price(row['current_price'], discount_percentage)
+        quantity = min(row['quantity'], row['stock'])
+        price_changed = round(price, 2) != round(row['price'], 2)
+        
+        if price_changed or quantity != row['quantity'] or discount_percentage != (row['discount_percentage'] or 0):
+            updates.append((quantity, price, row['current_price'], discount_percentage, cart_id, product_id))
+        
+        if price_changed:
+            changes.append({
+                'product_id': product_id,
+                'name': row['name'],
+                'change': 'price',
+                'old_price': round(row['price'], 2),
+                'new_price': round(price, 2)
+            })
+        if quantity != row['quantity']:
+            changes.append({
+                'product_id': product_id,
+                'name': row['name'],
+                'change': 'quantity',
+                'old_quantity': row['quantity'],
+                'new_quantity': quantity
+            })
+    
+    if removals:
+        conn.executemany("DELETE FROM cart_items WHERE cart_id = ? AND product_id = ?", removals)
+    if updates:
+        conn.executemany("""
+            UPDATE cart_items
+            SET quantity = ?, price = ?, original_price = ?, discount_percentage = ?
+            WHERE cart_id = ? AND product_id = ?
+        """, updates)
+    if removals or updates:
+        touch_cart(conn, cart_id)
+    
+    return changes
+
+
+def describe_cart_change(change):
+    """Human readable message for a revalidation change"""
+    if change['change'] == 'removed':
+        return f"{change['name']} was removed from your cart ({change['reason']})."
+    if change['change'] == 'price':
+        return f"The price of {change['name']} changed from ${change['old_price']:.2f} to ${change['new_price']:.2f}."
+    return f"Only {change['new_quantity']} of {change['name']} left in stock - your cart quantity was reduced."
+
+
+def merge_cart_on_login(user_id):
+    """
+    Attach the anonymous session cart to the user, merging it into any cart they already have.
+    The restored cart is revalidated; returns the list of changes made.
+    """
+    conn = get_db_connection()
+    try:
+        anon_cart_id = session.get('cart_id')
+        if anon_cart_id:
+            # Only carts nobody owns can be claimed - a cart left in the session by a
+            # different user who didn't log out stays with them
+            owner = conn.execute("SELECT user_id FROM carts WHERE id = ?", (anon_cart_id,)).fetchone()
+            if owner is None or owner['user_id'] not in (None, user_id):
+                session.pop('cart_id', None)
+                anon_cart_id = None
+        
+        user_cart = conn.execute("SELECT id FROM carts WHERE user_id = ?", (user_id,)).fetchone()
+        
+        if user_cart is None:
+            if anon_cart_id:
+                # First cart for this user - just claim the anonymous one
+                conn.execute("""
+                    UPDATE carts SET user_id = ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                """, (user_id, anon_cart_id))
+        elif anon_cart_id and anon_cart_id != user_cart['id']:
+            # Fold anonymous lines into the saved cart, adding quantities for duplicates
+            conn.execute("""
+                INSERT INTO cart_items (cart_id, product_id, quantity, price, original_price, discount_percentage, added_at)
+                SELECT ?, product_id, quantity, price, original_price, discount_percentage, added_at
+                FROM cart_items WHERE cart_id = ?
+                ON CONFLICT (cart_id, product_id) DO UPDATE SET quantity = quantity + excluded.quantity
+            """, (user_cart['id'], anon_cart_id))
+            conn.execute("DELETE FROM cart_items WHERE cart_id = ?", (anon_cart_id,))
+            conn.execute("DELETE FROM carts WHERE id = ?", (anon_cart_id,))
+            touch_cart(conn, user_cart['id'])
+            session['cart_id'] = user_cart['id']
+        else:
+            session['cart_id'] = user_cart['id']
+        
+        # Saved carts may be days old - bring prices and stock up to date
+        changes = revalidate_cart(conn, session.get('cart_id'))
+        
+        conn.commit()
+        g.cart_state_changed = True  # The session now points at a different cart
+        return changes
+    finally:
+        conn.close()
+
+
+def flash_cart_changes(changes, limit=3):
+    """Flash revalidation changes after login, collapsing long lists"""
+    for change in changes[:limit]:
+        flash(describe_cart_change(change), "info")
+    if len(changes) > limit:
+        flash(f"{len(changes) - limit} more items in your saved cart were updated.", "info")
+
+
+def calculate_cart_totals(subtotal):
+    """Dynamic shipping calculation plus GST for a cart subtotal"""
+    if subtotal >= FREE_SHIPPING_THRESHOLD:
+        shipping = 0  # FREE shipping
+        shipping_message = "FREE Shipping!"
+    elif subtotal == 0:
+        shipping = 0
+        shipping_message = "Add items to calculate shipping"
+    else:
+        # Dynamic shipping based on cart value
+        # Base rate: $15
+        # Reduced as cart value increases
+        # Formula: Base rate - (discount based on how close to threshold)
+        BASE_SHIPPING = 15.00
+        
+        # Calculate how much customer needs to reach free shipping
+        amount_to_free_shipping = FREE_SHIPPING_THRESHOLD - subtotal
+        
+        # Calculate discount based on cart value
+        discount_factor = subtotal / FREE_SHIPPING_THRESHOLD
+        shipping_discount = BASE_SHIPPING * discount_factor * 0.3  # Max 30% discount on shipping
+        
+        shipping = max(BASE_SHIPPING - shipping_discount, 8.00)  # Minimum $8 shipping
+        shipping = round(shipping, 2)
+        shipping_message = f"${amount_to_free_shipping:.2f} away from FREE shipping!"
+    
+    # Calculate GST and total
+    tax_rate = 0.10
+    tax = subtotal * tax_rate
+    total = subtotal + tax + shipping
+    
+    return {
+        'subtotal': subtotal,
+        'tax': tax,
+        'shipping': shipping,
+        'shipping_message': shipping_message,
+        'total': total
+    }
+
+
 # ===========================
 # CART ROUTES (UNIFIED)
 # ===========================
@@ -917,50 +3235,23 @@ def cart_add(product_id):
         # Get product from database
         conn = get_db_connection()
         product = conn.execute("SELECT * FROM products WHERE id = ?", (product_id,)).fetchone()
-        conn.close()
         
         if not product:
+            conn.close()
             return jsonify({'success': False, 'message': 'Product not found'}), 404
         
         # Check stock
         if product['stock'] < quantity:
+            conn.close()
             return jsonify({'success': False, 'message': f'Only {product["stock"]} items available'}), 400
         
-        # Calculate discounted price
-        original_price = product['price']
-        discount_percentage = product['discount_percentage'] if product['discount_percentage'] else 0
-        
-        if discount_percentage > 0:
-            final_price = original_price * (1 - discount_percentage / 100)
-        else:
-            final_price = original_price
-        
-        # Initialize cart if it doesn't exist
-        if 'cart' not in session:
-            session['cart'] = {}
-        
-        # Create cart key
-        cart_key = str(product_id)
-        
-        # Add or update item in cart - NOW WITH NAME AND IMAGE
-        if cart_key in session['cart']:
-            session['cart'][cart_key]['quantity'] += quantity
-        else:
-            session['cart'][cart_key] = {
-                'product_id': product_id,
-                'name': product['name'],              # ADD THIS
-                'image': product['image'],            # ADD THIS
-                'quantity': quantity,
-                'price': final_price,
-                'original_price': original_price,
-                'discount_percentage': discount_percentage
-            }
-        
-        # Mark session as modified
-        session.modified = True
+        cart_id = get_cart_id(conn, create=True)
+        add_cart_item(conn, cart_id, product, quantity)
+        conn.commit()
         
         # Calculate cart count
-        cart_count = sum(item['quantity'] for item in session['cart'].values())
+        cart_count = get_cart_count(conn, cart_id)
+        conn.close()
         
         return jsonify({
             'success': True,
@@ -977,11 +3268,14 @@ def cart_add(product_id):
 def cart_remove(cart_key):
     """Remove item from cart"""
     try:
-        if 'cart' in session and cart_key in session['cart']:
-            del session['cart'][cart_key]
-            session.modified = True
+        conn = get_db_connection()
+        cart_id = get_cart_id(conn)
+        if cart_id and cart_key.isdigit():
+            set_cart_item_quantity(conn, cart_id, int(cart_key), 0)
+            conn.commit()
         
-        cart_count = sum(item['quantity'] for item in session.get('cart', {}).values())
+        cart_count = get_cart_count(conn, cart_id)
+        conn.close()
         
         return jsonify({
             'success': True,
@@ -998,140 +3292,312 @@ def cart_update(product_id):
     try:
         data = request.get_json()
         quantity = data.get('quantity', 1)
-        cart_key = str(product_id)
         
-        if 'cart' in session and cart_key in session['cart']:
-            if quantity <= 0:
-                del session['cart'][cart_key]
-            else:
-                session['cart'][cart_key]['quantity'] = quantity
-            session.modified = True
+        conn = get_db_connection()
+        cart_id = get_cart_id(conn)
+        if cart_id:
+            set_cart_item_quantity(conn, cart_id, product_id, quantity)
+            conn.commit()
+        
+        cart_count = get_cart_count(conn, cart_id)
+        conn.close()
         
-        cart_count = sum(item['quantity'] for item in session.get('cart', {}).values())
+        return jsonify({
+            'success': True,
+            'cart_count': cart_count
+        })
+    except Exception as e:
+        print(f"Error updating cart: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
+@app.route("/cart/count")
+def cart_count_api():
+    """Return the number of items in the cart (used by the mini cart badge)"""
+    conn = get_db_connection()
+    count = get_cart_count(conn, get_cart_id(conn))
+    conn.close()
+    return jsonify({'count': count})
+
+
+@app.route("/cart/revalidate", methods=['POST'])
+def cart_revalidate():
+    """Revalidate the cart against current prices and stock, returning the diff"""
+    try:
+        conn = get_db_connection()
+        cart_id = get_cart_id(conn)
+        changes = revalidate_cart(conn, cart_id)
+        conn.commit()
+        cart_count = get_cart_count(conn, cart_id)
+        conn.close()
         
         return jsonify({
             'success': True,
+            'changes': [dict(change, message=describe_cart_change(change)) for change in changes],
             'cart_count': cart_count
         })
     except Exception as e:
-        print(f"Error updating cart: {e}")
+        print(f"Error revalidating cart: {e}")
         return jsonify({'success': False, 'message': str(e)}), 500
 
 
+def build_mini_cart(conn):
+    """Build the mini cart context (items, total, count) for the current session"""
+    cart = load_cart(conn, get_cart_id(conn))
+    cart_items = {}
+    total = 0
+    
+    for cart_key, item in cart.items():
+        subtotal = item['price'] * item['quantity']
+        cart_items[cart_key] = {
+            'id': item['product_id'],
+            'cart_key': cart_key,
+            'name': item['name'],
+            'price': item['price'],
+            'quantity': item['quantity'],
+            'subtotal': subtotal,
+            'image': item['image']
+        }
+        total += subtotal
+    
+    count = sum(item['quantity'] for item in cart.values())
+    return {'cart': cart_items, 'total': total, 'count': count}
+
+
 @app.route("/cart/mini")
 def cart_mini():
     """Return mini cart HTML fragment"""
-    cart = session.get('cart', {})
-    cart_items = {}
-    total = 0
+    conn = get_db_connection()
+    mini_cart = build_mini_cart(conn)
+    state = load_cart_state(conn, get_cart_id(conn))
+    conn.close()
+    
+    # Re-issue the state cookie and tell cart.js which version this fragment is for,
+    # so a cart changed on another device replaces the cached fragment
+    g.cart_state = state
+    response = app.make_response(render_template('partials/mini_cart.html', **mini_cart))
+    response.headers['X-Cart-State'] = f"{state['version']}.{state['tag']}"
+    return response
+
+
+# ===========================
+# CART STATE COOKIE
+# ===========================
+# A tiny signed "<count>.<version>.<tag>" cookie is rewritten after every cart
+# change. Pages render the badge from it without a database query, and
+# cart.js only fetches /cart/mini when the version differs from its cached copy.
+# The cookie expires after CART_STATE_MAX_AGE, so changes made to the same
+# cart on another device show up within that window.
+
+def cart_state_signer():
+    return Signer(app.secret_key, salt='cart-state')
+
+
+def cart_state_tag(cart_id):
+    """Short fingerprint tying the cookie to the session's cart"""
+    return hashlib.sha256(cart_id.encode()).hexdigest()[:8] if cart_id else '0'
+
+
+def load_cart_state(conn, cart_id):
+    """Read the cart count and version from the database"""
+    if not cart_id:
+        return {'count': 0, 'version': 0, 'tag': cart_state_tag(None)}
+    
+    row = conn.execute("""
+        SELECT c.version, COALESCE(SUM(ci.quantity), 0) AS count
+        FROM carts c
+        LEFT JOIN cart_items ci ON ci.cart_id = c.id
+        WHERE c.id = ?
+    """, (cart_id,)).fetchone()
+    
+    return {
+        'count': row['count'] if row and row['version'] is not None else 0,
+        'version': row['version'] if row and row['version'] is not None else 0,
+        'tag': cart_state_tag(cart_id)
+    }
+
+
+def get_cart_state():
+    """Cart count and version for the badge, read from the signed cookie when it is valid"""
+    cart_id = session.get('cart_id')
+    
+    if not cart_id and 'user_id' not in session:
+        return {'count': 0, 'version': 0, 'tag': cart_state_tag(None)}
     
-    if cart:
+    raw = request.cookies.get(CART_STATE_COOKIE)
+    if raw:
+        try:
+            count, version, tag = cart_state_signer().unsign(raw).decode().split('.')
+            if tag == cart_state_tag(cart_id):
+                return {'count': int(count), 'version': int(version), 'tag': tag}
+        except (BadSignature, ValueError):
+            pass
+    
+    # Missing or stale cookie - rebuild from the database and refresh it on the way out
+    conn = get_db_connection()
+    state = load_cart_state(conn, get_cart_id(conn))
+    conn.close()
+    g.cart_state = state
+    return state
+
+
+@app.after_request
+def refresh_cart_state_cookie(response):
+    """Rewrite the signed cart state cookie after any cart change"""
+    state = g.pop('cart_state', None)
+    
+    if g.pop('cart_state_changed', False):
         conn = get_db_connection()
-        for cart_key, item_data in cart.items():
-            product_id = item_data['product_id']
-            quantity = item_data['quantity']
-            
-            product = conn.execute("SELECT * FROM products WHERE id = ?", (product_id,)).fetchone()
-            if product:
-                # Use stored price from cart (which is already discounted)
-                price = item_data.get('price', product['price'])
-                subtotal = price * quantity
-                
-                cart_items[cart_key] = {
-                    'id': product_id,
-                    'cart_key': cart_key,
-                    'name': product['name'],
-                    'price': price,
-                    'quantity': quantity,
-                    'subtotal': subtotal,
-                    'image': product['image']
-                }
-                total += subtotal
+        state = load_cart_state(conn, session.get('cart_id'))
         conn.close()
     
-    # Render the mini cart partial and return HTML
-    return render_template('partials/mini_cart.html', 
-                         cart=cart_items,
-                         total=total,
-                         count=len(cart))
+    if state is not None:
+        value = f"{state['count']}.{state['version']}.{state['tag']}"
+        response.set_cookie(
+            CART_STATE_COOKIE,
+            cart_state_signer().sign(value).decode(),
+            max_age=CART_STATE_MAX_AGE,
+            samesite='Lax'
+        )
+    
+    return response
 
 
 @app.route("/cart")
 def view_cart():
     """Display shopping cart page"""
-    cart = session.get('cart', {})
+    conn = get_db_connection()
+    cart = load_cart(conn, get_cart_id(conn))
+    conn.close()
+    
     cart_items = []
     subtotal = 0
     
-    if cart:
-        conn = get_db_connection()
-        for cart_key, item_data in cart.items():
-            product_id = item_data['product_id']
-            quantity = item_data['quantity']
-            
-            product = conn.execute("SELECT * FROM products WHERE id = ?", (product_id,)).fetchone()
-            if product:
-                # Use stored price from cart (which is already discounted)
-                price = item_data.get('price', product['price'])
-                item_subtotal = price * quantity
-                
-                cart_items.append({
-                    'product_id': product_id,
-                    'sku': product['sku'],
-                    'name': product['name'],
-                    'price': price,  # Use discounted price
-                    'original_price': item_data.get('original_price', product['price']),
-                    'discount_percentage': item_data.get('discount_percentage', 0),
-                    'quantity': quantity,
-                    'subtotal': item_subtotal,
-                    'image': product['image'],
-                    'stock': product['stock']
-                })
-                subtotal += item_subtotal
-        conn.close()
-    
-    # Dynamic Shipping Calculation Algorithm
-    FREE_SHIPPING_THRESHOLD = 80.00
-    
-    if subtotal >= FREE_SHIPPING_THRESHOLD:
-        shipping = 0  # FREE shipping
-        shipping_message = "FREE Shipping!"
-    elif subtotal == 0:
-        shipping = 0
-        shipping_message = "Add items to calculate shipping"
-    else:
-        # Dynamic shipping based on cart value
-        # Base rate: $15
-        # Reduced as cart value increases
-        # Formula: Base rate - (discount based on how close to threshold)
-        BASE_SHIPPING = 15.00
-        DISCOUNT_RATE = 0.05  # 5% discount per $10 towards threshold
-        
-        # Calculate how much customer needs to reach free shipping
-        amount_to_free_shipping = FREE_SHIPPING_THRESHOLD - subtotal
-        
-        # Calculate discount based on cart value
-        discount_factor = subtotal / FREE_SHIPPING_THRESHOLD
-        shipping_discount = BASE_SHIPPING * discount_factor * 0.3  # Max 30% discount on shipping
+    for item_data in cart.values():
+        # Use stored price from cart (which is already discounted)
+        price = item_data['price']
+        item_subtotal = price * item_data['quantity']
         
-        shipping = max(BASE_SHIPPING - shipping_discount, 8.00)  # Minimum $8 shipping
-        shipping = round(shipping, 2)
-        shipping_message = f"${amount_to_free_shipping:.2f} away from FREE shipping!"
+        cart_items.append({
+            'product_id': item_data['product_id'],
+            'sku': item_data['sku'],
+            'name': item_data['name'],
+            'price': price,  # Use discounted price
+            'original_price': item_data['original_price'],
+            'discount_percentage': item_data['discount_percentage'] or 0,
+            'quantity': item_data['quantity'],
+            'subtotal': item_subtotal,
+            'image': item_data['image'],
+            'stock': item_data['stock']
+        })
+        subtotal += item_subtotal
     
-    # Calculate GST and total
-    tax_rate = 0.10
-    tax = subtotal * tax_rate
-    total = subtotal + tax + shipping
+    totals = calculate_cart_totals(subtotal)
     
     return render_template('cart.html',
                          cart_items=cart_items,
-                         subtotal=subtotal,
-                         tax=tax,
-                         shipping=shipping,
-                         shipping_message=shipping_message,
                          free_shipping_threshold=FREE_SHIPPING_THRESHOLD,
-                         total=total,
-                         year=datetime.now().year)
+                         year=datetime.now().year,
+                         **totals)
+
+
+@app.route("/cart/batch", methods=['POST'])
+def cart_batch():
+    """Apply a list of add/update/remove operations to the cart in one request"""
+    data = request.get_json(silent=True) or {}
+    operations = data.get('operations')
+    
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'success': False, 'message': 'No cart operations provided'}), 400
+    
+    if len(operations) > CART_BATCH_MAX_OPERATIONS:
+        return jsonify({'success': False, 'message': f'At most {CART_BATCH_MAX_OPERATIONS} operations per request'}), 400
+    
+    # Validate every operation before touching the cart
+    parsed = []
+    for operation in operations:
+        try:
+            op = operation.get('op')
+            product_id = int(operation.get('product_id'))
+            quantity = int(operation.get('quantity', 1 if op == 'add' else 0))
+        except (AttributeError, TypeError, ValueError):
+            return jsonify({'success': False, 'message': 'Invalid cart operation'}), 400
+        
+        if op not in ('add', 'update', 'remove') or (op == 'add' and quantity <= 0):
+            return jsonify({'success': False, 'message': 'Invalid cart operation'}), 400
+        
+        parsed.append((op, product_id, quantity))
+    
+    conn = get_db_connection()
+    try:
+        # Fetch every product being added or updated in one query
+        product_ids = sorted({product_id for op, product_id, _ in parsed if op != 'remove'})
+        products = {}
+        if product_ids:
+            placeholders = ','.join('?' * len(product_ids))
+            rows = conn.execute(f"SELECT * FROM products WHERE id IN ({placeholders})", product_ids).fetchall()
+            products = {row['id']: row for row in rows}
+        
+        cart_id = get_cart_id(conn, create=True)
+        
+        # Quantity each product will end up with, starting from what's already in the cart,
+        # so stock is checked against the final result of the whole batch
+        quantities = {
+            row['product_id']: row['quantity']
+            for row in conn.execute("SELECT product_id, quantity FROM cart_items WHERE cart_id = ?", (cart_id,))
+        }
+        
+        # Apply all operations in a single transaction - any failure rolls back the whole batch
+        for op, product_id, quantity in parsed:
+            if op == 'remove':
+                set_cart_item_quantity(conn, cart_id, product_id, 0)
+                quantities[product_id] = 0
+                continue
+            
+            if op == 'update' and not quantities.get(product_id):
+                continue  # Updating a line that isn't in the cart changes nothing
+            
+            new_quantity = quantities.get(product_id, 0) + quantity if op == 'add' else quantity
+            product = products.get(product_id)
+            if new_quantity > 0:
+                if not product:
+                    conn.rollback()
+                    return jsonify({'success': False, 'message': 'Product not found'}), 404
+                if product['stock'] < new_quantity:
+                    conn.rollback()
+                    return jsonify({'success': False, 'message': f'Only {product["stock"]} of {product["name"]} available'}), 400
+            
+            if op == 'add':
+                add_cart_item(conn, cart_id, product, quantity)
+            else:
+                set_cart_item_quantity(conn, cart_id, product_id, quantity)
+            quantities[product_id] = max(new_quantity, 0)
+        
+        conn.commit()
+        
+        mini_cart = build_mini_cart(conn)
+        
+        return jsonify({
+            'success': True,
+            'cart_count': mini_cart['count'],
+            'totals': calculate_cart_totals(mini_cart['total']),
+            'items': [
+                {
+                    'product_id': item['id'],
+                    'quantity': item['quantity'],
+                    'price': item['price'],
+                    'subtotal': item['subtotal']
+                }
+                for item in mini_cart['cart'].values()
+            ],
+            'mini_cart_html': render_template('partials/mini_cart.html', **mini_cart)
+        })
+    except Exception as e:
+        conn.rollback()
+        print(f"Error applying cart batch: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+    finally:
+        conn.close()
 
 
 # Update the checkout route (around line 650)
@@ -1139,40 +3605,35 @@ def view_cart():
 @login_required  # ADD THIS LINE
 def checkout():
     """Display checkout form"""
-    cart = session.get('cart', {})
+    conn = get_db_connection()
+    cart = load_cart(conn, get_cart_id(conn))
+    user = get_customer(session['user_id'], conn) if session.get('user_id') else None
+    conn.close()
     
     if not cart:
         flash("Your cart is empty. Add some products first!", "warning")
         return redirect(url_for('index'))
     
     # Calculate totals
-    conn = get_db_connection()
     cart_items = []
     subtotal = 0
     
-    for cart_key, item_data in cart.items():
-        product_id = item_data['product_id']
-        quantity = item_data['quantity']
+    for item_data in cart.values():
+        # Use stored price from cart (which is already discounted)
+        price = item_data['price']
+        item_subtotal = price * item_data['quantity']
         
-        product = conn.execute("SELECT * FROM products WHERE id = ?", (product_id,)).fetchone()
-        if product:
-            # Use stored price from cart (which is already discounted)
-            price = item_data.get('price', product['price'])
-            item_subtotal = price * quantity
-            
-            cart_items.append({
-                'sku': product['sku'],
-                'name': product['name'],
-                'price': price,  # Use discounted price
-                'original_price': item_data.get('original_price', product['price']),
-                'discount_percentage': item_data.get('discount_percentage', 0),
-                'quantity': quantity,
-                'subtotal': item_subtotal,
-                'image': product['image']
-            })
-            subtotal += item_subtotal
-    
-    conn.close()
+        cart_items.append({
+            'sku': item_data['sku'],
+            'name': item_data['name'],
+            'price': price,  # Use discounted price
+            'original_price': item_data['original_price'],
+            'discount_percentage': item_data['discount_percentage'] or 0,
+            'quantity': item_data['quantity'],
+            'subtotal': item_subtotal,
+            'image': item_data['image']
+        })
+        subtotal += item_subtotal
     
     # Dynamic Shipping Calculation Algorithm
     FREE_SHIPPING_THRESHOLD = 80.00
@@ -1196,20 +3657,16 @@ def checkout():
     
     # Get user info if logged in
     user_info = {}
-    if session.get('user_id'):
-        conn = get_db_connection()
-        user = conn.execute("SELECT * FROM customers WHERE id = ?", (session['user_id'],)).fetchone()
-        conn.close()
-        if user:
-            user_info = {
-                'name': user['name'],
-                'email': user['email'],
-                'phone': user['phone'] if user['phone'] else '',
-                'address': user['address'] if user['address'] else '',
-                'city': user['city'] if user['city'] else '',
-                'state': user['state'] if user['state'] else '',
-                'postcode': user['postcode'] if user['postcode'] else ''
-            }
+    if user:
+        user_info = {
+            'name': user['name'],
+            'email': user['email'],
+            'phone': user['phone'] if user['phone'] else '',
+            'address': user['address'] if user['address'] else '',
+            'city': user['city'] if user['city'] else '',
+            'state': user['state'] if user['state'] else '',
+            'postcode': user['postcode'] if user['postcode'] else ''
+        }
     
     return render_template('checkout.html',
                          cart_items=cart_items,
@@ -1227,9 +3684,12 @@ def checkout():
 @app.route("/place-order", methods=['POST'])
 def place_order():
     """Process the order and save to database"""
-    cart = session.get('cart', {})
+    conn = get_db_connection()
+    cart_id = get_cart_id(conn)
+    cart = load_cart(conn, cart_id)
     
     if not cart:
+        conn.close()
         flash("Your cart is empty!", "danger")
         return redirect(url_for('index'))
     
@@ -1246,39 +3706,34 @@ def place_order():
     # Validate required fields
     if not all([customer_name, customer_email, shipping_address, shipping_city, 
                 shipping_state, shipping_zip, payment_method]):
+        conn.close()
         flash("Please fill in all required fields.", "danger")
         return redirect(url_for('checkout'))
     
-    conn = get_db_connection()
-    
     try:
         # Calculate totals
         subtotal = 0
         order_items = []
         
-        for cart_key, item_data in cart.items():
-            product_id = item_data['product_id']
+        for item_data in cart.values():
             quantity = item_data['quantity']
             
-            product = conn.execute("SELECT * FROM products WHERE id = ?", (product_id,)).fetchone()
-            if product:
-                if product['stock'] < quantity:
-                    flash(f"Sorry, only {product['stock']} units of {product['name']} available.", "danger")
-                    conn.close()
-                    return redirect(url_for('checkout'))
-                
-                # USE THE STORED DISCOUNTED PRICE FROM CART
-                price = item_data.get('price', product['price'])
-                item_subtotal = price * quantity
-                
-                order_items.append({
-                    'sku': product['sku'],
-                    'name': product['name'],
-                    'price': price,  # This is the discounted price
-                    'quantity': quantity,
-                    'subtotal': item_subtotal
-                })
-                subtotal += item_subtotal
+            if item_data['stock'] < quantity:
+                flash(f"Sorry, only {item_data['stock']} units of {item_data['name']} available.", "danger")
+                return redirect(url_for('checkout'))
+            
+            # USE THE STORED DISCOUNTED PRICE FROM CART
+            price = item_data['price']
+            item_subtotal = price * quantity
+            
+            order_items.append({
+                'sku': item_data['sku'],
+                'name': item_data['name'],
+                'price': price,  # This is the discounted price
+                'quantity': quantity,
+                'subtotal': item_subtotal
+            })
+            subtotal += item_subtotal
         
         # Dynamic Shipping Calculation Algorithm
         FREE_SHIPPING_THRESHOLD = 80.00
@@ -1339,11 +3794,12 @@ def place_order():
                 UPDATE products SET stock = stock - ? WHERE sku = ?
             ''', (item['quantity'], item['sku']))
         
-        conn.commit()
+        record_order_sales(conn, order_id)
         
         # Clear cart
-        session['cart'] = {}
-        session.modified = True
+        clear_cart(conn, cart_id)
+        
+        conn.commit()
         
         flash(f"✅ Order placed successfully! Order Number: {order_number}", "success")
         return redirect(url_for('order_confirmation', order_number=order_number))
@@ -1366,18 +3822,20 @@ def order_confirmation(order_number):
         SELECT * FROM orders_new WHERE order_number = ?
     ''', (order_number,)).fetchone()
     
+    if order:
+        # Get order items
+        order_items = conn.execute('''
+            SELECT * FROM order_items_new WHERE order_id = ?
+        ''', (order['id'],)).fetchall()
+    else:
+        order, order_items = find_archived_order(order_number=order_number)
+    
+    conn.close()
+    
     if not order:
         flash("Order not found.", "danger")
-        conn.close()
         return redirect(url_for('index'))
     
-    # Get order items
-    order_items = conn.execute('''
-        SELECT * FROM order_items_new WHERE order_id = ?
-    ''', (order['id'],)).fetchall()
-    
-    conn.close()
-    
     return render_template('order_confirmation.html',
                          order=order,
                          order_items=order_items,
@@ -1388,13 +3846,7 @@ def order_confirmation(order_number):
 @login_required
 def my_orders():
     """Display user's order history"""
-    conn = get_db_connection()
-    orders = conn.execute('''
-        SELECT * FROM orders_new 
-        WHERE user_id = ? 
-        ORDER BY created_at DESC
-    ''', (session['user_id'],)).fetchall()
-    conn.close()
+    orders = get_customer_order_history(session['user_id'])
     
     return render_template('my_orders.html',
                          orders=orders,
@@ -1435,16 +3887,9 @@ def add_product():
         taste_body = int(taste_body) if taste_body and taste_body != '' else None
 
         image = request.files.get('image')
-        image_filename = None
-        if image and image.filename:
-            if allowed_file(image.filename):
-                ext = image.filename.rsplit('.', 1)[1].lower()
-                image_filename = f"{sku}.{ext}"
-                STATIC_IMG_DIR.mkdir(parents=True, exist_ok=True)
-                image.save(STATIC_IMG_DIR / image_filename)
-            else:
-                flash("Invalid image type. Allowed: jpg, png, webp, gif, avif", "danger")
-                return redirect(request.url)
+        if image and image.filename and not allowed_file(image.filename):
+            flash("Invalid image type. Allowed: jpg, png, webp, gif, avif", "danger")
+            return redirect(request.url)
 
         conn = get_db_connection()
         
@@ -1454,6 +3899,8 @@ def add_product():
             conn.close()
             return redirect(url_for('add_product'))
 
+        # Only store the upload once the product is known to be valid
+        image_filename = store_product_image(image) if image and image.filename else None
         try:
             conn.execute("""
                 INSERT INTO products (sku, name, category, subcategory, price, description, stock, image, discount_percentage, 
@@ -1462,6 +3909,8 @@ def add_product():
             """, (sku, name, category, subcategory, price, description, stock, image_filename, discount_percentage,
                   taste_sweetness, taste_aroma, taste_body))
             conn.commit()
+            if image_filename:
+                enqueue_product_image(image_filename)
 
             log_activity(
                 action='PRODUCT_ADDED',
@@ -1475,6 +3924,8 @@ def add_product():
             conn.close()
             return redirect(url_for('edit_product'))
         except sqlite3.Error as e:
+            conn.rollback()
+            release_product_image(conn, image_filename)
             flash(f"❌ Error adding product: {e}", "danger")
             conn.close()
             return redirect(url_for('add_product'))
@@ -1519,18 +3970,12 @@ def edit_product():
         sku_changed = old_sku != new_sku and session.get('user_role') == 'manager'
 
         image = request.files.get('image')
-        image_filename = None
-        if image and image.filename:
-            if allowed_file(image.filename):
-                ext = image.filename.rsplit('.', 1)[1].lower()
-                image_filename = f"{new_sku}.{ext}"
-                STATIC_IMG_DIR.mkdir(parents=True, exist_ok=True)
-                image.save(STATIC_IMG_DIR / image_filename)
-            else:
-                flash("Invalid image type.", "danger")
-                conn.close()
-                return redirect(request.url)
+        if image and image.filename and not allowed_file(image.filename):
+            flash("Invalid image type.", "danger")
+            conn.close()
+            return redirect(request.url)
 
+        image_filename = None
         try:
             if sku_changed:
                 existing = conn.execute("SELECT id FROM products WHERE sku = ?", (new_sku,)).fetchone()
@@ -1539,7 +3984,12 @@ def edit_product():
                     conn.close()
                     return redirect(url_for('edit_product', sku=old_sku, search=search, category=category_filter))
             
+            # Only store the upload once the edit is known to be valid
+            if image and image.filename:
+                image_filename = store_product_image(image)
+            
             if image_filename:
+                old_image = conn.execute("SELECT image FROM products WHERE sku = ?", (old_sku,)).fetchone()
                 conn.execute("""
                     UPDATE products
                     SET sku = ?, name = ?, category = ?, subcategory = ?, price = ?, description = ?, stock = ?, image = ?, discount_percentage = ?,
@@ -1556,6 +4006,11 @@ def edit_product():
                 """, (new_sku, name, category, subcategory, price, description, stock, discount_percentage,
                       taste_sweetness, taste_aroma, taste_body, old_sku))
             conn.commit()
+            
+            if image_filename:
+                enqueue_product_image(image_filename)
+            if image_filename and old_image and old_image['image'] != image_filename:
+                release_product_image(conn, old_image['image'])
 
             log_activity(
                 action='PRODUCT_EDITED',
@@ -1570,6 +4025,8 @@ def edit_product():
             # Redirect WITH search parameters preserved
             return redirect(url_for('edit_product', sku=new_sku, search=search, category=category_filter))
         except sqlite3.Error as e:
+            conn.rollback()
+            release_product_image(conn, image_filename)
             flash(f"❌ Error updating product: {e}", "danger")
             conn.close()
             return redirect(url_for('edit_product', sku=old_sku, search=search, category=category_filter))
@@ -1595,13 +4052,28 @@ def edit_product():
         product = conn.execute('SELECT * FROM products WHERE sku = ?', (sku,)).fetchone()
     
     conn.close()
+    image_job = get_image_job(product['image']) if product else None
     return render_template('edit_product.html', 
                          product=product, 
+                         image_job=image_job, 
                          products=products,
                          search=search,
                          category_filter=category_filter,
                          year=datetime.now().year)
 
+@app.route("/admin/product/image-job/<sku>/retry", methods=['POST'])
+@admin_required
+def retry_image_job(sku):
+    """Queue a product image for processing again after its job failed"""
+    conn = get_db_connection()
+    product = conn.execute("SELECT image FROM products WHERE sku = ?", (sku,)).fetchone()
+    conn.close()
+    
+    if product and product['image']:
+        enqueue_image_job(product['image'])
+        flash("Image processing queued again.", "info")
+    return redirect(url_for('edit_product', sku=sku))
+
 @app.route("/admin/product/delete/<sku>", methods=['POST'])
 @admin_required
 def delete_product(sku):
@@ -1624,13 +4096,7 @@ def delete_product(sku):
             details=f"Deleted {product['name']} ({product['sku']}) - Category: {product['category']}, Stock: {product['stock']}"
         )
 
-        if product['image']:
-            image_path = STATIC_IMG_DIR / product['image']
-            if image_path.exists():
-                try:
-                    image_path.unlink()
-                except Exception as e:
-                    print(f"Could not delete image file: {e}")
+        release_product_image(conn, product['image'])
         
         flash(f"✅ Product '{product['name']}' has been deleted.", "success")
     except Exception as e:
@@ -1645,22 +4111,331 @@ def delete_product(sku):
 # ADMIN ROUTES - ORDERS
 # ===========================
 
+ORDER_STATUSES = ['pending', 'processing', 'shipped', 'delivered', 'cancelled']
+
+# Statuses an order may move to from its current status (used by bulk updates)
+ORDER_STATUS_TRANSITIONS = {
+    'pending': ['processing', 'shipped', 'cancelled'],
+    'processing': ['shipped', 'cancelled'],
+    'shipped': ['delivered'],
+    'delivered': [],
+    'cancelled': []
+}
+
+
+def parse_date(value):
+    """Return a YYYY-MM-DD string if value is a valid date, otherwise empty string"""
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+    except (TypeError, ValueError):
+        return ''
+
+
+def get_admin_order_filters():
+    """Read the admin order list filters from the query string"""
+    status = request.args.get('status', '').strip().lower()
+    return {
+        'status': status if status in ORDER_STATUSES else '',
+        'email': request.args.get('email', '').strip(),
+        'date_from': parse_date(request.args.get('date_from', '').strip()),
+        'date_to': parse_date(request.args.get('date_to', '').strip())
+    }
+
+
+def order_filter_clause(filters, prefix=''):
+    """SQL conditions (each starting with AND) and params for the admin order filters"""
+    clause = ''
+    params = []
+    
+    if filters['status']:
+        clause += f" AND {prefix}status = ?"
+        params.append(filters['status'])
+    
+    if filters['email']:
+        clause += f" AND {prefix}customer_email = ? COLLATE NOCASE"
+        params.append(filters['email'])
+    
+    if filters['date_from']:
+        clause += f" AND {prefix}created_at >= ?"
+        params.append(filters['date_from'])
+    
+    if filters['date_to']:
+        clause += f" AND {prefix}created_at < date(?, '+1 day')"
+        params.append(filters['date_to'])
+    
+    return clause, params
+
+
+def parse_keyset_cursor(cursor):
+    """Split a "<timestamp>|<id>" keyset cursor into (timestamp, id), or None if invalid"""
+    try:
+        timestamp, row_id = cursor.rsplit('|', 1)
+        return timestamp, int(row_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def fetch_admin_orders_page(conn, filters, cursor=''):
+    """
+    One page of orders, newest first, using keyset pagination.
+    The cursor is "<created_at>|<id>" of the last order on the previous page,
+    so every page is an index range seek no matter how deep it is.
+    Returns (orders, next_cursor).
+    """
+    clause, params = order_filter_clause(filters)
+    query = "SELECT * FROM orders_new WHERE 1=1" + clause
+    
+    position = parse_keyset_cursor(cursor)
+    if position:
+        query += " AND (created_at, id) < (?, ?)"
+        params.extend(position)
+    
+    query += " ORDER BY created_at DESC, id DESC LIMIT ?"
+    params.append(ADMIN_ORDERS_PAGE_SIZE + 1)  # One extra row tells us if there is another page
+    
+    orders = conn.execute(query, params).fetchall()
+    
+    next_cursor = None
+    if len(orders) > ADMIN_ORDERS_PAGE_SIZE:
+        orders = orders[:ADMIN_ORDERS_PAGE_SIZE]
+        last = orders[-1]
+        next_cursor = f"{last['created_at']}|{last['id']}"
+    
+    return orders, next_cursor
+
+
+def get_order_status_counts(conn):
+    """
+    Per-status order counts from the trigger-maintained summary table.
+    These cover live orders only - archiving deletes from orders_new, which
+    the delete trigger counts down, so the tabs match the lists they open.
+    """
+    counts = {status: 0 for status in ORDER_STATUSES}
+    for row in conn.execute("SELECT status, count FROM order_status_counts"):
+        counts[row['status']] = row['count']
+    return counts
+
+
 @app.route("/admin/orders")
 @admin_required
 def admin_orders():
-    """Display all orders for admin/manager"""
+    """Display orders for admin/manager, one page at a time"""
+    filters = get_admin_order_filters()
+    cursor = request.args.get('cursor', '')
+    
     conn = get_db_connection()
-    orders = conn.execute('''
-        SELECT * FROM orders_new 
-        ORDER BY created_at DESC
-    ''').fetchall()
+    orders, next_cursor = fetch_admin_orders_page(conn, filters, cursor)
+    status_counts = get_order_status_counts(conn)
     conn.close()
     
+    # A customer lookup should also find their archived orders
+    archived_orders = []
+    if filters['email'] and not cursor:
+        archived_orders = get_archived_order_summaries(email=filters['email'], limit=ADMIN_ORDERS_PAGE_SIZE)
+    
     return render_template('admin_orders.html',
                          orders=orders,
+                         archived_orders=archived_orders,
+                         next_cursor=next_cursor,
+                         filters=filters,
+                         status_counts=status_counts,
+                         total_orders=sum(status_counts.values()),
+                         archived_count=get_archived_order_count(),
                          year=datetime.now().year)
 
 
+@app.route("/admin/orders/data")
+@admin_required
+def admin_orders_data():
+    """JSON page of orders for infinite scroll"""
+    filters = get_admin_order_filters()
+    cursor = request.args.get('cursor', '')
+    
+    conn = get_db_connection()
+    orders, next_cursor = fetch_admin_orders_page(conn, filters, cursor)
+    conn.close()
+    
+    return jsonify({
+        'orders': [
+            {
+                'id': order['id'],
+                'order_number': order['order_number'],
+                'customer_name': order['customer_name'],
+                'customer_email': order['customer_email'],
+                'created_at': order['created_at'],
+                'total': order['total'],
+                'status': order['status'],
+                'url': url_for('admin_order_detail', order_id=order['id'])
+            }
+            for order in orders
+        ],
+        'next_cursor': next_cursor
+    })
+
+
+ORDER_EXPORT_COLUMNS = [
+    'order_number', 'created_at', 'status', 'customer_name', 'customer_email', 'customer_phone',
+    'shipping_address', 'shipping_city', 'shipping_state', 'shipping_zip', 'payment_method',
+    'subtotal', 'tax', 'shipping_cost', 'total'
+]
+ORDER_ITEM_EXPORT_COLUMNS = ['product_sku', 'product_name', 'quantity', 'price', 'subtotal']
+
+
+def fetch_order_export_batch(clause, filter_params, position):
+    """One keyset batch of live orders after position, with their items"""
+    query = "SELECT * FROM orders_new WHERE 1=1" + clause
+    params = list(filter_params)
+    if position:
+        query += " AND (created_at, id) > (?, ?)"
+        params.extend(position)
+    query += " ORDER BY created_at, id LIMIT ?"
+    params.append(EXPORT_BATCH_SIZE)
+    
+    conn = get_db_connection()
+    orders = conn.execute(query, params).fetchall()
+    items_by_order = {}
+    if orders:
+        order_ids = [order['id'] for order in orders]
+        placeholders = ','.join('?' * len(order_ids))
+        for item in conn.execute(f"""
+            SELECT * FROM order_items_new WHERE order_id IN ({placeholders}) ORDER BY order_id, id
+        """, order_ids):
+            items_by_order.setdefault(item['order_id'], []).append(item)
+    conn.close()
+    return orders, items_by_order
+
+
+def fetch_archived_export_batch(clause, filter_params, position):
+    """One keyset batch of archived orders after position, decoded from their payloads"""
+    query = "SELECT payload FROM archived_orders WHERE 1=1" + clause
+    params = list(filter_params)
+    if position:
+        query += " AND (created_at, id) > (?, ?)"
+        params.extend(position)
+    query += " ORDER BY created_at, id LIMIT ?"
+    params.append(EXPORT_BATCH_SIZE)
+    
+    archive = get_archive_connection()
+    if archive is None:
+        return [], {}
+    rows = archive.execute(query, params).fetchall()
+    archive.close()
+    
+    orders = []
+    items_by_order = {}
+    for row in rows:
+        order, items = unpack_archived_order(row)
+        orders.append(order)
+        items_by_order[order['id']] = items
+    return orders, items_by_order
+
+
+def iter_export_source(fetch_batch, clause, filter_params, position):
+    """Yield (order, items) from one order table, a short keyset query per batch"""
+    while True:
+        orders, items_by_order = fetch_batch(clause, filter_params, position)
+        for order in orders:
+            yield order, items_by_order.get(order['id'], [])
+        if len(orders) < EXPORT_BATCH_SIZE:
+            return
+        position = (orders[-1]['created_at'], orders[-1]['id'])
+
+
+def iter_order_export_batches(filters, cursor=None, include_archived=False):
+    """
+    Yield (orders, items_by_order) in batches of EXPORT_BATCH_SIZE orders, oldest first.
+    Each batch is its own short keyset query, so the database isn't held open
+    (and writers aren't blocked) while a slow client downloads the export.
+    With include_archived, archive.db is read the same way and merged in by
+    (created_at, id), so one cursor resumes both.
+    """
+    clause, filter_params = order_filter_clause(filters)
+    sources = [iter_export_source(fetch_order_export_batch, clause, filter_params, cursor)]
+    if include_archived and os.path.exists(ARCHIVE_DB_PATH):
+        sources.append(iter_export_source(fetch_archived_export_batch, clause, filter_params, cursor))
+    
+    merged = heapq.merge(*sources, key=lambda pair: (pair[0]['created_at'], pair[0]['id']))
+    while True:
+        batch = list(itertools.islice(merged, EXPORT_BATCH_SIZE))
+        if not batch:
+            return
+        yield [order for order, _ in batch], {order['id']: items for order, items in batch}
+
+
+def export_orders_csv(filters, cursor, include_archived=False):
+    """CSV export, one row per order item (orders without items get one row)"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    
+    writer.writerow(ORDER_EXPORT_COLUMNS + ['item_' + column for column in ORDER_ITEM_EXPORT_COLUMNS] + ['cursor'])
+    yield buffer.getvalue()
+    
+    for orders, items_by_order in iter_order_export_batches(filters, cursor, include_archived):
+        buffer.seek(0)
+        buffer.truncate()
+        for order in orders:
+            order_values = [order[column] for column in ORDER_EXPORT_COLUMNS]
+            order_cursor = f"{order['created_at']}|{order['id']}"
+            for item in items_by_order.get(order['id']) or [None]:
+                item_values = [item[column] if item else '' for column in ORDER_ITEM_EXPORT_COLUMNS]
+                writer.writerow(order_values + item_values + [order_cursor])
+        yield buffer.getvalue()
+
+
+def export_orders_jsonl(filters, cursor, include_archived=False):
+    """JSONL export, one line per order with its items nested"""
+    for orders, items_by_order in iter_order_export_batches(filters, cursor, include_archived):
+        lines = []
+        for order in orders:
+            record = {column: order[column] for column in ORDER_EXPORT_COLUMNS}
+            record['items'] = [
+                {column: item[column] for column in ORDER_ITEM_EXPORT_COLUMNS}
+                for item in items_by_order.get(order['id'], [])
+            ]
+            record['cursor'] = f"{order['created_at']}|{order['id']}"
+            lines.append(json.dumps(record))
+        yield '\n'.join(lines) + '\n'
+
+
+@app.route("/admin/orders/export")
+@admin_required
+def export_orders():
+    """
+    Stream orders with their items as CSV (default) or JSONL.
+    Takes the same filters as the orders page. Every row carries a cursor;
+    pass the last complete order's cursor back as ?cursor= to resume.
+    Archived orders are only included with ?include_archived=1.
+    """
+    export_format = request.args.get('format', 'csv').lower()
+    if export_format not in ('csv', 'jsonl'):
+        return jsonify({'success': False, 'message': 'Format must be csv or jsonl'}), 400
+    
+    filters = get_admin_order_filters()
+    cursor = request.args.get('cursor', '')
+    position = parse_keyset_cursor(cursor)
+    if cursor and not position:
+        return jsonify({'success': False, 'message': 'Invalid cursor'}), 400
+    include_archived = request.args.get('include_archived') == '1'
+    
+    log_activity(
+        action='ORDERS_EXPORTED',
+        details=f"Exported orders as {export_format.upper()}"
+                f" (from {filters['date_from'] or 'start'} to {filters['date_to'] or 'now'})"
+                f"{', including archived' if include_archived else ''}"
+    )
+    
+    filename = f"orders-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{export_format}"
+    if export_format == 'csv':
+        body, mimetype = export_orders_csv(filters, position, include_archived), 'text/csv'
+    else:
+        body, mimetype = export_orders_jsonl(filters, position, include_archived), 'application/x-ndjson'
+    
+    return Response(stream_with_context(body),
+                    mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}',
+                             'X-Accel-Buffering': 'no'})
+
+
 @app.route("/admin/order/<int:order_id>")
 @admin_required
 def admin_order_detail(order_id):
@@ -1671,17 +4446,19 @@ def admin_order_detail(order_id):
         SELECT * FROM orders_new WHERE id = ?
     ''', (order_id,)).fetchone()
     
+    if order:
+        order_items = conn.execute('''
+            SELECT * FROM order_items_new WHERE order_id = ?
+        ''', (order_id,)).fetchall()
+    else:
+        order, order_items = find_archived_order(order_id=order_id)
+    
+    conn.close()
+    
     if not order:
         flash("Order not found.", "danger")
-        conn.close()
         return redirect(url_for('admin_orders'))
     
-    order_items = conn.execute('''
-        SELECT * FROM order_items_new WHERE order_id = ?
-    ''', (order_id,)).fetchall()
-    
-    conn.close()
-    
     return render_template('admin_order_detail.html',
                          order=order,
                          order_items=order_items,
@@ -1694,16 +4471,23 @@ def update_order_status(order_id):
     """Update order status"""
     new_status = request.form.get('status')
     
-    if new_status not in ['pending', 'processing', 'shipped', 'delivered', 'cancelled']:
+    if new_status not in ORDER_STATUSES:
         flash("Invalid status.", "danger")
         return redirect(url_for('admin_order_detail', order_id=order_id))
     
-    conn = get_db_connection()
+    conn = get_db_connection()
+    order = conn.execute('SELECT status FROM orders_new WHERE id = ?', (order_id,)).fetchone()
+    if not order:
+        conn.close()
+        flash("Order not found.", "danger")
+        return redirect(url_for('admin_orders'))
+    
     conn.execute('''
         UPDATE orders_new 
         SET status = ?, updated_at = CURRENT_TIMESTAMP 
         WHERE id = ?
     ''', (new_status, order_id))
+    apply_status_change_to_sales(conn, order_id, order['status'], new_status)
     conn.commit()
     conn.close()
     
@@ -1711,6 +4495,125 @@ def update_order_status(order_id):
     return redirect(url_for('admin_order_detail', order_id=order_id))
 
 
+@app.route("/admin/orders/bulk-status", methods=['POST'])
+@admin_required
+def bulk_update_order_status():
+    """
+    Move many orders to a new status in one transaction.
+    Accepts JSON {"orders": [ids or order numbers], "status": "..."} or a form
+    post with order_ids + status. Orders whose current status can't move to
+    the target are skipped and reported back.
+    """
+    wants_json = request.is_json
+    if wants_json:
+        data = request.get_json(silent=True) or {}
+        refs = data.get('orders') or []
+        new_status = str(data.get('status', '')).strip().lower()
+    else:
+        refs = request.form.getlist('order_ids')
+        new_status = request.form.get('status', '').strip().lower()
+    
+    def respond(success, message, status_code=200, **extra):
+        if wants_json:
+            return jsonify({'success': success, 'message': message, **extra}), status_code
+        flash(message, 'success' if success else 'danger')
+        return redirect(request.referrer or url_for('admin_orders'))
+    
+    if new_status not in ORDER_STATUSES:
+        return respond(False, 'Invalid status.', 400)
+    
+    if not isinstance(refs, list) or not refs:
+        return respond(False, 'No orders selected.', 400)
+    
+    if len(refs) > BULK_STATUS_MAX_ORDERS:
+        return respond(False, f'Too many orders (max {BULK_STATUS_MAX_ORDERS} per update).', 400)
+    
+    # Orders can be referenced by id or by order number
+    order_ids = set()
+    order_numbers = set()
+    for ref in refs:
+        ref = str(ref).strip()
+        if ref.isdigit():
+            order_ids.add(int(ref))
+        elif ref:
+            order_numbers.add(ref)
+    
+    conn = get_db_connection()
+    try:
+        # Take the write lock before reading statuses, so they can't change under us
+        conn.execute('BEGIN IMMEDIATE')
+        orders = []
+        if order_ids:
+            placeholders = ','.join('?' * len(order_ids))
+            orders += conn.execute(f"""
+                SELECT id, order_number, status FROM orders_new WHERE id IN ({placeholders})
+            """, list(order_ids)).fetchall()
+        if order_numbers:
+            placeholders = ','.join('?' * len(order_numbers))
+            orders += conn.execute(f"""
+                SELECT id, order_number, status FROM orders_new WHERE order_number IN ({placeholders})
+            """, list(order_numbers)).fetchall()
+        
+        found = {order['id']: order for order in orders}
+        matched = {str(order_id) for order_id in found} | {order['order_number'] for order in found.values()}
+        not_found = [str(ref).strip() for ref in refs if str(ref).strip() not in matched]
+        
+        to_update = []
+        skipped = []
+        for order in found.values():
+            if new_status in ORDER_STATUS_TRANSITIONS.get(order['status'], []):
+                to_update.append(order)
+            elif order['status'] != new_status:
+                skipped.append({'order_number': order['order_number'], 'status': order['status']})
+        
+        # The status guard keeps a concurrent change from being overwritten
+        conn.executemany("""
+            UPDATE orders_new
+            SET status = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = ?
+        """, [(new_status, order['id'], order['status']) for order in to_update])
+        
+        # Only orders the UPDATE actually changed get sales adjustments and a log entry
+        changed = []
+        if to_update:
+            placeholders = ','.join('?' * len(to_update))
+            now_updated = {row['id'] for row in conn.execute(f"""
+                SELECT id FROM orders_new WHERE id IN ({placeholders}) AND status = ?
+            """, [order['id'] for order in to_update] + [new_status])}
+            changed = [order for order in to_update if order['id'] in now_updated]
+        for order in changed:
+            apply_status_change_to_sales(conn, order['id'], order['status'], new_status)
+        updated = len(changed)
+        
+        if updated:
+            numbers = ', '.join(sorted(order['order_number'] for order in changed))
+            log_activity(
+                action='ORDERS_STATUS_UPDATED',
+                product_name=f"{updated} order{'s' if updated != 1 else ''} → {new_status}",
+                details=f"Marked {updated} order(s) as '{new_status}': {numbers}",
+                conn=conn
+            )
+        
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        print(f"❌ Bulk status update failed: {e}")
+        return respond(False, 'Could not update orders. No changes were made.', 500)
+    finally:
+        conn.close()
+    
+    message = f"✅ {updated} order{'s' if updated != 1 else ''} updated to '{new_status}'"
+    if skipped:
+        message += f" ({len(skipped)} skipped - status can't change to '{new_status}')"
+    if not_found:
+        message += f" ({len(not_found)} not found)"
+    
+    return respond(True, message,
+                   updated=updated,
+                   skipped=skipped,
+                   not_found=not_found)
+
+
 # ===========================
 # MANAGER ROUTES - Staff
 # ===========================
@@ -1809,8 +4712,11 @@ def edit_staff(staff_id):
                 """, (name, phone, role, staff_id))
             
             conn.commit()
+            invalidate_customer(staff_id)
             flash('Staff member updated successfully!', 'success')
             return redirect(url_for('manage_staff'))
+        except HTTPException:
+            raise  # e.g. 503 from the password hashing pool
         except Exception as e:
             flash(f'Error updating staff: {e}', 'danger')
         finally:
@@ -1838,6 +4744,7 @@ def delete_staff(staff_id):
     try:
         conn.execute("DELETE FROM customers WHERE id = ? AND role IN ('admin', 'manager')", (staff_id,))
         conn.commit()
+        invalidate_customer(staff_id)
         flash('Staff member removed successfully.', 'success')
     except Exception as e:
         flash(f'Error removing staff: {e}', 'danger')
@@ -1848,13 +4755,24 @@ def delete_staff(staff_id):
 
 
 # ===========================
-# DATABASE INITIALIZATION
+# DATABASE MIGRATIONS
 # ===========================
-
-def init_db():
-    """Initialize the database with required tables"""
-    conn = get_db_connection()
-    
+# Every schema change is a numbered migration, applied in order and recorded
+# in the schema_version table. Run pending migrations once per deploy with
+#     flask --app app migrate
+# Startup only compares the recorded version with the latest one, and no
+# request handler ever issues DDL. To change the schema, append a new
+# migration to MIGRATIONS - never edit one that has already shipped.
+
+def add_column_if_missing(conn, table, column, definition):
+    """Add a column unless it already exists (older databases were migrated by hand)"""
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def migrate_core_tables(conn):
+    """Products and customers tables (was init_db / db_setups/setup_db.py)"""
     conn.execute('''
         CREATE TABLE IF NOT EXISTS products (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -1888,71 +4806,74 @@ def init_db():
         )
     ''')
     
-    conn.commit()
-    conn.close()
-    print("✅ Database initialized")
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_products_category ON products(category)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_products_brand ON products(brand)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_products_subcategory ON products(subcategory)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_customers_email ON customers(email)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_customers_role ON customers(role)')
 
 
-def init_orders_db():
-    """Initialize orders and order_items tables"""
-    conn = get_db_connection()
-    
-    cursor = conn.execute("""
-        SELECT name FROM sqlite_master 
-        WHERE type='table' AND name='orders_new'
-    """)
-    
-    if cursor.fetchone() is None:
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS orders_new (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                order_number TEXT UNIQUE NOT NULL,
-                user_id INTEGER,
-                customer_name TEXT NOT NULL,
-                customer_email TEXT NOT NULL,
-                customer_phone TEXT,
-                shipping_address TEXT NOT NULL,
-                shipping_city TEXT NOT NULL,
-                shipping_state TEXT NOT NULL,
-                shipping_zip TEXT NOT NULL,
-                payment_method TEXT NOT NULL,
-                subtotal REAL NOT NULL,
-                tax REAL NOT NULL,
-                shipping_cost REAL NOT NULL,
-                total REAL NOT NULL,
-                status TEXT DEFAULT 'pending',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES customers(id)
-            )
-        ''')
-        
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS order_items_new (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                order_id INTEGER NOT NULL,
-                product_sku TEXT NOT NULL,
-                product_name TEXT NOT NULL,
-                quantity INTEGER NOT NULL,
-                price REAL NOT NULL,
-                subtotal REAL NOT NULL,
-                FOREIGN KEY (order_id) REFERENCES orders_new(id)
-            )
-        ''')
-        
-        conn.commit()
-        print("✅ New orders tables created")
-    
-    conn.close()
-    
-def init_reports_db():
-    """Initialize bug reports and missing products tables"""
-    conn = get_db_connection()
-    
-    # Drop old missing_products table if it exists (to add new columns)
-    conn.execute('DROP TABLE IF EXISTS missing_products')
+def migrate_order_tables(conn):
+    """Orders and order items tables (was init_orders_db)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS orders_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_number TEXT UNIQUE NOT NULL,
+            user_id INTEGER,
+            customer_name TEXT NOT NULL,
+            customer_email TEXT NOT NULL,
+            customer_phone TEXT,
+            shipping_address TEXT NOT NULL,
+            shipping_city TEXT NOT NULL,
+            shipping_state TEXT NOT NULL,
+            shipping_zip TEXT NOT NULL,
+            payment_method TEXT NOT NULL,
+            subtotal REAL NOT NULL,
+            tax REAL NOT NULL,
+            shipping_cost REAL NOT NULL,
+            total REAL NOT NULL,
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES customers(id)
+        )
+    ''')
     
-    # Create bug_reports table
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS order_items_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            product_sku TEXT NOT NULL,
+            product_name TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            price REAL NOT NULL,
+            subtotal REAL NOT NULL,
+            FOREIGN KEY (order_id) REFERENCES orders_new(id)
+        )
+    ''')
+
+
+def migrate_activity_log(conn):
+    """Admin/manager activity log (was db_setups/migrate_activity_log.py)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS activity_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            user_name TEXT NOT NULL,
+            user_role TEXT NOT NULL,
+            action TEXT NOT NULL,
+            product_id INTEGER,
+            product_sku TEXT,
+            product_name TEXT,
+            details TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES customers (id)
+        )
+    ''')
+
+
+def migrate_report_tables(conn):
+    """Bug reports and missing product requests (was init_reports_db and the report/request routes)"""
     conn.execute('''
         CREATE TABLE IF NOT EXISTS bug_reports (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -1969,7 +4890,6 @@ def init_reports_db():
         )
     ''')
     
-    # Create missing_products table with all columns
     conn.execute('''
         CREATE TABLE IF NOT EXISTS missing_products (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -1985,32 +4905,567 @@ def init_reports_db():
             FOREIGN KEY (user_id) REFERENCES customers (id)
         )
     ''')
+
+
+def migrate_product_discount(conn):
+    """Discount column on products (was add_discount_column)"""
+    add_column_if_missing(conn, 'products', 'discount_percentage', 'INTEGER DEFAULT 0')
+
+
+def migrate_taste_profile(conn):
+    """Taste profile columns for beans (was db_setups/migrate_taste_profile.py)"""
+    add_column_if_missing(conn, 'products', 'taste_sweetness', 'INTEGER DEFAULT NULL')
+    add_column_if_missing(conn, 'products', 'taste_aroma', 'INTEGER DEFAULT NULL')
+    add_column_if_missing(conn, 'products', 'taste_body', 'INTEGER DEFAULT NULL')
+
+
+def migrate_security_questions(conn):
+    """Security question columns on customers (was db_setups/migrate_security_questions.py)"""
+    add_column_if_missing(conn, 'customers', 'security_question', 'TEXT')
+    add_column_if_missing(conn, 'customers', 'security_answer', 'TEXT')
+
+
+def migrate_product_subcategories(conn):
+    """Default subcategories for uncategorised beans and accessories
+    (was add_beans_subcategories / db_setups/update_accessories_subcategory.py)"""
+    conn.execute('''
+        UPDATE products 
+        SET subcategory = 'coffee-beans' 
+        WHERE category = 'beans' AND (subcategory IS NULL OR subcategory = '')
+    ''')
     
-    conn.commit()
-    conn.close()
-    print("✅ Reports tables initialized")
+    # Only fill in blanks - never overwrite subcategories set through the admin panel
+    conn.execute("""
+        UPDATE products 
+        SET subcategory = 'grinders' 
+        WHERE category = 'accessories' AND (subcategory IS NULL OR subcategory = '') AND (
+            name LIKE '%grinder%' OR 
+            name LIKE '%burr%' OR
+            name LIKE '%mill%'
+        )
+    """)
+    conn.execute("""
+        UPDATE products 
+        SET subcategory = 'brewing-equipment' 
+        WHERE category = 'accessories' AND (subcategory IS NULL OR subcategory = '') AND (
+            name LIKE '%tamper%' OR 
+            name LIKE '%pitcher%' OR 
+            name LIKE '%scale%' OR 
+            name LIKE '%cup%' OR
+            name LIKE '%mug%' OR
+            name LIKE '%jug%' OR
+            name LIKE '%knock%' OR
+            name LIKE '%cloth%'
+        )
+    """)
+
+
+def migrate_cart_tables(conn):
+    """Server-side cart tables (was init_cart_db)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS carts (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            version INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES customers (id)
+        )
+    ''')
+    
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS cart_items (
+            cart_id TEXT NOT NULL,
+            product_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            price REAL NOT NULL,
+            original_price REAL NOT NULL,
+            discount_percentage INTEGER DEFAULT 0,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (cart_id, product_id),
+            FOREIGN KEY (cart_id) REFERENCES carts (id),
+            FOREIGN KEY (product_id) REFERENCES products (id)
+        )
+    ''')
+    
+    # One saved cart per user
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_carts_user ON carts(user_id)')
+
+
+def migrate_hot_path_indexes(conn):
+    """Indexes for the queries on the pages in HOT_PATHS"""
+    # Customer order history: WHERE user_id = ? ORDER BY created_at DESC
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_orders_new_user_created ON orders_new(user_id, created_at DESC)')
+    # Admin order list: ORDER BY created_at DESC
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_orders_new_created ON orders_new(created_at DESC)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_order_items_new_order ON order_items_new(order_id)')
+    
+    # Activity log: newest first, optionally filtered by action or user
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_activity_log_timestamp ON activity_log(timestamp DESC)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_activity_log_action ON activity_log(action, timestamp DESC)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_activity_log_user ON activity_log(user_name, timestamp DESC)')
+    
+    # Reports dashboard - the expression must match the ORDER BY in reports() exactly
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_bug_reports_priority ON bug_reports(
+            (CASE severity WHEN 'high' THEN 1 WHEN 'medium' THEN 2 WHEN 'low' THEN 3 END),
+            created_at DESC
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_missing_products_created ON missing_products(created_at DESC)')
+    
+    # Catalog pages: WHERE category = ? [AND subcategory = ?] ORDER BY [subcategory,] name
+    # (replaces idx_products_category, which is a prefix of this one)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_products_category_subcategory ON products(category, subcategory, name)')
+    conn.execute('DROP INDEX IF EXISTS idx_products_category')
+
+
+def migrate_order_status_counts(conn):
+    """Per-status order counts kept up to date by triggers, plus keyset pagination indexes"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS order_status_counts (
+            status TEXT PRIMARY KEY,
+            count INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    
+    conn.execute('DELETE FROM order_status_counts')
+    conn.execute('''
+        INSERT INTO order_status_counts (status, count)
+        SELECT status, COUNT(*) FROM orders_new GROUP BY status
+    ''')
+    
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_orders_new_count_insert
+        AFTER INSERT ON orders_new
+        BEGIN
+            INSERT INTO order_status_counts (status, count) VALUES (NEW.status, 1)
+            ON CONFLICT (status) DO UPDATE SET count = count + 1;
+        END
+    ''')
+    
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_orders_new_count_update
+        AFTER UPDATE OF status ON orders_new
+        WHEN OLD.status IS NOT NEW.status
+        BEGIN
+            UPDATE order_status_counts SET count = count - 1 WHERE status = OLD.status;
+            INSERT INTO order_status_counts (status, count) VALUES (NEW.status, 1)
+            ON CONFLICT (status) DO UPDATE SET count = count + 1;
+        END
+    ''')
+    
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_orders_new_count_delete
+        AFTER DELETE ON orders_new
+        BEGIN
+            UPDATE order_status_counts SET count = count - 1 WHERE status = OLD.status;
+        END
+    ''')
+    
+    # Keyset pagination orders by (created_at, id) - include id so no sort step is needed
+    conn.execute('DROP INDEX IF EXISTS idx_orders_new_created')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_orders_new_created ON orders_new(created_at DESC, id DESC)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_orders_new_status_created ON orders_new(status, created_at DESC, id DESC)')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_orders_new_email_created
+        ON orders_new(customer_email COLLATE NOCASE, created_at DESC, id DESC)
+    ''')
+
+
+def migrate_sales_rollups(conn):
+    """Daily sales rollups by day, category and SKU for the sales report"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sales_daily (
+            day TEXT PRIMARY KEY,
+            orders INTEGER NOT NULL DEFAULT 0,
+            units INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0,
+            gross REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sales_daily_category (
+            day TEXT NOT NULL,
+            category TEXT NOT NULL,
+            orders INTEGER NOT NULL DEFAULT 0,
+            units INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, category)
+        )
+    ''')
+    
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sales_daily_sku (
+            day TEXT NOT NULL,
+            sku TEXT NOT NULL,
+            name TEXT NOT NULL,
+            category TEXT NOT NULL,
+            orders INTEGER NOT NULL DEFAULT 0,
+            units INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, sku)
+        )
+    ''')
+    
+    # Backfill from the orders as they were at this schema version. This is a
+    # snapshot on purpose - rebuild_sales_rollups() keeps changing (it also reads
+    # archive.db now) and a migration must do the same thing on every database.
+    conn.execute('''
+        INSERT INTO sales_daily (day, orders, units, revenue, gross)
+        SELECT date(o.created_at), COUNT(*), COALESCE(SUM(u.units), 0), SUM(o.subtotal), SUM(o.total)
+        FROM orders_new o
+        LEFT JOIN (
+            SELECT order_id, SUM(quantity) AS units FROM order_items_new GROUP BY order_id
+        ) u ON u.order_id = o.id
+        WHERE o.status != 'cancelled'
+        GROUP BY date(o.created_at)
+    ''')
+    
+    conn.execute('''
+        INSERT INTO sales_daily_sku (day, sku, name, category, orders, units, revenue)
+        SELECT date(o.created_at), oi.product_sku, MAX(oi.product_name), COALESCE(MAX(p.category), 'other'),
+               COUNT(*), SUM(oi.quantity), SUM(oi.subtotal)
+        FROM order_items_new oi
+        JOIN orders_new o ON o.id = oi.order_id
+        LEFT JOIN products p ON p.sku = oi.product_sku
+        WHERE o.status != 'cancelled'
+        GROUP BY date(o.created_at), oi.product_sku
+    ''')
+    
+    conn.execute('''
+        INSERT INTO sales_daily_category (day, category, orders, units, revenue)
+        SELECT date(o.created_at), COALESCE(s.category, 'other'),
+               COUNT(DISTINCT o.id), SUM(oi.quantity), SUM(oi.subtotal)
+        FROM order_items_new oi
+        JOIN orders_new o ON o.id = oi.order_id
+        LEFT JOIN sales_daily_sku s ON s.day = date(o.created_at) AND s.sku = oi.product_sku
+        WHERE o.status != 'cancelled'
+        GROUP BY date(o.created_at), COALESCE(s.category, 'other')
+    ''')
+
+
+def migrate_activity_log_search(conn):
+    """Full-text index and distinct-user list for the activity log, plus keyset pagination indexes"""
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS activity_log_fts USING fts5(
+            product_name, product_sku, details,
+            content='activity_log', content_rowid='id'
+        )
+    ''')
+    conn.execute("INSERT INTO activity_log_fts (activity_log_fts) VALUES ('rebuild')")
+    
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_activity_log_fts_insert
+        AFTER INSERT ON activity_log
+        BEGIN
+            INSERT INTO activity_log_fts (rowid, product_name, product_sku, details)
+            VALUES (NEW.id, NEW.product_name, NEW.product_sku, NEW.details);
+        END
+    ''')
+    
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_activity_log_fts_delete
+        AFTER DELETE ON activity_log
+        BEGIN
+            INSERT INTO activity_log_fts (activity_log_fts, rowid, product_name, product_sku, details)
+            VALUES ('delete', OLD.id, OLD.product_name, OLD.product_sku, OLD.details);
+        END
+    ''')
+    
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_activity_log_fts_update
+        AFTER UPDATE OF product_name, product_sku, details ON activity_log
+        BEGIN
+            INSERT INTO activity_log_fts (activity_log_fts, rowid, product_name, product_sku, details)
+            VALUES ('delete', OLD.id, OLD.product_name, OLD.product_sku, OLD.details);
+            INSERT INTO activity_log_fts (rowid, product_name, product_sku, details)
+            VALUES (NEW.id, NEW.product_name, NEW.product_sku, NEW.details);
+        END
+    ''')
+    
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS activity_log_users (
+            user_name TEXT PRIMARY KEY,
+            entries INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('DELETE FROM activity_log_users')
+    conn.execute('''
+        INSERT INTO activity_log_users (user_name, entries)
+        SELECT user_name, COUNT(*) FROM activity_log GROUP BY user_name
+    ''')
+    
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_activity_log_users_insert
+        AFTER INSERT ON activity_log
+        BEGIN
+            INSERT INTO activity_log_users (user_name, entries) VALUES (NEW.user_name, 1)
+            ON CONFLICT (user_name) DO UPDATE SET entries = entries + 1;
+        END
+    ''')
+    
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_activity_log_users_delete
+        AFTER DELETE ON activity_log
+        BEGIN
+            UPDATE activity_log_users SET entries = entries - 1 WHERE user_name = OLD.user_name;
+            DELETE FROM activity_log_users WHERE user_name = OLD.user_name AND entries <= 0;
+        END
+    ''')
+    
+    # Keyset pagination orders by (timestamp, id)
+    for name, columns in [('idx_activity_log_timestamp', 'timestamp DESC, id DESC'),
+                          ('idx_activity_log_action', 'action, timestamp DESC, id DESC'),
+                          ('idx_activity_log_user', 'user_name, timestamp DESC, id DESC')]:
+        conn.execute(f'DROP INDEX IF EXISTS {name}')
+        conn.execute(f'CREATE INDEX {name} ON activity_log({columns})')
+
+
+def migrate_image_jobs(conn):
+    """Queue for background image derivative generation"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS image_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            filename TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            run_after REAL NOT NULL DEFAULT 0,
+            claimed_at REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_image_jobs_status ON image_jobs(status, run_after)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_image_jobs_filename ON image_jobs(filename, id DESC)')
+
+
+def migrate_image_metadata(conn):
+    """Per-image dimensions and placeholders, so templates never open image files"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS image_metadata (
+            filename TEXT PRIMARY KEY,
+            width INTEGER NOT NULL,
+            height INTEGER NOT NULL,
+            bytes INTEGER NOT NULL,
+            format TEXT NOT NULL,
+            dominant_color TEXT NOT NULL,
+            lqip TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+# (version, name, migration) - append only
+MIGRATIONS = [
+    (1, 'core_tables', migrate_core_tables),
+    (2, 'order_tables', migrate_order_tables),
+    (3, 'activity_log', migrate_activity_log),
+    (4, 'report_tables', migrate_report_tables),
+    (5, 'product_discount', migrate_product_discount),
+    (6, 'taste_profile', migrate_taste_profile),
+    (7, 'security_questions', migrate_security_questions),
+    (8, 'product_subcategories', migrate_product_subcategories),
+    (9, 'cart_tables', migrate_cart_tables),
+    (10, 'hot_path_indexes', migrate_hot_path_indexes),
+    (11, 'order_status_counts', migrate_order_status_counts),
+    (12, 'sales_rollups', migrate_sales_rollups),
+    (13, 'activity_log_search', migrate_activity_log_search),
+    (14, 'image_jobs', migrate_image_jobs),
+    (15, 'image_metadata', migrate_image_metadata),
+]
+
+LATEST_SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn):
+    """Current schema version (0 for a database that has never been migrated)"""
+    try:
+        row = conn.execute("SELECT MAX(version) AS version FROM schema_version").fetchone()
+    except sqlite3.OperationalError:
+        return 0  # schema_version table doesn't exist yet
+    return row['version'] or 0
 
-def add_discount_column():
-    """Add discount column to products table if it doesn't exist"""
+
+def run_migrations():
+    """Apply any pending migrations, each in its own transaction. Returns the versions applied."""
     conn = get_db_connection()
+    
+    # Fast path - one indexed lookup when the schema is already current
+    if get_schema_version(conn) >= LATEST_SCHEMA_VERSION:
+        conn.close()
+        return []
+    
+    conn.isolation_level = None  # Manage transactions explicitly so DDL is transactional
+    applied = []
     try:
-        # Check if discount column exists
-        cursor = conn.execute("PRAGMA table_info(products)")
-        columns = [column[1] for column in cursor.fetchall()]
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
         
-        if 'discount_percentage' not in columns:
-            conn.execute('''
-                ALTER TABLE products 
-                ADD COLUMN discount_percentage INTEGER DEFAULT 0
-            ''')
-            conn.commit()
-            print("✅ Discount column added to products table")
-        else:
-            print("ℹ️  Discount column already exists")
-    except Exception as e:
-        print(f"Error adding discount column: {e}")
+        for version, name, migration in MIGRATIONS:
+            # IMMEDIATE takes the write lock, so concurrent deploys can't apply a migration twice
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if conn.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,)).fetchone():
+                    conn.execute('ROLLBACK')
+                    continue
+                migration(conn)
+                conn.execute("INSERT INTO schema_version (version, name) VALUES (?, ?)", (version, name))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            applied.append(version)
+            print(f"✅ Applied migration {version:03d} {name}")
     finally:
         conn.close()
+    
+    return applied
+
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Apply pending database migrations."""
+    applied = run_migrations()
+    if applied:
+        print(f"✅ Database migrated to version {LATEST_SCHEMA_VERSION}")
+    else:
+        print(f"ℹ️  Database already at version {LATEST_SCHEMA_VERSION}")
+
+
+# ===========================
+# QUERY PLAN CHECKS
+# ===========================
+# `flask --app app check-query-plans` requests every hot page through the
+# test client, records the SELECTs the app really runs (via the connection
+# trace callback) and runs EXPLAIN QUERY PLAN on each one. It fails if any of
+# them falls back to a full table SCAN. When you add a hot page, add it to
+# HOT_PATHS (and an index migration if the check fails).
+
+# (name, role to sign in as or None, method, url)
+HOT_PATHS = [
+    # Customer pages
+    ('home', None, 'GET', '/'),
+    ('login', None, 'POST', '/login'),
+    ('account', 'customer', 'GET', '/account'),
+    ('my_orders', 'customer', 'GET', '/my-orders'),
+    ('order_confirmation', None, 'GET', '/order-confirmation/ORD-00000000'),
+    
+    # Catalog
+    ('product_detail', None, 'GET', '/product/1'),
+    ('beans', None, 'GET', '/beans'),
+    ('beans_subcategory', None, 'GET', '/beans/coffee-beans'),
+    ('accessories', None, 'GET', '/accessories/grinders'),
+    ('machines', None, 'GET', '/machines'),
+    # /search is left out: its '%term%' LIKE matching can't use an index
+    
+    # Cart
+    ('cart', 'customer', 'GET', '/cart'),
+    ('mini_cart', 'customer', 'GET', '/cart/mini'),
+    ('checkout', 'customer', 'GET', '/checkout'),
+    
+    # Admin / manager
+    ('admin_orders', 'admin', 'GET', '/admin/orders'),
+    ('admin_orders_next_page', 'admin', 'GET', '/admin/orders/data?cursor=2025-11-01 00:00:00|10'),
+    ('admin_orders_by_status', 'admin', 'GET', '/admin/orders/data?status=pending&cursor=2025-11-01 00:00:00|10'),
+    ('admin_orders_by_email', 'admin', 'GET', '/admin/orders/data?email=customer@example.com'),
+    ('admin_orders_by_date', 'admin', 'GET', '/admin/orders/data?date_from=2025-01-01&date_to=2025-12-31'),
+    ('orders_export', 'admin', 'GET', '/admin/orders/export?date_from=2025-01-01'),
+    ('admin_order_detail', 'admin', 'GET', '/admin/order/1'),
+    ('sales_report', 'manager', 'GET', '/manager/reports/sales'),
+    ('reports', 'manager', 'GET', '/manager/reports'),
+    ('manage_staff', 'manager', 'GET', '/manager/staff'),
+    ('activity_log', 'manager', 'GET', '/activity-log'),
+    ('activity_log_next_page', 'manager', 'GET', '/activity-log?cursor=2025-11-01 00:00:00|100'),
+    ('activity_log_by_action', 'manager', 'GET', '/activity-log?action=PRODUCT_EDITED&cursor=2025-11-01 00:00:00|100'),
+    ('activity_log_by_user', 'manager', 'GET', '/activity-log?user=cruz'),
+    ('activity_log_search', 'manager', 'GET', '/activity-log?search=espresso'),
+]
+
+# Tables that are small by design, so scanning them is fine
+SMALL_TABLES = {'schema_version', 'order_status_counts', 'activity_log_fts_config'}
+
+query_trace = None  # List of executed statements while check-query-plans is recording
+
+
+def capture_hot_queries():
+    """Request every HOT_PATHS page and return {name: [SELECT statements it ran]}"""
+    global query_trace
+    conn = get_db_connection()
+    users = {
+        role: conn.execute("SELECT id, name, role FROM customers WHERE role = ? ORDER BY id LIMIT 1", (role,)).fetchone()
+        for role in ('customer', 'admin', 'manager')
+    }
+    conn.close()
+    
+    client = app.test_client()
+    captured = {}
+    for name, role, method, url in HOT_PATHS:
+        with client.session_transaction() as sess:
+            sess.clear()
+            if role and users[role]:
+                sess.update(user_id=users[role]['id'], user_name=users[role]['name'], user_role=role)
+        
+        query_trace = []
+        try:
+            response = client.open(url, method=method, data={'email': 'nobody@example.com', 'password': 'x'})
+            response.get_data()  # Run streamed responses to the end
+        finally:
+            statements, query_trace = query_trace, None
+        
+        captured[name] = list(dict.fromkeys(
+            sql.strip() for sql in statements if sql.lstrip().upper().startswith(('SELECT', 'WITH'))
+        ))
+    return captured
+
+
+def check_query_plans(conn, captured):
+    """EXPLAIN every captured query. Returns {name: [(sql, plan lines, problems)]}."""
+    results = {}
+    for name, statements in captured.items():
+        results[name] = []
+        for sql in statements:
+            plan = [row['detail'] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}")]
+            # "SCAN t USING [COVERING] INDEX" walks an index in order and is fine;
+            # a bare "SCAN t" reads the whole table. FTS tables show up as
+            # "SCAN t VIRTUAL TABLE INDEX n:<constraints>" - empty constraints is a full scan.
+            problems = [
+                line for line in plan
+                if line.startswith('SCAN ') and ' USING ' not in line
+                and not (' VIRTUAL TABLE INDEX ' in line and not line.endswith(':'))
+                and line.split()[1].split('.')[-1] not in SMALL_TABLES
+            ]
+            results[name].append((sql, plan, problems))
+    return results
+
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """Fail if any query on a hot page does a full table scan."""
+    captured = capture_hot_queries()
+    conn = get_db_connection()
+    results = check_query_plans(conn, captured)
+    conn.close()
+    
+    failures = 0
+    for name, checks in results.items():
+        bad = [(sql, plan) for sql, plan, problems in checks if problems]
+        print(f"{'❌' if bad else '✅'} {name}: {len(checks)} queries")
+        for sql, plan in bad:
+            print(f"     {' '.join(sql.split())[:200]}\n       -> {' | '.join(plan)}")
+        failures += len(bad)
+    
+    if failures:
+        print(f"\n{failures} hot queries do a full table scan")
+        raise SystemExit(1)
+    print(f"\nAll queries on {len(results)} hot pages use an index")
+
 
 def set_product_discount():
     """Set 10% discount ONLY on Breville Barista Express (M-BRE003)"""
@@ -2053,36 +5508,6 @@ def set_product_discount():
         conn.close()
 
 
-def add_beans_subcategories():
-    """Update existing beans products with subcategories"""
-    conn = get_db_connection()
-    try:
-        # Check if any beans products exist without subcategories
-        beans = conn.execute('''
-            SELECT id, name FROM products 
-            WHERE category = 'beans' AND (subcategory IS NULL OR subcategory = '')
-        ''').fetchall()
-        
-        if beans:
-            print(f"Found {len(beans)} beans products without subcategories")
-            # You can manually categorize them or set a default
-            # For now, set them all to 'coffee-beans' as default
-            conn.execute('''
-                UPDATE products 
-                SET subcategory = 'coffee-beans' 
-                WHERE category = 'beans' AND (subcategory IS NULL OR subcategory = '')
-            ''')
-            conn.commit()
-            print("✅ Updated beans products with default subcategory 'coffee-beans'")
-        else:
-            print("ℹ️  All beans products already have subcategories")
-            
-    except Exception as e:
-        print(f"❌ Error updating beans subcategories: {e}")
-    finally:
-        conn.close()
-
-
 # ===========================
 # ERROR HANDLERS
 # ===========================
@@ -2099,40 +5524,46 @@ def not_found(e):
 def internal_error(e):
     return render_template('errors/500.html', error_code=500, error_message="Internal Server Error", year=datetime.now().year), 500
 
+@app.errorhandler(429)
+def too_many_requests(e):
+    response = app.make_response((render_template('errors/429.html', error_code=429, error_message="Too Many Requests", year=datetime.now().year), 429))
+    response.headers['Retry-After'] = str(g.get('retry_after', 60))
+    return response
+
+@app.errorhandler(503)
+def service_busy(e):
+    response = app.make_response((render_template('errors/503.html', error_code=503, error_message="Service Busy", year=datetime.now().year), 503))
+    response.headers['Retry-After'] = '2'
+    return response
+
 
 @app.route("/cart/items")
 def cart_items_api():
     """API endpoint to get cart items for mini cart"""
-    cart = session.get('cart', {})
+    conn = get_db_connection()
+    cart = load_cart(conn, get_cart_id(conn))
+    conn.close()
+    
     items = []
     total = 0
     
-    if cart:
-        conn = get_db_connection()
-        for cart_key, item_data in cart.items():
-            product_id = item_data['product_id']
-            quantity = item_data['quantity']
-            
-            product = conn.execute("SELECT * FROM products WHERE id = ?", (product_id,)).fetchone()
-            if product:
-                price = item_data.get('price', product['price'])
-                subtotal = price * quantity
-                
-                items.append({
-                    'product_id': product_id,
-                    'name': product['name'],
-                    'price': price,
-                    'quantity': quantity,
-                    'subtotal': subtotal,
-                    'image': product['image']
-                })
-                total += subtotal
-        conn.close()
+    for item_data in cart.values():
+        subtotal = item_data['price'] * item_data['quantity']
+        
+        items.append({
+            'product_id': item_data['product_id'],
+            'name': item_data['name'],
+            'price': item_data['price'],
+            'quantity': item_data['quantity'],
+            'subtotal': subtotal,
+            'image': item_data['image']
+        })
+        total += subtotal
     
     return jsonify({
         'items': items,
         'total': total,
-        'count': len(cart)
+        'count': sum(item['quantity'] for item in items)
     })
 
 
@@ -2401,9 +5832,5 @@ def manifest():
     return app.send_static_file('manifest.json')
 
 if __name__ == "__main__":
-    init_db()
-    init_orders_db()
-    init_reports_db() 
-    add_discount_column()
-    add_beans_subcategories()
+    run_migrations()
     app.run(debug=True)
\ No newline at end of file
@@ -1,5 +1,38 @@
 console.log('✅ cart.js loaded');
 
+// Batched cart API - sends add/update/remove operations in one request.
+// The response carries the new count, totals and mini cart HTML, so the
+// page never has to reload or make a follow-up request to refresh the cart.
+const CartAPI = {
+    batch: async function(operations) {
+        const response = await fetch('/cart/batch', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({ operations: operations })
+        });
+        const data = await response.json();
+        
+        if (data.success) {
+            MiniCart.render(data);
+        }
+        return data;
+    },
+    
+    add: function(productId, quantity = 1) {
+        return this.batch([{ op: 'add', product_id: parseInt(productId), quantity: quantity }]);
+    },
+    
+    update: function(productId, quantity) {
+        return this.batch([{ op: 'update', product_id: parseInt(productId), quantity: quantity }]);
+    },
+    
+    remove: function(productId) {
+        return this.batch([{ op: 'remove', product_id: parseInt(productId) }]);
+    }
+};
+
 // Add to cart from product detail page
 function addToCartDetail(productId) {
     const quantityInput = document.getElementById(`quantity-${productId}`);
@@ -7,20 +40,11 @@ function addToCartDetail(productId) {
     
     console.log('Adding to cart:', productId, 'Quantity:', quantity);
     
-    fetch(`/cart/add/${productId}`, {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({ quantity: quantity })
-    })
-    .then(response => response.json())
+    CartAPI.add(productId, quantity)
     .then(data => {
         console.log('Cart response:', data);
         if (data.success) {
             alert(`✅ ${quantity} item(s) added to cart!`);
-            // Reload page to update mini cart
-            window.location.reload();
         } else {
             alert(data.message || 'Error adding to cart');
         }
@@ -44,38 +68,72 @@ function changeQuantity(productId, change) {
     }
 }
 
+// Read the signed cart state cookie ("<count>.<version>.<tag>.<signature>").
+// The server rewrites it after every cart change, so the badge never needs a request.
+function readCartState() {
+    const match = document.cookie.match(/(?:^|; )cart_state=([^;]*)/);
+    if (!match) {
+        return { count: 0, key: '0.0' };
+    }
+    const [count, version, tag] = decodeURIComponent(match[1]).replace(/^"|"$/g, '').split('.');
+    return { count: parseInt(count) || 0, key: `${version}.${tag}` };
+}
+
 // Mini Cart functionality
 const MiniCart = {
-    updateCartCount: async function() {
+    // Update the badge and dropdown from a /cart/batch response
+    render: function(data) {
+        const cartBadge = document.getElementById('mini-cart-count');
+        if (cartBadge) {
+            cartBadge.textContent = data.cart_count || 0;
+        }
+        
+        const miniCartContent = document.getElementById('mini-cart-content');
+        if (miniCartContent && data.mini_cart_html !== undefined) {
+            miniCartContent.innerHTML = data.mini_cart_html;
+            this.cache(data.mini_cart_html);
+        }
+    },
+    
+    // Remember the rendered mini cart for the cart version it was rendered from
+    cache: function(html, key = readCartState().key) {
         try {
-            // Refresh the entire mini cart (count + content)
-            await this.refreshMiniCart();
-            
+            sessionStorage.setItem('miniCartHtml', html);
+            sessionStorage.setItem('miniCartKey', key);
         } catch (error) {
-            console.error('Error updating cart count:', error);
+            // Storage unavailable (private mode) - just refetch next time
         }
     },
     
-    refreshMiniCart: async function() {
+    updateCartCount: function() {
+        const cartBadge = document.getElementById('mini-cart-count');
+        if (cartBadge) {
+            cartBadge.textContent = readCartState().count;
+        }
+    },
+    
+    refreshMiniCart: async function(force = false) {
+        const miniCartContent = document.getElementById('mini-cart-content');
+        if (!miniCartContent) {
+            return;
+        }
+        
         try {
+            // Reuse the cached fragment while the cart version is unchanged
+            const key = readCartState().key;
+            const cachedHtml = sessionStorage.getItem('miniCartHtml');
+            if (!force && cachedHtml !== null && sessionStorage.getItem('miniCartKey') === key) {
+                miniCartContent.innerHTML = cachedHtml;
+                return;
+            }
+            
             // Fetch the mini cart HTML from server
             const response = await fetch('/cart/mini');
             const html = await response.text();
-            
-            // Update the mini cart content
-            const miniCartContent = document.getElementById('mini-cart-content');
-            if (miniCartContent) {
-                miniCartContent.innerHTML = html;
-                console.log('✅ Mini cart content refreshed');
-            }
-            
-            // Also update the cart count badge
-            const countResponse = await fetch('/cart/count');
-            const countData = await countResponse.json();
-            const cartBadge = document.getElementById('mini-cart-count');
-            if (cartBadge) {
-                cartBadge.textContent = countData.count || 0;
-            }
+            miniCartContent.innerHTML = html;
+            this.cache(html, response.headers.get('X-Cart-State') || readCartState().key);
+            this.updateCartCount();  // The response re-issued the state cookie
+            console.log('✅ Mini cart content refreshed');
             
         } catch (error) {
             console.error('Error refreshing mini cart:', error);
@@ -83,13 +141,54 @@ const MiniCart = {
     }
 };
 
+// Remove item from mini cart
+function removeFromMiniCart(cartKey) {
+    // Show loading state on button
+    const buttons = document.querySelectorAll('.mini-cart-delete-btn');
+    buttons.forEach(btn => {
+        const onclickStr = btn.getAttribute('onclick');
+        if (onclickStr && onclickStr.includes(cartKey)) {
+            btn.disabled = true;
+            btn.innerHTML = '<i class="bi bi-hourglass-split"></i>';
+        }
+    });
+    
+    window.CartAPI.remove(cartKey)
+    .then(data => {
+        if (!data.success) {
+            alert('Error removing item from cart');
+            // Re-enable button on error
+            buttons.forEach(btn => {
+                btn.disabled = false;
+                btn.innerHTML = '<i class="bi bi-trash"></i>';
+            });
+        }
+    })
+    .catch(error => {
+        console.error('Error:', error);
+        alert('Error removing item from cart');
+        // Re-enable button on error
+        buttons.forEach(btn => {
+            btn.disabled = false;
+            btn.innerHTML = '<i class="bi bi-trash"></i>';
+        });
+    });
+}
+
 // Initialize on page load
 document.addEventListener('DOMContentLoaded', function() {
-    console.log('DOM loaded, loading mini cart...');
     MiniCart.updateCartCount();
+    
+    // Only load the mini cart contents when the dropdown is opened
+    const cartDropdown = document.getElementById('cartDropdown');
+    if (cartDropdown) {
+        cartDropdown.addEventListener('show.bs.dropdown', () => MiniCart.refreshMiniCart());
+    }
 });
 
 // Make functions available globally
 window.MiniCart = MiniCart;
+window.CartAPI = CartAPI;
 window.addToCartDetail = addToCartDetail;
-window.changeQuantity = changeQuantity;
\ No newline at end of file
+window.changeQuantity = changeQuantity;
+window.removeFromMiniCart = removeFromMiniCart;
\ No newline at end of file
@@ -0,0 +1,24 @@
+// Blurred image placeholders (LQIP). image_attrs() puts the preview and
+// dominant colour in data attributes rather than an inline style/onload, so
+// the pages work under a Content-Security-Policy without 'unsafe-inline'.
+(function () {
+    function showPlaceholder(img) {
+        if (img.complete) {
+            return;
+        }
+        img.style.backgroundColor = img.dataset.lqipColor;
+        img.style.backgroundImage = 'url("' + img.dataset.lqip + '")';
+    }
+
+    // load doesn't bubble, so one capturing listener on the document sees every image
+    document.addEventListener('load', function (event) {
+        const img = event.target;
+        if (img.tagName === 'IMG' && img.dataset.lqip) {
+            img.classList.add('lqip-loaded');
+        }
+    }, true);
+
+    document.addEventListener('DOMContentLoaded', function () {
+        document.querySelectorAll('img[data-lqip]').forEach(showPlaceholder);
+    });
+})();
@@ -0,0 +1,82 @@
+import sqlite3
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+import app as store
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """The app running against a fresh store.db in a temp directory"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(store.app.config, 'TESTING', True)
+    monkeypatch.setitem(store.app.config, 'RATE_LIMIT_ENABLED', False)
+    monkeypatch.setitem(store.app.config, 'PASSWORD_HASH_ITERATIONS', 1000)
+    store.run_migrations()
+    yield store.app
+    store.flush_activity_log(timeout=5.0)
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def db(app):
+    conn = sqlite3.connect('store.db')
+    conn.row_factory = sqlite3.Row
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def make_order(db):
+    def make_order(order_number, user_id=None, status='pending', created_at=None, total=20.0):
+        cursor = db.execute("""
+            INSERT INTO orders_new (order_number, user_id, customer_name, customer_email, shipping_address,
+                                    shipping_city, shipping_state, shipping_zip, payment_method,
+                                    subtotal, tax, shipping_cost, total, status, created_at)
+            VALUES (?, ?, 'Test', 'test@example.com', '1 Test St', 'Sydney', 'NSW', '2000', 'card',
+                    ?, 0, 0, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+        """, (order_number, user_id, total, total, status, created_at))
+        db.execute("""
+            INSERT INTO order_items_new (order_id, product_sku, product_name, quantity, price, subtotal)
+            VALUES (?, 'SKU-1', 'Product SKU-1', 2, ?, ?)
+        """, (cursor.lastrowid, total / 2, total))
+        db.commit()
+        return cursor.lastrowid
+    return make_order
+
+
+@pytest.fixture
+def make_customer(db):
+    def make_customer(email, password='Secret#Pass12', role='customer'):
+        password_hash = generate_password_hash(password, method=store.current_hash_method(), salt_length=16)
+        cursor = db.execute(
+            "INSERT INTO customers (name, email, password, role) VALUES (?, ?, ?, ?)",
+            (email.split('@')[0], email, password_hash, role)
+        )
+        db.commit()
+        return cursor.lastrowid
+    return make_customer
+
+
+@pytest.fixture
+def make_product(db):
+    def make_product(sku, price=10.0, stock=10, category='beans'):
+        cursor = db.execute(
+            "INSERT INTO products (sku, name, category, price, stock) VALUES (?, ?, ?, ?, ?)",
+            (sku, f"Product {sku}", category, price, stock)
+        )
+        db.commit()
+        return cursor.lastrowid
+    return make_product
+
+
+@pytest.fixture
+def login(client):
+    def login(email, password='Secret#Pass12'):
+        return client.post('/login', data={'email': email, 'password': password})
+    return login
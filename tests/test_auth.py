@@ -0,0 +1,32 @@
+import hashlib
+import time
+
+from werkzeug.security import check_password_hash
+
+
+def stored_hash(db, user_id):
+    return db.execute("SELECT password FROM customers WHERE id = ?", (user_id,)).fetchone()['password']
+
+
+def test_legacy_unsalted_hash_logs_in_and_is_upgraded(client, db, make_customer, login):
+    user = make_customer('legacy@example.com')
+    legacy = hashlib.sha256(b'Secret#Pass12').hexdigest()
+    db.execute("UPDATE customers SET password = ? WHERE id = ?", (legacy, user))
+    db.commit()
+    
+    # A wrong password neither logs in nor touches the stored hash
+    login('legacy@example.com', 'Wrong#Pass12')
+    with client.session_transaction() as session:
+        assert 'user_id' not in session
+    assert stored_hash(db, user) == legacy
+    
+    login('legacy@example.com')
+    with client.session_transaction() as session:
+        assert session['user_id'] == user
+    
+    # The rehash finishes in the background after the response
+    deadline = time.monotonic() + 10
+    while stored_hash(db, user) == legacy and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert stored_hash(db, user).startswith('pbkdf2:sha256:1000$')
+    assert check_password_hash(stored_hash(db, user), 'Secret#Pass12')
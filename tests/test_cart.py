@@ -0,0 +1,63 @@
+def batch(client, *operations):
+    return client.post('/cart/batch', json={'operations': list(operations)})
+
+
+def cart_quantities(db, cart_id):
+    return {row['product_id']: row['quantity']
+            for row in db.execute("SELECT product_id, quantity FROM cart_items WHERE cart_id = ?", (cart_id,))}
+
+
+def test_batch_add_is_limited_by_stock(client, make_product):
+    product_id = make_product('SKU-1', stock=3)
+    
+    assert batch(client, {'op': 'add', 'product_id': product_id, 'quantity': 2}).status_code == 200
+    # 2 already in the cart + 2 more is past the 3 in stock
+    response = batch(client, {'op': 'add', 'product_id': product_id, 'quantity': 2})
+    assert response.status_code == 400
+    assert batch(client, {'op': 'add', 'product_id': product_id, 'quantity': 1}).status_code == 200
+
+
+def test_batch_checks_the_final_quantity(client, db, make_product):
+    product_id = make_product('SKU-1', stock=3)
+    batch(client, {'op': 'add', 'product_id': product_id, 'quantity': 1})
+    
+    response = batch(client,
+                     {'op': 'update', 'product_id': product_id, 'quantity': 2},
+                     {'op': 'add', 'product_id': product_id, 'quantity': 2})
+    assert response.status_code == 400
+    
+    with client.session_transaction() as session:
+        cart_id = session['cart_id']
+    assert cart_quantities(db, cart_id) == {product_id: 1}  # Rejected batches change nothing
+    
+    response = batch(client,
+                     {'op': 'update', 'product_id': product_id, 'quantity': 2},
+                     {'op': 'add', 'product_id': product_id, 'quantity': 1})
+    assert response.status_code == 200
+    assert cart_quantities(db, cart_id) == {product_id: 3}
+
+
+def test_login_does_not_take_another_users_cart(client, db, make_customer, make_product, login):
+    product_id = make_product('SKU-1')
+    alice = make_customer('alice@example.com')
+    bob = make_customer('bob@example.com')
+    
+    login('alice@example.com')
+    batch(client, {'op': 'add', 'product_id': product_id, 'quantity': 2})
+    with client.session_transaction() as session:
+        alice_cart = session['cart_id']
+    
+    # Bob logs in on the same browser without Alice logging out
+    login('bob@example.com')
+    with client.session_transaction() as session:
+        assert session.get('cart_id') != alice_cart
+    owner = db.execute("SELECT user_id FROM carts WHERE id = ?", (alice_cart,)).fetchone()
+    assert owner['user_id'] == alice
+    assert cart_quantities(db, alice_cart) == {product_id: 2}
+    assert db.execute("SELECT COUNT(*) FROM carts WHERE user_id = ?", (bob,)).fetchone()[0] == 0
+    
+    # Alice gets her cart back when she logs in again
+    client.get('/logout')
+    login('alice@example.com')
+    with client.session_transaction() as session:
+        assert session['cart_id'] == alice_cart
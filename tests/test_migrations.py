@@ -0,0 +1,14 @@
+import app as store
+
+
+def test_migrations_build_an_empty_database(db):
+    versions = [row['version'] for row in db.execute("SELECT version FROM schema_version ORDER BY version")]
+    assert versions == [version for version, _, _ in store.MIGRATIONS]
+    
+    tables = {row['name'] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert {'products', 'customers', 'orders_new', 'order_items_new', 'activity_log', 'carts', 'cart_items'} <= tables
+
+
+def test_migrations_are_idempotent(db):
+    store.run_migrations()
+    assert db.execute("SELECT COUNT(*) FROM schema_version").fetchone()[0] == len(store.MIGRATIONS)
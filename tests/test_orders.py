@@ -0,0 +1,146 @@
+import os
+import sqlite3
+
+import pytest
+
+import app as store
+
+
+def sales_orders(db):
+    return db.execute("SELECT COALESCE(SUM(orders), 0) FROM sales_daily").fetchone()[0]
+
+
+class RacingConnection(sqlite3.Connection):
+    """Changes one order's status right before the first guarded UPDATE, as a concurrent request would"""
+    race = None
+    
+    def run_race(self, sql):
+        if RacingConnection.race and sql.lstrip().startswith('UPDATE orders_new'):
+            order_id, status = RacingConnection.race
+            RacingConnection.race = None
+            super().execute("UPDATE orders_new SET status = ? WHERE id = ?", (status, order_id))
+    
+    def execute(self, sql, *args):
+        self.run_race(sql)
+        return super().execute(sql, *args)
+    
+    def executemany(self, sql, *args):
+        self.run_race(sql)
+        return super().executemany(sql, *args)
+
+
+def test_bulk_status_skips_orders_changed_concurrently(client, db, monkeypatch, make_customer, make_order):
+    manager = make_customer('manager@example.com', role='manager')
+    first = make_order('ORD-1')
+    second = make_order('ORD-2')
+    store.rebuild_sales_rollups(db)
+    db.commit()
+    assert sales_orders(db) == 2
+    
+    def racing_connection():
+        conn = sqlite3.connect('store.db', factory=RacingConnection)
+        conn.row_factory = sqlite3.Row
+        return conn
+    monkeypatch.setattr(store, 'get_db_connection', racing_connection)
+    RacingConnection.race = (second, 'shipped')
+    
+    with client.session_transaction() as session:
+        session.update(user_id=manager, user_name='manager', user_role='manager')
+    response = client.post('/admin/orders/bulk-status', json={'orders': [first, second], 'status': 'cancelled'})
+    
+    assert response.get_json()['updated'] == 1
+    statuses = dict(db.execute("SELECT id, status FROM orders_new").fetchall())
+    assert statuses == {first: 'cancelled', second: 'shipped'}
+    assert sales_orders(db) == 1  # Only the order that was actually cancelled left the rollups
+    
+    log = db.execute("SELECT details FROM activity_log WHERE action = 'ORDERS_STATUS_UPDATED'").fetchone()
+    assert 'ORD-1' in log['details'] and 'ORD-2' not in log['details']
+
+
+def test_status_counts_follow_order_changes(db, make_order):
+    first = make_order('ORD-1')
+    make_order('ORD-2')
+    make_order('ORD-3', status='shipped')
+    
+    db.execute("UPDATE orders_new SET status = 'cancelled' WHERE id = ?", (first,))
+    db.execute("DELETE FROM orders_new WHERE order_number = 'ORD-3'")
+    db.commit()
+    
+    counts = store.get_order_status_counts(db)
+    assert counts['pending'] == 1
+    assert counts['cancelled'] == 1
+    assert counts['shipped'] == 0
+    assert sum(counts.values()) == db.execute("SELECT COUNT(*) FROM orders_new").fetchone()[0]
+
+
+def test_export_includes_archived_orders_in_keyset_order(make_order):
+    make_order('ORD-OLD', status='delivered', created_at="2000-01-01 10:00:00")
+    make_order('ORD-LIVE', status='shipped', created_at="2000-03-01 10:00:00")
+    make_order('ORD-ARCHIVED', status='cancelled', created_at="2000-06-01 10:00:00")
+    make_order('ORD-RECENT')
+    store.archive_orders(365)
+    filters = {'status': '', 'email': '', 'date_from': None, 'date_to': None}
+    
+    def exported(cursor=None, include_archived=False):
+        return [order['order_number']
+                for orders, _ in store.iter_order_export_batches(filters, cursor, include_archived)
+                for order in orders]
+    
+    assert exported() == ['ORD-LIVE', 'ORD-RECENT']
+    assert exported(include_archived=True) == ['ORD-OLD', 'ORD-LIVE', 'ORD-ARCHIVED', 'ORD-RECENT']
+    
+    # A cursor from the merged export resumes both sources
+    batches = list(store.iter_order_export_batches(filters, None, True))
+    live = batches[0][0][1]
+    assert exported((live['created_at'], live['id']), include_archived=True) == ['ORD-ARCHIVED', 'ORD-RECENT']
+
+
+def test_my_orders_merges_archived_orders_by_date(client, make_customer, make_order, login):
+    user = make_customer('alice@example.com')
+    make_order('ORD-RECENT', user_id=user)
+    make_order('ORD-ARCHIVED', user_id=user, status='delivered', created_at="2000-06-01 10:00:00")
+    make_order('ORD-STILL-SHIPPING', user_id=user, status='shipped', created_at="2000-01-01 10:00:00")
+    assert store.archive_orders(365) == 1
+    
+    history = store.get_customer_order_history(user)
+    assert [order['order_number'] for order in history] == ['ORD-RECENT', 'ORD-ARCHIVED', 'ORD-STILL-SHIPPING']
+    assert [order['order_number'] for order in store.get_customer_order_history(user, limit=2)] == \
+        ['ORD-RECENT', 'ORD-ARCHIVED']
+    
+    login('alice@example.com')
+    page = client.get('/my-orders').get_data(as_text=True)
+    positions = [page.index(number) for number in ('ORD-RECENT', 'ORD-ARCHIVED', 'ORD-STILL-SHIPPING')]
+    assert positions == sorted(positions)
+
+
+def test_status_counts_cover_live_orders_only(db, make_order):
+    make_order('ORD-1', status='delivered', created_at="2000-01-01 10:00:00")
+    make_order('ORD-2', status='delivered')
+    store.archive_orders(365)
+    
+    counts = store.get_order_status_counts(db)
+    assert counts['delivered'] == 1
+    assert sum(counts.values()) == db.execute("SELECT COUNT(*) FROM orders_new").fetchone()[0]
+    assert store.get_archived_order_count() == 1
+
+
+def test_reading_order_history_does_not_create_the_archive(make_customer, make_order):
+    user = make_customer('alice@example.com')
+    make_order('ORD-1', user_id=user)
+    
+    assert [order['order_number'] for order in store.get_customer_order_history(user)] == ['ORD-1']
+    assert store.find_archived_order(order_number='ORD-1') == (None, [])
+    assert store.get_archived_order_count() == 0
+    assert not os.path.exists(store.ARCHIVE_DB_PATH)
+
+
+def test_archiving_never_drops_an_order_that_is_already_archived(db, make_order):
+    make_order('ORD-1', status='delivered', created_at="2000-01-01 10:00:00")
+    assert store.archive_orders(365) == 1
+    # The same order number turns up live again, e.g. restored from a backup
+    make_order('ORD-1', status='delivered', created_at="2000-01-01 10:00:00")
+    
+    with pytest.raises(sqlite3.IntegrityError):
+        store.archive_orders(365)
+    assert db.execute("SELECT COUNT(*) FROM orders_new WHERE order_number = 'ORD-1'").fetchone()[0] == 1
+    assert db.execute("SELECT COUNT(*) FROM order_items_new").fetchone()[0] == 1
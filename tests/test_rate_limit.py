@@ -0,0 +1,20 @@
+import app as store
+
+
+def test_sqlite_buckets_refill_and_run_no_ddl_per_request(app, monkeypatch):
+    monkeypatch.setattr(store, 'rate_limit_db_ready', False)
+    
+    assert [store.take_token_sqlite('login:ip:1.2.3.4', 2, 60, 100.0) for _ in range(3)] == [0, 0, 60.0]
+    assert store.take_token_sqlite('login:ip:1.2.3.4', 2, 60, 160.0) == 0  # One token back after a minute
+    assert store.rate_limit_db_ready
+    
+    # Once the table exists the per-request path only reads and upserts
+    executed = []
+    connect = store.sqlite3.connect
+    def tracing_connect(*args, **kwargs):
+        conn = connect(*args, **kwargs)
+        conn.set_trace_callback(executed.append)
+        return conn
+    monkeypatch.setattr(store.sqlite3, 'connect', tracing_connect)
+    store.take_token_sqlite('login:ip:1.2.3.4', 2, 60, 160.0)
+    assert executed and not any('CREATE' in sql for sql in executed)